@@ -0,0 +1,133 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, os, random, sys, time
+
+import question_engine as qeng
+import generate_questions as gen
+
+"""
+Check that pruning with TemplateCSP (--instantiation_engine csp) never changes
+which instantiations are found. For every scene and template, this runs an
+exhaustive depth-first search with and without TemplateCSP.prune and compares
+the sets of complete states that pass check_state and refer to the changed
+object; the random empty and trivial filter options of expand_state are drawn
+with the same seed for a state in both searches. Exits with a nonzero status
+if the sets differ for any scene and template:
+
+python check_csp.py --input_scene_file ../output/CLEVR_scenes.json \
+  --input_changed_scene_file ../output/CLEVR_sc_scenes.json --num_scenes 10
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
+    help="JSON file containing ground-truth scene information for all images " +
+         "from render_images.py")
+parser.add_argument('--input_changed_scene_file',
+    default='../output/CLEVR_sc_scenes.json',
+    help="JSON file containing ground-truth scene information for the " +
+         "changed versions of the images")
+parser.add_argument('--metadata_file', default='metadata.json',
+    help="JSON file containing metadata about functions")
+parser.add_argument('--template_dir', default='CLEVR_change_templates',
+    help="Directory containing JSON templates for questions")
+parser.add_argument('--scene_start_idx', default=0, type=int,
+    help="The image at which to start checking")
+parser.add_argument('--num_scenes', default=0, type=int,
+    help="The number of images to check; defaults to all images")
+
+
+def load_templates(template_dir):
+  templates = []
+  for fn in sorted(os.listdir(template_dir)):
+    if not fn.endswith('.json'): continue
+    with open(os.path.join(template_dir, fn), 'r') as f:
+      for i, template in enumerate(json.load(f)):
+        templates.append(((fn, i), template))
+  return templates
+
+
+def complete_states(scene_struct, change, template, metadata, prune=None):
+  """
+  Run an exhaustive depth-first search over the instantiations of template,
+  returning the set of parameter values of complete states that refer to the
+  changed object, and the number of states visited.
+  """
+  param_name_to_type = {p['name']: p['type'] for p in template['params']}
+  states = [gen.initial_search_state(template)]
+  found = set()
+  num_states = 0
+  while states:
+    state = states.pop()
+    num_states += 1
+    outputs = gen.check_state(state, template, metadata, scene_struct,
+                              param_name_to_type)
+    if outputs is None:
+      continue
+    if gen.is_complete_state(state, template):
+      if gen.refers_to_change(outputs, change):
+        found.add(tuple(sorted(state['vals'].items())))
+      continue
+    # Draw the same random filter options for this state in both searches
+    random.seed(repr(sorted(state['vals'].items()))
+                + str(state['next_template_node']))
+    states.extend(gen.expand_state(state, outputs, template, metadata,
+                                   scene_struct, param_name_to_type,
+                                   prune=prune))
+  return found, num_states
+
+
+def main(args):
+  with open(args.metadata_file, 'r') as f:
+    metadata = json.load(f)
+  metadata['_functions_by_name'] = dict((f['name'], f)
+                                        for f in metadata['functions'])
+  templates = load_templates(args.template_dir)
+  scenes, _ = gen.load_scene_file(args.input_scene_file)
+  changed_scenes, _ = gen.load_scene_file(args.input_changed_scene_file)
+  end = len(scenes)
+  if args.num_scenes > 0:
+    end = min(end, args.scene_start_idx + args.num_scenes)
+
+  num_checked, mismatched = 0, []
+  totals = {'dfs': [0.0, 0], 'csp': [0.0, 0]}
+  for i in range(args.scene_start_idx, end):
+    scene_struct = qeng.SceneContext(scenes[i])
+    change = gen.find_change(scene_struct, changed_scenes[i])
+    for key, template in templates:
+      tic = time.time()
+      expected, n = complete_states(scene_struct, change, template, metadata)
+      totals['dfs'][0] += time.time() - tic
+      totals['dfs'][1] += n
+
+      tic = time.time()
+      csp = gen.TemplateCSP(template, metadata, scene_struct, change=change)
+      found, n = complete_states(scene_struct, change, template, metadata,
+                                 prune=csp.prune)
+      totals['csp'][0] += time.time() - tic
+      totals['csp'][1] += n
+
+      num_checked += 1
+      if found != expected:
+        mismatched.append((scenes[i]['image_filename'], key,
+                           len(expected), len(found)))
+    scene_struct.release()
+
+  print('Checked %d scene and template pairs, %d mismatched'
+        % (num_checked, len(mismatched)))
+  for name in ['dfs', 'csp']:
+    print('%s: %.1f s, %d states' % (name, totals[name][0], totals[name][1]))
+  for fn, key, num_expected, num_found in mismatched:
+    print('%s %s[%d]: %d instantiations without pruning, %d with'
+          % (fn, key[0], key[1], num_expected, num_found))
+  return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  sys.exit(main(args))
@@ -0,0 +1,49 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import argparse, json, sys
+
+import question_engine as qeng
+
+"""
+Check that relationships derived on load (see derive_relationships in
+question_engine.py) exactly match the relationships stored by the renderer.
+Run this on scene files written with stored relationships before switching
+rendering to --store_relationships 0; it exits with a nonzero status if any
+scene differs.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input_scene_files', nargs='+',
+    help="JSON files containing ground-truth scene information with " +
+         "stored relationships, as written by render_images.py")
+parser.add_argument('--eps', default=0.2, type=float,
+    help="The threshold that was used by compute_all_relationships")
+
+
+def main(args):
+  num_scenes, mismatched = 0, []
+  for path in args.input_scene_files:
+    with open(path, 'r') as f:
+      scenes = json.load(f)['scenes']
+    for scene in scenes:
+      if 'relationships' not in scene:
+        continue
+      num_scenes += 1
+      spec = {'version': qeng.RELATIONSHIPS_VERSION, 'eps': args.eps}
+      derived = qeng.derive_relationships(dict(scene, relationships_spec=spec))
+      if derived != scene['relationships']:
+        mismatched.append(scene['image_filename'])
+  print('Checked %d scenes, %d mismatched' % (num_scenes, len(mismatched)))
+  for fn in mismatched:
+    print(fn)
+  return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  sys.exit(main(args))
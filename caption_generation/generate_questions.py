@@ -6,11 +6,13 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import argparse, json, os, itertools, random, shutil
+import argparse, json, os, itertools, random, shutil, sys
+import resource
 import time
 import re
 
 import question_engine as qeng
+import shared_counts
 
 """
 Generate synthetic questions and answers for CLEVR images. Input is a single
@@ -38,6 +40,11 @@ program during each step of template expansion. This together with the use of
 composite nodes in program templates (filter_unique, relate_filter_unique) allow
 us to efficiently prune the search space and terminate early when we know that
 (1) or (2) will be violated.
+
+Alternatively templates can be instantiated by sampling: we count the number
+of valid completions of each partial instantiation and walk down the search
+tree choosing children in proportion to their counts; see
+instantiate_templates_sampling.
 """
 
 
@@ -47,10 +54,10 @@ parser = argparse.ArgumentParser()
 # Inputs
 parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py, or a .bin file converted by scene_store.py")
 parser.add_argument('--input_changed_scene_file', default='../output/CLEVR_sc_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py, or a .bin file converted by scene_store.py")
 parser.add_argument('--metadata_file', default='metadata.json',
     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='synonyms.json',
@@ -62,6 +69,22 @@ parser.add_argument('--template_dir', default='CLEVR_change_templates',
 parser.add_argument('--output_questions_file',
     default='../output/CLEVR_questions.json',
     help="The output file to write containing generated questions")
+parser.add_argument('--output_format', default='json',
+    choices=['json', 'npy', 'both'],
+    help="Format for the generated questions. \"npy\" writes token-id arrays " +
+         "for question text and prefix-serialized programs, plus answer ids, " +
+         "as .npy files in --output_encoded_dir that can be memory-mapped; " +
+         "\"both\" writes the JSON file as well.")
+parser.add_argument('--output_encoded_dir',
+    default='../output/CLEVR_questions_encoded',
+    help="Directory where encoded .npy arrays are written when " +
+         "--output_format is npy or both. Use one directory per shard.")
+parser.add_argument('--input_vocab_json', default=None,
+    help="Optional vocabulary file to encode questions with; by default the " +
+         "vocabulary is built from the metadata, templates and synonyms, " +
+         "which gives the same token ids for every shard.")
+parser.add_argument('--output_vocab_json', default='../output/CLEVR_vocab.json',
+    help="Where to write the vocabulary used for encoded output")
 
 # Control which and how many images to process
 parser.add_argument('--scene_start_idx', default=0, type=int,
@@ -79,12 +102,37 @@ parser.add_argument('--templates_per_image', default=10, type=int,
          "on each image")
 parser.add_argument('--instances_per_template', default=1, type=int,
     help="The number of times each template should be instantiated on an image")
+parser.add_argument('--instantiation_engine', default='dfs',
+    choices=['dfs', 'csp', 'sampling'],
+    help="How to search for template instantiations. \"dfs\" runs a " +
+         "randomized depth-first search; \"csp\" is the same search but " +
+         "propagates template constraints before creating each child state; " +
+         "\"sampling\" counts the valid " +
+         "completions of each partial instantiation and samples " +
+         "instantiations in proportion to these counts, which gives more " +
+         "uniform questions and bounds the time spent per template.")
+parser.add_argument('--max_count_states', default=10000, type=int,
+    help="With --instantiation_engine sampling, stop counting after " +
+         "expanding this many distinct search states and instantiate the " +
+         "template with depth-first search instead")
 
 # Misc
 parser.add_argument('--reset_counts_every', default=250, type=int,
     help="How often to reset template and answer counts. Higher values will " +
          "result in flatter distributions over templates and answers, but " +
          "will result in longer runtimes.")
+parser.add_argument('--num_workers', default=1, type=int,
+    help="Number of worker processes. With more than one worker, scenes are " +
+         "packed once into shared memory that all workers read from, and " +
+         "template and answer counts are shared between workers (through " +
+         "--shared_counts_file if given, otherwise a temporary file). " +
+         "Requires NumPy.")
+parser.add_argument('--shared_counts_file', default=None,
+    help="Optional path to a file holding template and answer counts that " +
+         "are shared by all workers on this machine that are given the same " +
+         "file, so that their questions are balanced jointly; " +
+         "--reset_counts_every then counts scenes over all workers. The " +
+         "file is created if it does not exist.")
 parser.add_argument('--verbose', action='store_true',
     help="Print more verbose output")
 parser.add_argument('--time_dfs', action='store_true',
@@ -129,19 +177,20 @@ def precompute_filter_options(scene_struct, metadata):
           attribute_map[masked_key] = set()
         attribute_map[masked_key].add(object_idx)
 
-  scene_struct['_filter_options'] = attribute_map
+  qeng.get_scene_cache(scene_struct)['_filter_options'] = attribute_map
 
 
 def find_filter_options(object_idxs, scene_struct, metadata):
   # Keys are tuples (size, color, shape, material) (where some may be None)
   # and values are lists of object idxs that match the filter criterion
 
-  if '_filter_options' not in scene_struct:
+  scene_cache = qeng.get_scene_cache(scene_struct)
+  if '_filter_options' not in scene_cache:
     precompute_filter_options(scene_struct, metadata)
 
   attribute_map = {}
   object_idxs = set(object_idxs)
-  for k, vs in scene_struct['_filter_options'].items():
+  for k, vs in scene_cache['_filter_options'].items():
     attribute_map[k] = sorted(list(object_idxs & vs))
   return attribute_map
 
@@ -168,7 +217,8 @@ def add_empty_filter_options(attribute_map, metadata, num_to_add):
 def find_relate_filter_options(object_idx, scene_struct, metadata,
     unique=False, include_zero=False, trivial_frac=0.1):
   options = {}
-  if '_filter_options' not in scene_struct:
+  scene_cache = qeng.get_scene_cache(scene_struct)
+  if '_filter_options' not in scene_cache:
     precompute_filter_options(scene_struct, metadata)
 
   # TODO: Right now this is only looking for nontrivial combinations; in some
@@ -177,7 +227,7 @@ def find_relate_filter_options(object_idx, scene_struct, metadata,
   trivial_options = {}
   for relationship in scene_struct['relationships']:
     related = set(scene_struct['relationships'][relationship][object_idx])
-    for filters, filtered in scene_struct['_filter_options'].items():
+    for filters, filtered in scene_cache['_filter_options'].items():
       intersection = related & filtered
       trivial = (intersection == filtered)
       if unique and len(intersection) != 1: continue
@@ -242,291 +292,701 @@ def other_heuristic(text, param_vals):
   return text
 
 
-def instantiate_templates_dfs(scene_struct, changed_scene_struct, 
-                              template, metadata, answer_counts,
-                              synonyms, max_instances=None, verbose=False):
-
-  param_name_to_type = {p['name']: p['type'] for p in template['params']}
-
-  initial_state = {
-    'nodes': [node_shallow_copy(template['nodes'][0])],
-    'vals': {},
-    'input_map': {0: 0},
-    'next_template_node': 1,
-  }
-  states = [initial_state]
-  final_states = []
-  while states:
-    state = states.pop()
-
-    # Check to make sure the current state is valid
-    q = {'nodes': state['nodes']}
-    outputs = qeng.answer_question(q, metadata, scene_struct, all_outputs=True)
-    answer = outputs[-1]
-    default_objects = scene_struct['objects']
-    changed_objects = changed_scene_struct['objects']
-    for changed_idx, (from_obj, to_obj) in enumerate(zip(default_objects, changed_objects)):
-      assert from_obj['3d_coords'] == to_obj['3d_coords']
-      from_color = from_obj['color']
-      to_color = to_obj['color']
-      from_material = from_obj['material']
-      to_material = to_obj['material']
-      if from_color != to_color:
-        change_type = 'color'
-        change_from = from_color
-        change_to = to_color
-        break
-      if from_material != to_material:
-        change_type = 'material'
-        change_from = from_material
-        change_to = to_material
-        break
-
-    refexp_obj = outputs[-2] if len(outputs) > 1 else None
-    if answer == '__INVALID__': continue
-
-    # Check to make sure constraints are satisfied for the current state
-    skip_state = False
-    for constraint in template['constraints']:
-      if constraint['type'] == 'NEQ':
-        p1, p2 = constraint['params']
-        v1, v2 = state['vals'].get(p1), state['vals'].get(p2)
-        if v1 is not None and v2 is not None and v1 != v2:
+def find_change(scene_struct, changed_scene_struct):
+  """
+  Find the object that differs between a scene and its semantically changed
+  version. Returns a tuple (changed_idx, change_type, change_from, change_to);
+  if no color or material change is found then change_type is None.
+  """
+  default_objects = scene_struct['objects']
+  changed_objects = changed_scene_struct['objects']
+  changed_idx = None
+  for changed_idx, (from_obj, to_obj) in enumerate(zip(default_objects, changed_objects)):
+    assert from_obj['3d_coords'] == to_obj['3d_coords']
+    from_color = from_obj['color']
+    to_color = to_obj['color']
+    from_material = from_obj['material']
+    to_material = to_obj['material']
+    if from_color != to_color:
+      return changed_idx, 'color', from_color, to_color
+    if from_material != to_material:
+      return changed_idx, 'material', from_material, to_material
+  return changed_idx, None, None, None
+
+
+def check_state(state, template, metadata, scene_struct, param_name_to_type,
+                verbose=False):
+  """
+  Evaluate the partial program of a search state and check the template
+  constraints against it. Returns the list of node outputs if the state is
+  valid, and None if the state (and hence every state below it) is invalid.
+  """
+  q = {'nodes': state['nodes']}
+  outputs = qeng.answer_question(q, metadata, scene_struct, all_outputs=True)
+  answer = outputs[-1]
+  if answer == '__INVALID__': return None
+
+  # Check to make sure constraints are satisfied for the current state
+  for constraint in template['constraints']:
+    if constraint['type'] == 'NEQ':
+      p1, p2 = constraint['params']
+      v1, v2 = state['vals'].get(p1), state['vals'].get(p2)
+      if v1 is not None and v2 is not None and v1 != v2:
+        if verbose:
+          print('skipping due to NEQ constraint')
+          print(constraint)
+          print(state['vals'])
+        return None
+    elif constraint['type'] == 'NULL':
+      p = constraint['params'][0]
+      p_type = param_name_to_type[p]
+      v = state['vals'].get(p)
+      if v is not None:
+        skip = False
+        if p_type == 'Shape' and v != 'thing': skip = True
+        if p_type != 'Shape' and v != '': skip = True
+        if skip:
           if verbose:
-            print('skipping due to NEQ constraint')
+            print('skipping due to NULL constraint')
             print(constraint)
             print(state['vals'])
-          skip_state = True
-          break
-      elif constraint['type'] == 'NULL':
-        p = constraint['params'][0]
-        p_type = param_name_to_type[p]
-        v = state['vals'].get(p)
-        if v is not None:
-          skip = False
-          if p_type == 'Shape' and v != 'thing': skip = True
-          if p_type != 'Shape' and v != '': skip = True
-          if skip:
-            if verbose:
-              print('skipping due to NULL constraint')
-              print(constraint)
-              print(state['vals'])
-            skip_state = True
-            break
-      elif constraint['type'] == 'OUT_NEQ':
-        i, j = constraint['params']
-        i = state['input_map'].get(i, None)
-        j = state['input_map'].get(j, None)
-        if i is not None and j is not None and outputs[i] == outputs[j]:
-          if verbose:
-            print('skipping due to OUT_NEQ constraint')
-            print(outputs[i])
-            print(outputs[j])
-          skip_state = True
-          break
-      else:
-        assert False, 'Unrecognized constraint type "%s"' % constraint['type']
+          return None
+    elif constraint['type'] == 'OUT_NEQ':
+      i, j = constraint['params']
+      i = state['input_map'].get(i, None)
+      j = state['input_map'].get(j, None)
+      if i is not None and j is not None and outputs[i] == outputs[j]:
+        if verbose:
+          print('skipping due to OUT_NEQ constraint')
+          print(outputs[i])
+          print(outputs[j])
+        return None
+    else:
+      assert False, 'Unrecognized constraint type "%s"' % constraint['type']
 
-    if skip_state:
-      continue
+  return outputs
 
-    # We have already checked to make sure the answer is valid, so if we have
-    # processed all the nodes in the template then the current state is a valid
-    # question, so add it if it passes our rejection sampling tests.
-    if state['next_template_node'] == len(template['nodes']):
-      # Use our rejection sampling heuristics to decide whether we should
-      # keep this template instantiation
-      cur_answer_count = answer_counts[answer]
-      answer_counts_sorted = sorted(answer_counts.values())
-      median_count = answer_counts_sorted[len(answer_counts_sorted) // 2]
-      median_count = max(median_count, 5)
-      if cur_answer_count > 1.1 * answer_counts_sorted[-2]:
-        if verbose: print('skipping due to second count')
-        continue
-      if cur_answer_count > 5.0 * median_count:
-        if verbose: print('skipping due to median')
-        continue
 
-      # If the template contains a raw relate node then we need to check for
-      # degeneracy at the end
-      has_relate = any(n['type'] == 'relate' for n in template['nodes'])
-      if has_relate:
-        degen = qeng.is_degenerate(q, metadata, scene_struct, answer=answer,
-                                   verbose=verbose)
-        if degen:
-          continue
+def is_complete_state(state, template):
+  return state['next_template_node'] == len(template['nodes'])
 
-      if changed_idx != refexp_obj: continue
 
-      answer_counts[answer] += 1
-      state['answer'] = answer
-      assert isinstance(refexp_obj, int)
-      state['refexp_obj'] = refexp_obj
-      state['changed_idx'] = changed_idx
-      state['change_type'] = change_type
-      state['change_from'] = change_from
-      state['change_to'] = change_to
-      final_states.append(state)
-      if max_instances is not None and len(final_states) == max_instances:
-        break
-      continue
+def refers_to_change(outputs, change):
+  """
+  A complete state is only useful for a caption if the object it refers to is
+  the one that was changed.
+  """
+  refexp_obj = outputs[-2] if len(outputs) > 1 else None
+  return change[1] is not None and change[0] == refexp_obj
 
-    # Otherwise fetch the next node from the template
-    # Make a shallow copy so cached _outputs don't leak ... this is very nasty
-    next_node = template['nodes'][state['next_template_node']]
-    next_node = node_shallow_copy(next_node)
 
-    special_nodes = {
-        'filter_unique', 'filter_count', 'filter_exist', 'filter',
-        'relate_filter', 'relate_filter_unique', 'relate_filter_count',
-        'relate_filter_exist',
-    }
-    if next_node['type'] in special_nodes:
-      if next_node['type'].startswith('relate_filter'):
-        unique = (next_node['type'] == 'relate_filter_unique')
-        include_zero = (next_node['type'] == 'relate_filter_count'
-                        or next_node['type'] == 'relate_filter_exist')
-        filter_options = find_relate_filter_options(answer, scene_struct, metadata,
-                            unique=unique, include_zero=include_zero)
+def passes_rejection_sampling(state, outputs, template, metadata, scene_struct,
+                              answer_counts, verbose=False):
+  """
+  Use our rejection sampling heuristics to decide whether we should keep a
+  complete, valid template instantiation.
+  """
+  answer = outputs[-1]
+  cur_answer_count = answer_counts[answer]
+  answer_counts_sorted = sorted(answer_counts.values())
+  median_count = answer_counts_sorted[len(answer_counts_sorted) // 2]
+  median_count = max(median_count, 5)
+  if cur_answer_count > 1.1 * answer_counts_sorted[-2]:
+    if verbose: print('skipping due to second count')
+    return False
+  if cur_answer_count > 5.0 * median_count:
+    if verbose: print('skipping due to median')
+    return False
+
+  # If the template contains a raw relate node then we need to check for
+  # degeneracy at the end
+  has_relate = any(n['type'] == 'relate' for n in template['nodes'])
+  if has_relate:
+    q = {'nodes': state['nodes']}
+    degen = qeng.is_degenerate(q, metadata, scene_struct, answer=answer,
+                               verbose=verbose)
+    if degen:
+      return False
+  return True
+
+
+def accept_state(state, outputs, answer_counts, change):
+  answer = outputs[-1]
+  refexp_obj = outputs[-2]
+  shared_counts.increment(answer_counts, answer)
+  state['answer'] = answer
+  assert isinstance(refexp_obj, int)
+  state['refexp_obj'] = refexp_obj
+  state['changed_idx'], state['change_type'] = change[:2]
+  state['change_from'], state['change_to'] = change[2:]
+
+
+# Template nodes that expand_state instantiates as a chain of filter nodes
+SPECIAL_NODES = {
+  'filter_unique', 'filter_count', 'filter_exist', 'filter',
+  'relate_filter', 'relate_filter_unique', 'relate_filter_count',
+  'relate_filter_exist',
+}
+
+
+def expand_state(state, outputs, template, metadata, scene_struct,
+                 param_name_to_type, prune=None):
+  """
+  Expand a valid, incomplete search state by instantiating the next node from
+  the template, returning a list of child states. Children are returned in no
+  particular order; search procedures should shuffle them as needed.
+
+  If given, prune(state, outputs, next_node, option, objs) is called before
+  each child is created and the child is skipped if it returns False; option
+  is a filter option key and objs the matching objects for special nodes, and
+  option is the parameter value and objs is None for other nodes.
+  """
+  answer = outputs[-1]
+  children = []
+
+  # Fetch the next node from the template
+  # Make a shallow copy so cached _outputs don't leak ... this is very nasty
+  next_node = template['nodes'][state['next_template_node']]
+  next_node = node_shallow_copy(next_node)
+
+  if next_node['type'] in SPECIAL_NODES:
+    if next_node['type'].startswith('relate_filter'):
+      unique = (next_node['type'] == 'relate_filter_unique')
+      include_zero = (next_node['type'] == 'relate_filter_count'
+                      or next_node['type'] == 'relate_filter_exist')
+      filter_options = find_relate_filter_options(answer, scene_struct, metadata,
+                          unique=unique, include_zero=include_zero)
+    else:
+      filter_options = find_filter_options(answer, scene_struct, metadata)
+      if next_node['type'] == 'filter':
+        # Remove null filter
+        filter_options.pop((None, None, None, None), None)
+      if next_node['type'] == 'filter_unique':
+        # Get rid of all filter options that don't result in a single object
+        filter_options = {k: v for k, v in filter_options.items()
+                          if len(v) == 1}
       else:
-        filter_options = find_filter_options(answer, scene_struct, metadata)
-        if next_node['type'] == 'filter':
-          # Remove null filter
-          filter_options.pop((None, None, None, None), None)
-        if next_node['type'] == 'filter_unique':
-          # Get rid of all filter options that don't result in a single object
-          filter_options = {k: v for k, v in filter_options.items()
-                            if len(v) == 1}
-        else:
-          # Add some filter options that do NOT correspond to the scene
-          if next_node['type'] == 'filter_exist':
-            # For filter_exist we want an equal number that do and don't
-            num_to_add = len(filter_options)
-          elif next_node['type'] == 'filter_count' or next_node['type'] == 'filter':
-            # For filter_count add nulls equal to the number of singletons
-            num_to_add = sum(1 for k, v in filter_options.items() if len(v) == 1)
-          add_empty_filter_options(filter_options, metadata, num_to_add)
-
-      filter_option_keys = list(filter_options.keys())
-      random.shuffle(filter_option_keys)
-      for k in filter_option_keys:
-        new_nodes = []
-        cur_next_vals = {k: v for k, v in state['vals'].items()}
-        next_input = state['input_map'][next_node['inputs'][0]]
-        filter_side_inputs = next_node['side_inputs']
-        if next_node['type'].startswith('relate'):
-          param_name = next_node['side_inputs'][0] # First one should be relate
-          filter_side_inputs = next_node['side_inputs'][1:]
-          param_type = param_name_to_type[param_name]
-          assert param_type == 'Relation'
-          param_val = k[0]
-          k = k[1]
+        # Add some filter options that do NOT correspond to the scene
+        if next_node['type'] == 'filter_exist':
+          # For filter_exist we want an equal number that do and don't
+          num_to_add = len(filter_options)
+        elif next_node['type'] == 'filter_count' or next_node['type'] == 'filter':
+          # For filter_count add nulls equal to the number of singletons
+          num_to_add = sum(1 for k, v in filter_options.items() if len(v) == 1)
+        add_empty_filter_options(filter_options, metadata, num_to_add)
+
+    for k, objs in filter_options.items():
+      k = tuple(k)
+      if prune is not None and not prune(state, outputs, next_node, k, objs):
+        continue
+      new_nodes = []
+      cur_next_vals = {k: v for k, v in state['vals'].items()}
+      next_input = state['input_map'][next_node['inputs'][0]]
+      filter_side_inputs = next_node['side_inputs']
+      if next_node['type'].startswith('relate'):
+        param_name = next_node['side_inputs'][0] # First one should be relate
+        filter_side_inputs = next_node['side_inputs'][1:]
+        param_type = param_name_to_type[param_name]
+        assert param_type == 'Relation'
+        param_val = k[0]
+        k = k[1]
+        new_nodes.append({
+          'type': 'relate',
+          'inputs': [next_input],
+          'side_inputs': [param_val],
+        })
+        cur_next_vals[param_name] = param_val
+        next_input = len(state['nodes']) + len(new_nodes) - 1
+      for param_name, param_val in zip(filter_side_inputs, k):
+        param_type = param_name_to_type[param_name]
+        filter_type = 'filter_%s' % param_type.lower()
+        if param_val is not None:
           new_nodes.append({
-            'type': 'relate',
+            'type': filter_type,
             'inputs': [next_input],
             'side_inputs': [param_val],
           })
           cur_next_vals[param_name] = param_val
           next_input = len(state['nodes']) + len(new_nodes) - 1
-        for param_name, param_val in zip(filter_side_inputs, k):
-          param_type = param_name_to_type[param_name]
-          filter_type = 'filter_%s' % param_type.lower()
-          if param_val is not None:
-            new_nodes.append({
-              'type': filter_type,
-              'inputs': [next_input],
-              'side_inputs': [param_val],
-            })
-            cur_next_vals[param_name] = param_val
-            next_input = len(state['nodes']) + len(new_nodes) - 1
-          elif param_val is None:
-            if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
-              param_val = 'thing'
-            else:
-              param_val = ''
-            cur_next_vals[param_name] = param_val
-        input_map = {k: v for k, v in state['input_map'].items()}
-        extra_type = None
-        if next_node['type'].endswith('unique'):
-          extra_type = 'unique'
-        if next_node['type'].endswith('count'):
-          extra_type = 'count'
-        if next_node['type'].endswith('exist'):
-          extra_type = 'exist'
-        if extra_type is not None:
-          new_nodes.append({
-            'type': extra_type,
-            'inputs': [input_map[next_node['inputs'][0]] + len(new_nodes)],
-          })
-        input_map[state['next_template_node']] = len(state['nodes']) + len(new_nodes) - 1
-        states.append({
-          'nodes': state['nodes'] + new_nodes,
-          'vals': cur_next_vals,
-          'input_map': input_map,
-          'next_template_node': state['next_template_node'] + 1,
+        elif param_val is None:
+          if metadata['dataset'] == 'CLEVR-v1.0' and param_type == 'Shape':
+            param_val = 'thing'
+          else:
+            param_val = ''
+          cur_next_vals[param_name] = param_val
+      input_map = {k: v for k, v in state['input_map'].items()}
+      extra_type = None
+      if next_node['type'].endswith('unique'):
+        extra_type = 'unique'
+      if next_node['type'].endswith('count'):
+        extra_type = 'count'
+      if next_node['type'].endswith('exist'):
+        extra_type = 'exist'
+      if extra_type is not None:
+        new_nodes.append({
+          'type': extra_type,
+          'inputs': [input_map[next_node['inputs'][0]] + len(new_nodes)],
         })
+      input_map[state['next_template_node']] = len(state['nodes']) + len(new_nodes) - 1
+      children.append({
+        'nodes': state['nodes'] + new_nodes,
+        'vals': cur_next_vals,
+        'input_map': input_map,
+        'next_template_node': state['next_template_node'] + 1,
+      })
 
-    elif 'side_inputs' in next_node:
-      # If the next node has template parameters, expand them out
-      # TODO: Generalize this to work for nodes with more than one side input
-      assert len(next_node['side_inputs']) == 1, 'NOT IMPLEMENTED'
-
-      # Use metadata to figure out domain of valid values for this parameter.
-      # Iterate over the values in a random order; then it is safe to bail
-      # from the DFS as soon as we find the desired number of valid template
-      # instantiations.
-      param_name = next_node['side_inputs'][0]
-      param_type = param_name_to_type[param_name]
-      param_vals = metadata['types'][param_type][:]
-      random.shuffle(param_vals)
-      for val in param_vals:
-        input_map = {k: v for k, v in state['input_map'].items()}
-        input_map[state['next_template_node']] = len(state['nodes'])
-        cur_next_node = {
-          'type': next_node['type'],
-          'inputs': [input_map[idx] for idx in next_node['inputs']],
-          'side_inputs': [val],
-        }
-        cur_next_vals = {k: v for k, v in state['vals'].items()}
-        cur_next_vals[param_name] = val
-
-        states.append({
-          'nodes': state['nodes'] + [cur_next_node],
-          'vals': cur_next_vals,
-          'input_map': input_map,
-          'next_template_node': state['next_template_node'] + 1,
-        })
-    else:
+  elif 'side_inputs' in next_node:
+    # If the next node has template parameters, expand them out
+    # TODO: Generalize this to work for nodes with more than one side input
+    assert len(next_node['side_inputs']) == 1, 'NOT IMPLEMENTED'
+
+    # Use metadata to figure out domain of valid values for this parameter.
+    param_name = next_node['side_inputs'][0]
+    param_type = param_name_to_type[param_name]
+    for val in metadata['types'][param_type]:
+      if prune is not None and not prune(state, outputs, next_node, val, None):
+        continue
       input_map = {k: v for k, v in state['input_map'].items()}
       input_map[state['next_template_node']] = len(state['nodes'])
-      next_node = {
+      cur_next_node = {
         'type': next_node['type'],
         'inputs': [input_map[idx] for idx in next_node['inputs']],
+        'side_inputs': [val],
       }
-      states.append({
-        'nodes': state['nodes'] + [next_node],
-        'vals': state['vals'],
+      cur_next_vals = {k: v for k, v in state['vals'].items()}
+      cur_next_vals[param_name] = val
+
+      children.append({
+        'nodes': state['nodes'] + [cur_next_node],
+        'vals': cur_next_vals,
         'input_map': input_map,
         'next_template_node': state['next_template_node'] + 1,
       })
+  else:
+    input_map = {k: v for k, v in state['input_map'].items()}
+    input_map[state['next_template_node']] = len(state['nodes'])
+    next_node = {
+      'type': next_node['type'],
+      'inputs': [input_map[idx] for idx in next_node['inputs']],
+    }
+    children.append({
+      'nodes': state['nodes'] + [next_node],
+      'vals': state['vals'],
+      'input_map': input_map,
+      'next_template_node': state['next_template_node'] + 1,
+    })
+
+  return children
+
+
+def initial_search_state(template):
+  return {
+    'nodes': [node_shallow_copy(template['nodes'][0])],
+    'vals': {},
+    'input_map': {0: 0},
+    'next_template_node': 1,
+  }
+
+
+def instantiate_templates_dfs(scene_struct, changed_scene_struct, 
+                              template, metadata, answer_counts,
+                              synonyms, max_instances=None, verbose=False,
+                              prune=None):
+
+  param_name_to_type = {p['name']: p['type'] for p in template['params']}
+  change = find_change(scene_struct, changed_scene_struct)
+
+  states = [initial_search_state(template)]
+  final_states = []
+  while states:
+    state = states.pop()
+
+    # Check to make sure the current state is valid
+    outputs = check_state(state, template, metadata, scene_struct,
+                          param_name_to_type, verbose=verbose)
+    if outputs is None:
+      continue
+
+    # We have already checked to make sure the answer is valid, so if we have
+    # processed all the nodes in the template then the current state is a valid
+    # question, so add it if it refers to the changed object and passes our
+    # rejection sampling tests.
+    if is_complete_state(state, template):
+      if not refers_to_change(outputs, change): continue
+      if not passes_rejection_sampling(state, outputs, template, metadata,
+                                       scene_struct, answer_counts,
+                                       verbose=verbose):
+        continue
+      accept_state(state, outputs, answer_counts, change)
+      final_states.append(state)
+      if max_instances is not None and len(final_states) == max_instances:
+        break
+      continue
+
+    # Otherwise expand the next node from the template. Iterate over the
+    # children in a random order; then it is safe to bail from the DFS as soon
+    # as we find the desired number of valid template instantiations.
+    children = expand_state(state, outputs, template, metadata, scene_struct,
+                            param_name_to_type, prune=prune)
+    random.shuffle(children)
+    states.extend(children)
+
+  return realize_final_states(final_states, template, synonyms)
+
+
+class TemplateCSP(object):
+  """
+  Treats the parameters of a template as the variables of a constraint
+  satisfaction problem on a particular scene, so that children which are
+  certain to violate a constraint can be pruned before they are created.
+
+  The domain of each parameter starts out as its values in metadata['types']
+  (plus None, the NULL value, for attributes) and is restricted by NULL
+  constraints and, for parameters of unique filters, by the attribute values
+  that actually occur in the scene. The prune method then checks a candidate
+  assignment against the domains, against NEQ constraints (including forward
+  checking of parameters that are not assigned yet), against OUT_NEQ
+  constraints when the output of the new node can be read off the scene
+  tables, and against the requirement that the caption refers to the changed
+  object.
+
+  Pruning is only ever conservative: every child that survives is still
+  checked by check_state, and depth-first search without pruning remains the
+  reference implementation.
+  """
+  def __init__(self, template, metadata, scene_struct, change=None):
+    self.param_name_to_type = {p['name']: p['type'] for p in template['params']}
+    self.scene_struct = scene_struct
+    self.domains = {}
+    for p in template['params']:
+      domain = set(metadata['types'][p['type']])
+      if p['type'] != 'Relation':
+        domain.add(None)
+      self.domains[p['name']] = domain
+
+    self.neq, self.out_neq = [], []
+    for c in template['constraints']:
+      if c['type'] == 'NULL':
+        self.domains[c['params'][0]] &= {None}
+      elif c['type'] == 'NEQ':
+        self.neq.append(tuple(c['params']))
+      elif c['type'] == 'OUT_NEQ':
+        self.out_neq.append(tuple(c['params']))
+
+    # Objects picked out by unique filters exist in the scene, so their
+    # attribute values must be among those in the scene's filter table.
+    scene_cache = qeng.get_scene_cache(scene_struct)
+    if '_filter_options' not in scene_cache:
+      precompute_filter_options(scene_struct, metadata)
+    scene_values = [set(), set(), set(), set()]
+    for key in scene_cache['_filter_options']:
+      for values, v in zip(scene_values, key):
+        values.add(v)
+    for node in template['nodes']:
+      if node['type'] not in ('filter_unique', 'relate_filter_unique'):
+        continue
+      filter_params = node['side_inputs']
+      if node['type'].startswith('relate'):
+        filter_params = filter_params[1:]
+      for name, values in zip(filter_params, scene_values):
+        self.domains[name] &= values
+
+    # Captions must refer to the changed object, which is the output of the
+    # unique node feeding the final query.
+    nodes = template['nodes']
+    self.target_node = None
+    if (change is not None and change[1] is not None and len(nodes) > 1
+        and nodes[-1]['inputs'] == [len(nodes) - 2]
+        and nodes[-2]['type'] in ('filter_unique', 'relate_filter_unique')):
+      self.target_node = len(nodes) - 2
+      self.target = change[0]
+
+  def text_value(self, name, v):
+    if v is not None:
+      return v
+    return 'thing' if self.param_name_to_type[name] == 'Shape' else ''
+
+  def node_output(self, state, outputs, next_node, option, objs):
+    # The output of the new node if we can tell without creating it, or None
+    node_type = next_node['type']
+    if objs is None:
+      if node_type == 'relate':
+        subject = outputs[state['input_map'][next_node['inputs'][0]]]
+        return self.scene_struct['relationships'][option][subject]
+      return None
+    if node_type.endswith('unique'):
+      return objs[0] if len(objs) == 1 else '__INVALID__'
+    if len(objs) == 0:
+      # Options added by add_empty_filter_options do not record their objects
+      return None
+    if node_type.endswith('count'):
+      return len(objs)
+    if node_type.endswith('exist'):
+      return True
+    return objs
+
+  def prune(self, state, outputs, next_node, option, objs):
+    """
+    Return False if instantiating next_node with option cannot lead to a
+    valid instantiation; see expand_state.
+    """
+    if objs is None:
+      assignment = {next_node['side_inputs'][0]: option}
+    else:
+      values = option
+      if next_node['type'].startswith('relate'):
+        values = (option[0],) + tuple(option[1])
+      assignment = dict(zip(next_node['side_inputs'], values))
+
+    for name, v in assignment.items():
+      if v not in self.domains[name]:
+        return False
+
+    for p1, p2 in self.neq:
+      for a, b in [(p1, p2), (p2, p1)]:
+        if a not in assignment:
+          continue
+        va = self.text_value(a, assignment[a])
+        if b in assignment:
+          vb = self.text_value(b, assignment[b])
+        elif b in state['vals']:
+          vb = state['vals'][b]
+        else:
+          # Forward checking: b must still be able to agree with a
+          if va not in {self.text_value(b, x) for x in self.domains[b]}:
+            return False
+          continue
+        if va != vb:
+          return False
+
+    k = state['next_template_node']
+    if not self.out_neq and k != self.target_node:
+      return True
+    output = self.node_output(state, outputs, next_node, option, objs)
+    if output is None:
+      return True
+    for i, j in self.out_neq:
+      for a, b in [(i, j), (j, i)]:
+        if a == k and b in state['input_map']:
+          if output == outputs[state['input_map'][b]]:
+            return False
+    if k == self.target_node and output != self.target:
+      return False
+    return True
+
+
+def instantiate_templates_csp(scene_struct, changed_scene_struct,
+                              template, metadata, answer_counts,
+                              synonyms, max_instances=None, verbose=False):
+  """
+  Depth-first search over template instantiations that propagates the
+  template constraints (see TemplateCSP) before creating each child state,
+  rather than only checking them after states are popped.
+  """
+  change = find_change(scene_struct, changed_scene_struct)
+  csp = TemplateCSP(template, metadata, scene_struct, change=change)
+  return instantiate_templates_dfs(scene_struct, changed_scene_struct,
+                                   template, metadata, answer_counts,
+                                   synonyms, max_instances=max_instances,
+                                   verbose=verbose, prune=csp.prune)
 
+
+class CountBudgetExceeded(Exception):
+  pass
+
+
+# Constraint types whose effect on the completions of a state is captured by
+# the key of make_state_key_fn
+COUNTABLE_CONSTRAINTS = {'NEQ', 'NULL', 'OUT_NEQ'}
+
+
+def is_countable_template(template):
+  """
+  Whether instantiate_templates_sampling can count the solutions of a template;
+  otherwise we fall back to depth-first search. Besides constraints of unknown
+  types, the counter cannot handle raw relate nodes, since instantiations with
+  them are only checked for degeneracy after they are sampled (see
+  passes_rejection_sampling), nor parameterized nodes with more than one side
+  input other than the filter nodes expanded by expand_state.
+  """
+  if any(c['type'] not in COUNTABLE_CONSTRAINTS
+         for c in template['constraints']):
+    return False
+  for node in template['nodes']:
+    if node['type'] == 'relate':
+      return False
+    if (node['type'] not in SPECIAL_NODES
+        and len(node.get('side_inputs', [])) > 1):
+      return False
+  return True
+
+
+def make_state_key_fn(template):
+  """
+  Build a function mapping a valid search state (and its node outputs) to a
+  key such that states with equal keys have the same number of valid
+  completions. The completions of a state only depend on the next template
+  node, on the outputs of template nodes that are still used as inputs by
+  later nodes or by OUT_NEQ constraints, and on the values of parameters
+  appearing in NEQ constraints.
+  """
+  nodes = template['nodes']
+  referenced_after = []
+  for k in range(len(nodes) + 1):
+    referenced = set()
+    for node in nodes[k:]:
+      referenced.update(node['inputs'])
+    for c in template['constraints']:
+      if c['type'] == 'OUT_NEQ':
+        referenced.update(c['params'])
+    referenced_after.append(sorted(i for i in referenced if i < k))
+  neq_params = sorted(set(p for c in template['constraints']
+                          if c['type'] == 'NEQ' for p in c['params']))
+
+  def freeze(x):
+    return tuple(x) if isinstance(x, list) else x
+
+  def state_key(state, outputs):
+    k = state['next_template_node']
+    out_key = tuple(freeze(outputs[state['input_map'][i]])
+                    for i in referenced_after[k])
+    val_key = tuple(state['vals'].get(p) for p in neq_params)
+    # Special template nodes are expanded using the output of the last node
+    return (k, freeze(outputs[-1]), out_key, val_key)
+  return state_key
+
+
+def weighted_choice(items, weights):
+  total = sum(weights)
+  r = random.uniform(0, total)
+  cum = 0
+  for item, w in zip(items, weights):
+    cum += w
+    if w > 0 and r <= cum:
+      return item
+  return [item for item, w in zip(items, weights) if w > 0][-1]
+
+
+def instantiate_templates_sampling(scene_struct, changed_scene_struct,
+                                   template, metadata, answer_counts,
+                                   synonyms, max_instances=None, verbose=False,
+                                   max_count_states=10000, max_samples=None):
+  """
+  Instantiate a template by sampling rather than exhaustive search. We first
+  count the number of valid completions below each search state, memoizing
+  counts by a key that summarizes everything the rest of the search depends on
+  (see make_state_key_fn); this is cheap since the key only depends on the
+  outputs of a few nodes. We then walk down from the root, choosing each child
+  with probability proportional to its count, which samples valid
+  instantiations close to uniformly instead of favoring whichever branch a DFS
+  happens to try first.
+
+  Since filter options are partly random, counts for states that share a key
+  are estimates and a walk may occasionally dead-end; walks that dead-end or
+  fail rejection sampling are retried up to max_samples times in total. If
+  counting expands more than max_count_states states we stop counting and
+  find the remaining instances with DFS, as we do for templates that we do not
+  know how to count (see is_countable_template).
+  """
+  if not is_countable_template(template):
+    if verbose:
+      print('cannot count template; falling back to DFS')
+    return instantiate_templates_dfs(scene_struct, changed_scene_struct,
+                                     template, metadata, answer_counts,
+                                     synonyms, max_instances=max_instances,
+                                     verbose=verbose)
+
+  param_name_to_type = {p['name']: p['type'] for p in template['params']}
+  change = find_change(scene_struct, changed_scene_struct)
+  state_key = make_state_key_fn(template)
+  counts = {}
+  num_expanded = [0]
+
+  def count(state):
+    # Returns (number of valid completions, node outputs) for a state
+    outputs = check_state(state, template, metadata, scene_struct,
+                          param_name_to_type)
+    if outputs is None:
+      return 0, None
+    if is_complete_state(state, template):
+      return int(refers_to_change(outputs, change)), outputs
+    key = state_key(state, outputs)
+    if key not in counts:
+      num_expanded[0] += 1
+      if num_expanded[0] > max_count_states:
+        raise CountBudgetExceeded()
+      children = expand_state(state, outputs, template, metadata,
+                              scene_struct, param_name_to_type)
+      counts[key] = sum(count(child)[0] for child in children)
+    return counts[key], outputs
+
+  if max_samples is None:
+    max_samples = 10 * (max_instances or 1)
+  final_states = []
+  seen_vals = set()
+  try:
+    root = initial_search_state(template)
+    num_solutions, root_outputs = count(root)
+    if verbose:
+      print('template has %d solutions (%d states counted)'
+            % (num_solutions, num_expanded[0]))
+    for _ in range(max_samples if num_solutions > 0 else 0):
+      state, outputs = root, root_outputs
+      while outputs is not None and not is_complete_state(state, template):
+        children = expand_state(state, outputs, template, metadata,
+                                scene_struct, param_name_to_type)
+        child_counts = [count(child) for child in children]
+        weights = [c for c, _ in child_counts]
+        if sum(weights) == 0:
+          outputs = None
+          break
+        idx = weighted_choice(list(range(len(children))), weights)
+        state, outputs = children[idx], child_counts[idx][1]
+      if outputs is None or not refers_to_change(outputs, change):
+        if verbose: print('sample dead-ended')
+        continue
+      vals_key = tuple(sorted(state['vals'].items()))
+      if vals_key in seen_vals:
+        continue
+      seen_vals.add(vals_key)
+      if not passes_rejection_sampling(state, outputs, template, metadata,
+                                       scene_struct, answer_counts,
+                                       verbose=verbose):
+        continue
+      accept_state(state, outputs, answer_counts, change)
+      final_states.append(state)
+      if max_instances is not None and len(final_states) == max_instances:
+        break
+  except CountBudgetExceeded:
+    if verbose:
+      print('gave up counting after %d states; falling back to DFS'
+            % max_count_states)
+    sampled = realize_final_states(final_states, template, synonyms)
+    remaining = None
+    if max_instances is not None:
+      remaining = max_instances - len(final_states)
+    found = instantiate_templates_dfs(scene_struct, changed_scene_struct,
+                                      template, metadata, answer_counts,
+                                      synonyms, max_instances=remaining,
+                                      verbose=verbose)
+    return tuple(a + b for a, b in zip(sampled, found))
+
+  return realize_final_states(final_states, template, synonyms)
+
+
+def realize_final_states(final_states, template, synonyms):
   # Actually instantiate the template with the solutions we've found
   text_questions, structured_questions, answers, refexp_objs = [], [], [], []
   for state in final_states:
-    structured_questions.append(state['nodes'])
+    # Nodes are shared with sibling search states, so copy them; main renames
+    # their side_inputs in place.
+    structured_questions.append([dict(n) for n in state['nodes']])
     answers.append(state['answer'])
     refexp_objs.append(state['refexp_obj'])
-    text = random.choice(template['text'])
-    text += ' <CHANGE> <TARGET>'
+    compiled = random.choice(template['_text_compiled']) + CHANGE_TEXT_COMPILED
     state['vals']['<CHANGE>'] = 'change'
     state['vals']['<TARGET>'] = state['change_to']
-    for name, val in state['vals'].items():
-      if val in synonyms:
-        val = random.choice(synonyms[val])
-      text = text.replace(name, val)
-      text = ' '.join(text.split())
-    text = replace_optionals(text)
-    text = ' '.join(text.split())
+    text = realize_text(compiled, state['vals'], synonyms)
     text = other_heuristic(text, state['vals'])
     text_questions.append(text)
 
@@ -565,6 +1025,314 @@ def replace_optionals(s):
   return s
 
 
+TEXT_TOKEN_PATTERN = re.compile(r'(<[A-Z0-9_]+>|\[|\])')
+
+
+def compile_text_template(text):
+  """
+  Compile a text template into a sequence of tokens so that it can be realized
+  without repeated string replacement. Each token is a tuple:
+
+  ('text', s): literal text s
+  ('param', name): a slot filled with the (synonym of the) value of name
+  ('optional', tokens): a compiled subsequence that is kept with probability
+    0.5, as in replace_optionals
+
+  For example "What [is] <C>" compiles to
+
+  [('text', 'What '), ('optional', [('text', 'is')]), ('text', ' '),
+   ('param', '<C>')]
+  """
+  root = []
+  stack = [root]
+  for piece in TEXT_TOKEN_PATTERN.split(text):
+    if piece == '':
+      continue
+    if piece == '[':
+      optional = []
+      stack[-1].append(('optional', optional))
+      stack.append(optional)
+    elif piece == ']' and len(stack) > 1:
+      stack.pop()
+    elif piece.startswith('<'):
+      stack[-1].append(('param', piece))
+    else:
+      stack[-1].append(('text', piece))
+
+  # Brackets that are never closed are not optional; splice their contents
+  # back into the enclosing sequence as literal text.
+  while len(stack) > 1:
+    unclosed = stack.pop()
+    parent = stack[-1]
+    assert parent[-1][0] == 'optional' and parent[-1][1] is unclosed
+    parent[-1] = ('text', '[')
+    parent.extend(unclosed)
+  return root
+
+
+def build_synonym_table(synonyms):
+  """
+  Convert the synonyms JSON into a table mapping each value to a tuple of
+  choices, so that realizing text needs a single lookup per parameter.
+  """
+  return {val: tuple(choices) for val, choices in synonyms.items()}
+
+
+def realize_text(compiled, vals, synonym_table):
+  """
+  Realize a compiled text template (from compile_text_template) with the
+  parameter values in vals. Each parameter gets a single synonym for all of
+  its occurrences; parameters missing from vals are left as-is.
+  """
+  words = {}
+  for name, val in vals.items():
+    choices = synonym_table.get(val)
+    words[name] = random.choice(choices) if choices else val
+
+  pieces = []
+  def emit(tokens):
+    for kind, value in tokens:
+      if kind == 'text':
+        pieces.append(value)
+      elif kind == 'param':
+        pieces.append(words.get(value, value))
+      elif random.random() > 0.5:
+        emit(value)
+  emit(compiled)
+  return ' '.join(''.join(pieces).split())
+
+
+# Every caption ends by describing the change applied to its target object
+CHANGE_TEXT_COMPILED = compile_text_template(' <CHANGE> <TARGET>')
+
+
+def peak_rss_mb():
+  """
+  Peak resident set size of this process in megabytes
+  """
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    # ru_maxrss is in bytes on OSX but kilobytes on Linux
+    rss /= 1024.0
+  return rss / 1024.0
+
+
+def generate_scene_questions(scene_struct, changed_scene_struct, split,
+                             templates, metadata, synonyms, template_counts,
+                             template_answer_counts, args):
+  """
+  Instantiate templates on one scene and return the generated questions,
+  without question_index. The counts are updated as questions are accepted.
+  """
+  scene_fn = scene_struct['image_filename']
+  # Order templates by the number of questions we have so far for those
+  # templates. This is a simple heuristic to give a flat distribution over
+  # templates.
+  templates_items = list(templates.items())
+  templates_items = sorted(templates_items,
+                      key=lambda x: template_counts[x[0][:2]])
+  questions = []
+  num_instantiated = 0
+  for (fn, idx), template in templates_items:
+    if args.verbose:
+      print('trying template ', fn, idx)
+    if args.time_dfs and args.verbose:
+      tic = time.time()
+    if args.instantiation_engine == 'sampling':
+      ts, qs, ans, objs = instantiate_templates_sampling(
+                      scene_struct,
+                      changed_scene_struct,
+                      template,
+                      metadata,
+                      template_answer_counts[(fn, idx)],
+                      synonyms,
+                      max_instances=args.instances_per_template,
+                      max_count_states=args.max_count_states,
+                      verbose=False)
+    elif args.instantiation_engine == 'csp':
+      ts, qs, ans, objs = instantiate_templates_csp(
+                      scene_struct,
+                      changed_scene_struct,
+                      template,
+                      metadata,
+                      template_answer_counts[(fn, idx)],
+                      synonyms,
+                      max_instances=args.instances_per_template,
+                      verbose=False)
+    else:
+      ts, qs, ans, objs = instantiate_templates_dfs(
+                      scene_struct,
+                      changed_scene_struct,
+                      template,
+                      metadata,
+                      template_answer_counts[(fn, idx)],
+                      synonyms,
+                      max_instances=args.instances_per_template,
+                      verbose=False)
+    if args.time_dfs and args.verbose:
+      toc = time.time()
+      print('that took ', toc - tic)
+    image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
+    for t, q, a, o in zip(ts, qs, ans, objs):
+      questions.append({
+        'split': split,
+        'image_filename': scene_fn,
+        'image_index': image_index,
+        'image': os.path.splitext(scene_fn)[0],
+        'question': t,
+        'program': q,
+        'answer': a,
+        'refexp_obj': o,
+        'template_filename': fn,
+        'question_family_index': idx,
+      })
+    if len(ts) > 0:
+      if args.verbose:
+        print('got one!')
+      num_instantiated += 1
+      shared_counts.increment(template_counts, (fn, idx))
+    elif args.verbose:
+      print('did not get any =(')
+    if num_instantiated >= args.templates_per_image:
+      break
+  return questions
+
+
+def load_scene_file(path):
+  """
+  Read scenes from a scene JSON file, or from a binary scene file written by
+  scene_store.py if path ends in .bin; the latter are memory-mapped rather than
+  parsed. Returns (scenes, info).
+  """
+  if path.endswith('.bin'):
+    # numpy is only needed for binary scene files
+    import scene_store
+    store = scene_store.MappedSceneStore(path)
+    return store, store.info
+  with open(path, 'r') as f:
+    scene_data = json.load(f)
+  return scene_data['scenes'], scene_data['info']
+
+
+def make_counts(templates, metadata):
+  """
+  Build freshly reset template and answer counts.
+  """
+  # Maps a template (filename, index) to the number of questions we have
+  # so far using that template
+  template_counts = {}
+  # Maps a template (filename, index) to a dict mapping the answer to the
+  # number of questions so far of that template type with that answer
+  template_answer_counts = {}
+  node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
+  for key, template in templates.items():
+    template_counts[key[:2]] = 0
+    final_node_type = template['nodes'][-1]['type']
+    final_dtype = node_type_to_dtype[final_node_type]
+    answers = metadata['types'][final_dtype]
+    if final_dtype == 'Bool':
+      answers = [True, False]
+    if final_dtype == 'Integer':
+      if metadata['dataset'] == 'CLEVR-v1.0':
+        answers = list(range(0, 11))
+    template_answer_counts[key[:2]] = {}
+    for a in answers:
+      template_answer_counts[key[:2]][a] = 0
+  return template_counts, template_answer_counts
+
+
+# State of a worker process in a multiprocess run; set by init_worker
+_worker = {}
+
+
+def init_worker(scenes_spec, changed_scenes_spec, split, templates, metadata,
+                synonyms, shared_counts_file, args):
+  import scene_store
+  # Forked workers would otherwise all draw the same random numbers
+  random.seed()
+  scenes = scene_store.open_shared_scenes(scenes_spec)
+  changed_scenes = scene_store.open_shared_scenes(changed_scenes_spec)
+  template_counts, template_answer_counts = make_counts(templates, metadata)
+  shared = shared_counts.SharedCounts(shared_counts_file, template_counts,
+                                      template_answer_counts)
+  _worker.update({
+    'scenes': scenes,
+    'changed_scenes': changed_scenes,
+    'split': split,
+    'templates': templates,
+    'metadata': metadata,
+    'synonyms': synonyms,
+    'shared': shared,
+    'args': args,
+  })
+
+
+def run_worker(i):
+  """
+  Generate questions for the i-th scene of the shared scene stores.
+  """
+  w = _worker
+  scene_struct = qeng.SceneContext(w['scenes'][i])
+  changed_scene_struct = w['changed_scenes'][i]
+  print('starting image %s (%d / %d)'
+        % (scene_struct['image_filename'], i + 1, len(w['scenes'])))
+  if w['shared'].start_scene(w['args'].reset_counts_every):
+    print('resetting counts')
+  questions = generate_scene_questions(scene_struct, changed_scene_struct,
+                                       w['split'], w['templates'],
+                                       w['metadata'], w['synonyms'],
+                                       w['shared'].template_counts,
+                                       w['shared'].template_answer_counts,
+                                       w['args'])
+  scene_struct.release()
+  return questions
+
+
+def generate_questions_multiprocess(all_scenes, all_changed_scenes, split,
+                                    templates, metadata, synonyms, args):
+  """
+  Generate questions with args.num_workers worker processes. Scenes are packed
+  once into shared memory (see scene_store) that every worker attaches to, or
+  memory-mapped by every worker when they come from a binary scene file, and
+  template and answer counts are shared through a SharedCounts file so that
+  questions are balanced over all workers.
+  """
+  import multiprocessing, tempfile
+  import scene_store
+  scenes_spec, scenes = scene_store.share_scenes(all_scenes)
+  changed_scenes_spec, changed_scenes = scene_store.share_scenes(
+      all_changed_scenes)
+  num_scenes = len(all_scenes)
+  counts_file = args.shared_counts_file
+  tmp_dir = None
+  if counts_file is None:
+    tmp_dir = tempfile.mkdtemp()
+    counts_file = os.path.join(tmp_dir, 'counts.bin')
+  # Create and initialize the counts file before starting the workers
+  shared = shared_counts.SharedCounts(counts_file,
+                                      *make_counts(templates, metadata))
+  questions = []
+  try:
+    initargs = (scenes_spec, changed_scenes_spec, split, templates, metadata,
+                synonyms, counts_file, args)
+    pool = multiprocessing.Pool(args.num_workers, initializer=init_worker,
+                                initargs=initargs)
+    try:
+      for scene_questions in pool.imap(run_worker, range(num_scenes)):
+        questions.extend(scene_questions)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    shared.close()
+    for store in (scenes, changed_scenes):
+      if store is not None:
+        store.close()
+    if tmp_dir is not None:
+      shutil.rmtree(tmp_dir)
+  return questions
+
+
 def main(args):
   with open(args.metadata_file, 'r') as f:
     metadata = json.load(f)
@@ -589,46 +1357,27 @@ def main(args):
       for i, template in enumerate(json.load(f)):
         num_loaded_templates += 1
         key = (fn, i)
+        template['_text_compiled'] = [compile_text_template(t)
+                                      for t in template['text']]
         templates[key] = template
   print('Read %d templates from disk' % num_loaded_templates)
 
-  def reset_counts():
-    # Maps a template (filename, index) to the number of questions we have
-    # so far using that template
-    template_counts = {}
-    # Maps a template (filename, index) to a dict mapping the answer to the
-    # number of questions so far of that template type with that answer
-    template_answer_counts = {}
-    node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
-    for key, template in templates.items():
-      template_counts[key[:2]] = 0
-      final_node_type = template['nodes'][-1]['type']
-      final_dtype = node_type_to_dtype[final_node_type]
-      answers = metadata['types'][final_dtype]
-      if final_dtype == 'Bool':
-        answers = [True, False]
-      if final_dtype == 'Integer':
-        if metadata['dataset'] == 'CLEVR-v1.0':
-          answers = list(range(0, 11))
-      template_answer_counts[key[:2]] = {}
-      for a in answers:
-        template_answer_counts[key[:2]][a] = 0
-    return template_counts, template_answer_counts
-
-  template_counts, template_answer_counts = reset_counts()
+  template_counts, template_answer_counts = make_counts(templates, metadata)
+  shared = None
+  if args.shared_counts_file is not None:
+    # Keep counts in a file shared by all workers, so that templates and
+    # answers are balanced over all shards rather than within each one
+    shared = shared_counts.SharedCounts(args.shared_counts_file,
+                                        template_counts, template_answer_counts)
+    template_counts = shared.template_counts
+    template_answer_counts = shared.template_answer_counts
 
   # Read file containing input scenes
-  all_scenes = []
-  with open(args.input_scene_file, 'r') as f:
-    scene_data = json.load(f)
-    all_scenes = scene_data['scenes']
-    scene_info = scene_data['info']
+  all_scenes, scene_info = load_scene_file(args.input_scene_file)
 
   # Read file containing changed input scenes
-  with open(args.input_changed_scene_file, 'r') as f:
-    changed_scene_data = json.load(f)
-    all_changed_scenes = changed_scene_data['scenes']
-    changed_scene_info = changed_scene_data['info']
+  all_changed_scenes, changed_scene_info = load_scene_file(
+      args.input_changed_scene_file)
   begin = args.scene_start_idx
   if args.num_scenes > 0:
     end = args.scene_start_idx + args.num_scenes
@@ -640,71 +1389,60 @@ def main(args):
 
   # Read synonyms file
   with open(args.synonyms_json, 'r') as f:
-    synonyms = json.load(f)
+    synonyms = build_synonym_table(json.load(f))
+
+  vocab = None
+  if args.output_format in ['npy', 'both']:
+    # numpy is only needed for encoded output
+    import question_encoding as qenc
+    if args.input_vocab_json is not None:
+      vocab = qenc.load_vocab(args.input_vocab_json)
+      # Fail now rather than after all questions have been generated
+      qenc.check_vocab(vocab, templates)
+    else:
+      vocab = qenc.build_vocab(templates, metadata, synonyms,
+                               extra_compiled=[CHANGE_TEXT_COMPILED])
 
   questions = []
   scene_count = 0
+  if args.num_workers > 1:
+    questions = generate_questions_multiprocess(all_scenes, all_changed_scenes,
+                                                scene_info['split'], templates,
+                                                metadata, synonyms, args)
+    scene_count = len(all_scenes)
+    # Workers have their own copies of the scenes; drop ours
+    del all_scenes[:], all_changed_scenes[:]
   for i, (scene, changed_scene) in enumerate(zip(all_scenes, all_changed_scenes)):
     scene_fn = scene['image_filename']
-    changed_scene_fn = changed_scene['image_filename']
-    scene_struct = scene
+    # Caches derived from the scene live in a per-scene context that is
+    # released once we are done with the scene, so they do not accumulate
+    # in all_scenes over the whole run.
+    scene_struct = qeng.SceneContext(scene)
     changed_scene_struct = changed_scene
     print('starting image %s (%d / %d)'
           % (scene_fn, i + 1, len(all_scenes)))
 
-    if scene_count % args.reset_counts_every == 0:
+    if shared is not None:
+      if shared.start_scene(args.reset_counts_every):
+        print('resetting counts')
+    elif scene_count % args.reset_counts_every == 0:
       print('resetting counts')
-      template_counts, template_answer_counts = reset_counts()
+      template_counts, template_answer_counts = make_counts(templates, metadata)
     scene_count += 1
 
-    # Order templates by the number of questions we have so far for those
-    # templates. This is a simple heuristic to give a flat distribution over
-    # templates.
-    templates_items = list(templates.items())
-    templates_items = sorted(templates_items,
-                        key=lambda x: template_counts[x[0][:2]])
-    num_instantiated = 0
-    for (fn, idx), template in templates_items:
-      if args.verbose:
-        print('trying template ', fn, idx)
-      if args.time_dfs and args.verbose:
-        tic = time.time()
-      ts, qs, ans, objs = instantiate_templates_dfs(
-                      scene_struct,
-                      changed_scene_struct,
-                      template,
-                      metadata,
-                      template_answer_counts[(fn, idx)],
-                      synonyms,
-                      max_instances=args.instances_per_template,
-                      verbose=False)
-      if args.time_dfs and args.verbose:
-        toc = time.time()
-        print('that took ', toc - tic)
-      image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
-      for t, q, a, o in zip(ts, qs, ans, objs):
-        questions.append({
-          'split': scene_info['split'],
-          'image_filename': scene_fn,
-          'image_index': image_index,
-          'image': os.path.splitext(scene_fn)[0],
-          'question': t,
-          'program': q,
-          'answer': a,
-          'refexp_obj': o,
-          'template_filename': fn,
-          'question_family_index': idx,
-          'question_index': len(questions),
-        })
-      if len(ts) > 0:
-        if args.verbose:
-          print('got one!')
-        num_instantiated += 1
-        template_counts[(fn, idx)] += 1
-      elif args.verbose:
-        print('did not get any =(')
-      if num_instantiated >= args.templates_per_image:
-        break
+    questions.extend(generate_scene_questions(
+        scene_struct, changed_scene_struct, scene_info['split'], templates,
+        metadata, synonyms, template_counts, template_answer_counts, args))
+    scene_struct.release()
+    if args.verbose:
+      print('peak RSS: %.1f MB' % peak_rss_mb())
+
+  for i, q in enumerate(questions):
+    q['question_index'] = i
+
+  print('peak RSS after %d scenes: %.1f MB' % (scene_count, peak_rss_mb()))
+  if shared is not None:
+    shared.close()
 
   # Change "side_inputs" to "value_inputs" in all functions of all functional
   # programs. My original name for these was "side_inputs" but I decided to
@@ -726,12 +1464,19 @@ def main(args):
       else:
         f['value_inputs'] = []
 
-  with open(args.output_questions_file, 'w') as f:
-    print('Writing output to %s' % args.output_questions_file)
-    json.dump({
-        'info': scene_info,
-        'questions': questions,
-      }, f)
+  if args.output_format in ['json', 'both']:
+    with open(args.output_questions_file, 'w') as f:
+      print('Writing output to %s' % args.output_questions_file)
+      json.dump({
+          'info': scene_info,
+          'questions': questions,
+        }, f)
+
+  if vocab is not None:
+    arrays = qenc.encode_questions(questions, vocab, verbose=args.verbose)
+    print('Writing encoded output to %s' % args.output_encoded_dir)
+    qenc.write_encoded_questions(args.output_encoded_dir, arrays)
+    qenc.write_vocab(args.output_vocab_json, vocab)
 
 
 if __name__ == '__main__':
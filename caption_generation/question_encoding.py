@@ -0,0 +1,266 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, os
+import numpy as np
+
+"""
+Utilities for writing generated questions in a compact, vocabulary-encoded
+form. Question text and prefix-serialized programs are converted to padded
+arrays of token ids and written as .npy files, one directory per shard, so that
+downstream loaders can memory-map them with np.load(path, mmap_mode='r')
+instead of parsing and re-tokenizing large JSON files.
+
+The vocabulary is built deterministically from the metadata, templates and
+synonyms rather than from the generated questions, so shards generated by
+independent workers all agree on token ids as long as they share the same
+template directory; a previously written vocabulary can also be reused.
+"""
+
+
+SPECIAL_TOKENS = {
+  '<NULL>': 0,
+  '<START>': 1,
+  '<END>': 2,
+  '<UNK>': 3,
+}
+
+
+def tokenize(s, delim=' ', add_start_token=True, add_end_token=True,
+             punct_to_keep=(';', ','), punct_to_remove=('?', '.')):
+  """
+  Tokenize a sequence, converting a string s into a list of (string) tokens by
+  splitting on the specified delimiter. Optionally keep or remove certain
+  punctuation marks and add start and end tokens.
+  """
+  s = s.lower()
+  for p in punct_to_keep:
+    s = s.replace(p, '%s%s' % (delim, p))
+  for p in punct_to_remove:
+    s = s.replace(p, '')
+  tokens = [t for t in s.split(delim) if t]
+  if add_start_token:
+    tokens.insert(0, '<START>')
+  if add_end_token:
+    tokens.append('<END>')
+  return tokens
+
+
+def function_to_token(f):
+  value_inputs = f.get('value_inputs', f.get('side_inputs', []))
+  if len(value_inputs) == 0:
+    return f['type']
+  return '%s[%s]' % (f['type'], ','.join(value_inputs))
+
+
+def program_to_prefix(program):
+  """
+  Serialize a program (a list of functions whose inputs index into the list)
+  in prefix order, starting from the final function.
+  """
+  prefix = []
+  def visit(idx):
+    prefix.append(program[idx])
+    for input_idx in program[idx]['inputs']:
+      visit(input_idx)
+  visit(len(program) - 1)
+  return prefix
+
+
+def _template_words(compiled):
+  # Flatten a compiled text template (see compile_text_template) into a list
+  # of whitespace-separated words where each word is a list of pieces; pieces
+  # are either literal strings or ('param', name) tuples. Optional spans are
+  # inlined since including or dropping them does not create new words.
+  words, word = [], []
+  def visit(tokens):
+    for kind, value in tokens:
+      if kind == 'param':
+        word.append((kind, value))
+      elif kind == 'optional':
+        visit(value)
+      else:
+        parts = value.split(' ')
+        for i, part in enumerate(parts):
+          if i > 0 and word:
+            words.append(list(word))
+            del word[:]
+          if part:
+            word.append(part)
+  visit(compiled)
+  if word:
+    words.append(word)
+  return words
+
+
+def _expand_word(word, fills):
+  # All strings a word can realize to when each param takes any fill value
+  outputs = ['']
+  for piece in word:
+    choices = fills if isinstance(piece, tuple) else [piece]
+    outputs = [o + c for o in outputs for c in choices]
+  return outputs
+
+
+def build_vocab(templates, metadata, synonym_table, extra_compiled=()):
+  """
+  Build question, program and answer vocabularies from the templates
+  (which must have been compiled with compile_text_template), the metadata
+  and the synonym table; extra_compiled gives other compiled text that is
+  appended to every question. Token ids are assigned in sorted order after the
+  special tokens so that the result does not depend on template load order.
+  """
+  values = set(['', 'thing'])
+  for vals in metadata['types'].values():
+    if vals is not None:
+      values.update(vals)
+  values.update(synonym_table.keys())
+  fills = set(values)
+  for v in values:
+    fills.update(synonym_table.get(v, ()))
+  fills = sorted(fills)
+
+  all_compiled = list(extra_compiled)
+  template_filenames = set()
+  for (fn, idx), template in templates.items():
+    template_filenames.add(fn)
+    all_compiled.extend(template['_text_compiled'])
+  question_tokens = set()
+  for compiled in all_compiled:
+    for word in _template_words(compiled):
+      for s in _expand_word(word, fills):
+        question_tokens.update(tokenize(s, add_start_token=False,
+                                        add_end_token=False))
+
+  program_tokens = set()
+  for f in metadata['functions']:
+    if f.get('template_only', False):
+      continue
+    side_input_types = f.get('side_inputs', [])
+    if len(side_input_types) == 0:
+      program_tokens.add(f['name'])
+      continue
+    assert len(side_input_types) == 1, 'NOT IMPLEMENTED'
+    for v in metadata['types'][side_input_types[0]]:
+      program_tokens.add(function_to_token({'type': f['name'],
+                                            'value_inputs': [v]}))
+
+  answer_tokens = set(['True', 'False'] + [str(i) for i in range(11)])
+  for f in metadata['functions']:
+    if f.get('terminal', False):
+      vals = metadata['types'][f['output']]
+      if vals is not None:
+        answer_tokens.update(vals)
+
+  def make_token_to_idx(tokens, special=True):
+    token_to_idx = dict(SPECIAL_TOKENS) if special else {}
+    for token in sorted(tokens):
+      if token not in token_to_idx:
+        token_to_idx[token] = len(token_to_idx)
+    return token_to_idx
+
+  return {
+    'question_token_to_idx': make_token_to_idx(question_tokens),
+    'program_token_to_idx': make_token_to_idx(program_tokens),
+    'answer_token_to_idx': make_token_to_idx(answer_tokens),
+    'template_filename_to_idx': make_token_to_idx(template_filenames,
+                                                  special=False),
+  }
+
+
+def check_vocab(vocab, templates):
+  """
+  Raise a ValueError if a loaded vocabulary has no id for one of the template
+  files, since questions from that file could not be encoded.
+  """
+  missing = sorted(set(fn for fn, idx in templates)
+                   - set(vocab['template_filename_to_idx']))
+  if missing:
+    raise ValueError('Template files missing from the vocabulary: %s; build '
+                     'a new vocabulary from the current template directory'
+                     % ', '.join(missing))
+
+
+def encode(tokens, token_to_idx, unk_counts=None):
+  ids = []
+  for token in tokens:
+    if token not in token_to_idx:
+      if unk_counts is not None:
+        unk_counts[token] = unk_counts.get(token, 0) + 1
+      token = '<UNK>'
+    ids.append(token_to_idx[token])
+  return ids
+
+
+def _pad(seqs, dtype=np.int32):
+  max_len = max([len(s) for s in seqs] + [0])
+  arr = np.full((len(seqs), max_len), SPECIAL_TOKENS['<NULL>'], dtype=dtype)
+  for i, s in enumerate(seqs):
+    arr[i, :len(s)] = s
+  return arr
+
+
+def encode_questions(questions, vocab, verbose=False):
+  """
+  Encode a list of question dicts (as written by generate_questions.py, after
+  side_inputs have been renamed to value_inputs) into a dict of numpy arrays.
+  """
+  unk_counts = {}
+  question_seqs, program_seqs = [], []
+  answers, image_idxs, families, templates, refexp_objs = [], [], [], [], []
+  for q in questions:
+    question_tokens = tokenize(q['question'])
+    question_seqs.append(encode(question_tokens,
+                                vocab['question_token_to_idx'], unk_counts))
+    program_tokens = [function_to_token(f)
+                      for f in program_to_prefix(q['program'])]
+    program_tokens = ['<START>'] + program_tokens + ['<END>']
+    program_seqs.append(encode(program_tokens,
+                               vocab['program_token_to_idx'], unk_counts))
+    answers.append(encode([str(q['answer'])],
+                          vocab['answer_token_to_idx'], unk_counts)[0])
+    image_idxs.append(q['image_index'])
+    families.append(q['question_family_index'])
+    templates.append(vocab['template_filename_to_idx'][q['template_filename']])
+    refexp_objs.append(q.get('refexp_obj', -1))
+
+  if unk_counts:
+    print('WARNING: %d distinct tokens were missing from the vocabulary'
+          % len(unk_counts))
+    if verbose:
+      print(sorted(unk_counts.items(), key=lambda x: -x[1]))
+
+  return {
+    'questions': _pad(question_seqs),
+    'programs': _pad(program_seqs),
+    'answers': np.asarray(answers, dtype=np.int32),
+    'image_idxs': np.asarray(image_idxs, dtype=np.int32),
+    'question_families': np.asarray(families, dtype=np.int32),
+    'template_filenames': np.asarray(templates, dtype=np.int32),
+    'refexp_objs': np.asarray(refexp_objs, dtype=np.int32),
+  }
+
+
+def write_encoded_questions(output_dir, arrays):
+  """
+  Write each encoded array to output_dir/<name>.npy; these can be loaded
+  lazily with np.load(path, mmap_mode='r').
+  """
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  for name, arr in arrays.items():
+    np.save(os.path.join(output_dir, '%s.npy' % name), arr)
+
+
+def load_vocab(path):
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def write_vocab(path, vocab):
+  with open(path, 'w') as f:
+    json.dump(vocab, f, indent=2, sort_keys=True)
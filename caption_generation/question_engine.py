@@ -16,6 +16,89 @@ in a JSON metadata file.
 """
 
 
+class SceneContext(object):
+  """
+  Pairs a scene structure with the caches derived from it while the scene is
+  being processed. A context can be passed anywhere a scene structure is
+  expected, since it exposes the keys of the scene read-only; derived data such
+  as filter options and same-attribute tables is kept in the context's cache
+  rather than in the scene itself, so it is freed with the context (or by
+  calling release) once we are done with the scene instead of staying alive as
+  long as the scene does.
+  """
+  def __init__(self, scene_struct):
+    self.scene = scene_struct
+    self.cache = {}
+
+  def __getitem__(self, key):
+    if key == 'relationships' and self._derives_relationships():
+      if '_relationships' not in self.cache:
+        self.cache['_relationships'] = derive_relationships(self.scene)
+      return self.cache['_relationships']
+    return self.scene[key]
+
+  def __contains__(self, key):
+    if key == 'relationships' and self._derives_relationships():
+      return True
+    return key in self.scene
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def _derives_relationships(self):
+    # Scenes written without relationships have them derived on first use
+    return 'relationships' not in self.scene and \
+           'relationships_spec' in self.scene
+
+  def release(self):
+    self.cache.clear()
+
+
+def get_scene_cache(scene_struct):
+  """
+  Return the dict where data derived from a scene should be cached. For a
+  SceneContext this is its cache; for a bare scene structure we fall back to
+  caching in the scene itself.
+  """
+  if isinstance(scene_struct, SceneContext):
+    return scene_struct.cache
+  return scene_struct
+
+
+# Version of the relationship computation that derive_relationships implements;
+# see compute_all_relationships in image_generation/relationships.py
+RELATIONSHIPS_VERSION = 1
+
+
+def derive_relationships(scene_struct):
+  """
+  Recompute the spatial relationships of a scene that was written with
+  --store_relationships 0, which stores a relationships_spec giving the
+  threshold and version instead of the relationships themselves. The result is
+  identical to what compute_all_relationships would have stored: differences
+  and dot products are evaluated in the same order, in double precision.
+  Requires numpy.
+  """
+  import numpy as np
+  spec = scene_struct['relationships_spec']
+  if spec['version'] != RELATIONSHIPS_VERSION:
+    raise ValueError('Unsupported relationships version %r' % spec['version'])
+  eps = spec['eps']
+  coords = [obj['3d_coords'] for obj in scene_struct['objects']]
+  coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+  # diff[i, j] is the vector from object i to object j
+  diff = coords[None, :, :] - coords[:, None, :]
+  all_relationships = {}
+  for name, direction_vec in scene_struct['directions'].items():
+    if name == 'above' or name == 'below': continue
+    dot = diff[:, :, 0] * direction_vec[0] + diff[:, :, 1] * direction_vec[1]
+    dot = dot + diff[:, :, 2] * direction_vec[2]
+    related = dot > eps
+    np.fill_diagonal(related, False)
+    all_relationships[name] = [np.flatnonzero(row).tolist() for row in related]
+  return all_relationships
+
+
 # Handlers for answering questions. Each handler receives the scene structure
 # that was output from Blender, the node, and a list of values that were output
 # from each of the node's inputs; the handler should return the computed output
@@ -86,7 +169,8 @@ def count_handler(scene_struct, inputs, side_inputs):
 def make_same_attr_handler(attribute):
   def same_attr_handler(scene_struct, inputs, side_inputs):
     cache_key = '_same_%s' % attribute
-    if cache_key not in scene_struct:
+    scene_cache = get_scene_cache(scene_struct)
+    if cache_key not in scene_cache:
       cache = {}
       for i, obj1 in enumerate(scene_struct['objects']):
         same = []
@@ -94,9 +178,9 @@ def make_same_attr_handler(attribute):
           if i != j and obj1[attribute] == obj2[attribute]:
             same.append(j)
         cache[i] = same
-      scene_struct[cache_key] = cache
+      scene_cache[cache_key] = cache
 
-    cache = scene_struct[cache_key]
+    cache = scene_cache[cache_key]
     assert len(inputs) == 1
     assert len(side_inputs) == 0
     return cache[inputs[0]]
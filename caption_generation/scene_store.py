@@ -0,0 +1,465 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import argparse, json, mmap, os, struct
+import numpy as np
+
+import question_engine as qeng
+
+"""
+Columnar storage for scene structures, so that many worker processes can share
+one copy of all scenes instead of each re-parsing the scene JSON or receiving
+pickled scene dicts.
+
+All scenes are packed into a single buffer: a small JSON header (vocabularies,
+per-scene filenames and the layout of the arrays) followed by flat arrays of
+attribute codes, coordinates, direction vectors and relationship bitmasks. The
+buffer can live in shared memory; workers attach to it by name and get numpy
+views of the arrays without copying them.
+
+The same buffer can be written to a file (conventionally next to the scene JSON,
+with a .bin extension) and memory-mapped by MappedSceneStore, which avoids
+parsing the JSON at startup; attribute values are then coded against the
+vocabularies in properties.json. Run this file as a script to convert a scene
+JSON file written by collect_scenes.py or render_images.py.
+
+SceneView exposes one scene of a store with the same keys as a scene structure
+loaded from JSON ('objects', 'relationships', 'directions', 'image_filename',
+...), so it can be passed to question_engine and generate_questions directly.
+"""
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
+    help="JSON file containing ground-truth scene information for all images " +
+         "from render_images.py")
+parser.add_argument('--output_scene_file', default=None,
+    help="Binary scene file to write; defaults to --input_scene_file with " +
+         "a .bin extension")
+parser.add_argument('--properties_json',
+    default='../image_generation/data/properties.json',
+    help="JSON file defining the object properties used when rendering; " +
+         "attribute values are stored as indices into its lists. If the " +
+         "file does not exist, the values found in the scenes are used.")
+
+
+ATTRIBUTES = ['size', 'color', 'material', 'shape']
+VERSION = 1
+ALIGNMENT = 8
+
+
+def _pad(n):
+  return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def properties_vocab(properties):
+  """
+  Attribute vocabularies in the order of a properties.json file.
+  """
+  return {
+    'size': list(properties['sizes'].keys()),
+    'color': list(properties['colors'].keys()),
+    'material': list(properties['materials'].keys()),
+    'shape': list(properties['shapes'].keys()),
+  }
+
+
+def pack_scenes(scenes, info=None, vocab=None):
+  """
+  Convert a list of scene structures into a header dict and a dict of numpy
+  arrays; see write_store for the buffer layout. Attribute values are coded
+  as indices into vocab (see properties_vocab), or into the sorted values
+  found in the scenes if vocab is None.
+  """
+  if vocab is None:
+    vocab = {a: sorted(set(o[a] for s in scenes for o in s['objects']))
+             for a in ATTRIBUTES}
+  for a in ATTRIBUTES:
+    if len(vocab[a]) > 256:
+      raise ValueError('Too many values of "%s" for uint8 codes' % a)
+    missing = set(o[a] for s in scenes for o in s['objects']) - set(vocab[a])
+    if missing:
+      raise ValueError('Values of "%s" missing from vocabulary: %s'
+                       % (a, ', '.join(sorted(missing))))
+  codes = {a: {v: i for i, v in enumerate(vocab[a])} for a in ATTRIBUTES}
+  # Scenes written without relationships are packed with derived ones
+  all_relationships = []
+  for s in scenes:
+    if 'relationships' not in s and 'relationships_spec' in s:
+      all_relationships.append(qeng.derive_relationships(s))
+    else:
+      all_relationships.append(s.get('relationships', {}))
+  relationship_names = sorted(set(r for rels in all_relationships
+                                  for r in rels))
+  direction_names = sorted(set(d for s in scenes
+                               for d in s.get('directions', {})))
+
+  num_objects = [len(s['objects']) for s in scenes]
+  if max(num_objects + [0]) > 32:
+    raise ValueError('Relationship bitmasks support at most 32 objects')
+  object_offsets = np.zeros(len(scenes) + 1, dtype=np.int64)
+  object_offsets[1:] = np.cumsum(num_objects)
+  total = int(object_offsets[-1])
+
+  attributes = np.zeros((total, len(ATTRIBUTES)), dtype=np.uint8)
+  # Coordinates and directions are stored in double precision, like the
+  # floats parsed from the JSON, so that relationships derived from a store
+  # match those derived from the JSON exactly
+  coords = np.zeros((total, 3), dtype=np.float64)
+  rotations = np.zeros(total, dtype=np.float64)
+  pixel_coords = np.zeros((total, 3), dtype=np.float64)
+  relationships = np.zeros((total, len(relationship_names)), dtype=np.uint32)
+  directions = np.zeros((len(scenes), len(direction_names), 3),
+                        dtype=np.float64)
+  scene_info = []
+  for i, s in enumerate(scenes):
+    start = int(object_offsets[i])
+    for j, o in enumerate(s['objects']):
+      attributes[start + j] = [codes[a][o[a]] for a in ATTRIBUTES]
+      coords[start + j] = o['3d_coords']
+      rotations[start + j] = o.get('rotation', 0)
+      pixel_coords[start + j] = o.get('pixel_coords', (0, 0, 0))
+    for r, name in enumerate(relationship_names):
+      for j, related in enumerate(all_relationships[i][name]):
+        mask = 0
+        for k in related:
+          mask |= 1 << k
+        relationships[start + j, r] = mask
+    for d, name in enumerate(direction_names):
+      directions[i, d] = s['directions'][name]
+    scene_info.append({k: s[k] for k in ('split', 'image_index',
+                                         'image_filename') if k in s})
+
+  header = {
+    'version': VERSION,
+    'info': info,
+    'vocab': vocab,
+    'relationships': relationship_names,
+    'directions': direction_names,
+    'scenes': scene_info,
+  }
+  arrays = {
+    'object_offsets': object_offsets,
+    'attributes': attributes,
+    '3d_coords': coords,
+    'rotations': rotations,
+    'pixel_coords': pixel_coords,
+    'relationships': relationships,
+    'directions': directions,
+  }
+  return header, arrays
+
+
+def _layout(header, arrays):
+  # Record the location of each array relative to the start of the array data
+  # in the header; returns the header bytes and the total size of the buffer.
+  header = dict(header)
+  header['arrays'] = {}
+  offset = 0
+  for name in sorted(arrays):
+    arr = arrays[name]
+    header['arrays'][name] = [offset, arr.dtype.str, list(arr.shape)]
+    offset = _pad(offset + arr.nbytes)
+  header_bytes = json.dumps(header).encode('utf-8')
+  return header_bytes, _pad(8 + len(header_bytes)) + offset
+
+
+def store_size(header, arrays):
+  return _layout(header, arrays)[1]
+
+
+def write_store(buf, header, arrays):
+  """
+  Write packed scenes into a writable buffer of at least store_size bytes. The
+  layout is an 8-byte little-endian header length, the JSON header, and then
+  the arrays, starting at the next 8-byte boundary, at the (aligned) offsets
+  recorded in the header.
+  """
+  header_bytes, size = _layout(header, arrays)
+  buf = memoryview(buf)
+  buf[:8] = struct.pack('<Q', len(header_bytes))
+  buf[8:8 + len(header_bytes)] = header_bytes
+  data_start = _pad(8 + len(header_bytes))
+  for name, (offset, dtype, shape) in json.loads(
+      header_bytes.decode('utf-8'))['arrays'].items():
+    out = np.ndarray(shape, dtype=dtype, buffer=buf,
+                     offset=data_start + offset)
+    out[...] = arrays[name]
+
+
+class SceneStore(object):
+  """
+  Read-only access to scenes packed by write_store. The arrays are numpy views
+  of buf, so no data is copied; buf must stay alive as long as the store.
+  """
+  def __init__(self, buf):
+    self._buf = buf
+    header_len = struct.unpack('<Q', bytes(buf[:8]))[0]
+    header = json.loads(bytes(buf[8:8 + header_len]).decode('utf-8'))
+    if header['version'] != VERSION:
+      raise ValueError('Unsupported scene store version %r'
+                       % header['version'])
+    self.header = header
+    self.info = header['info']
+    self.vocab = header['vocab']
+    self.relationship_names = header['relationships']
+    self.direction_names = header['directions']
+    self.arrays = {}
+    data_start = _pad(8 + header_len)
+    for name, (offset, dtype, shape) in header['arrays'].items():
+      self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buf,
+                                     offset=data_start + offset)
+
+  def __len__(self):
+    return len(self.header['scenes'])
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return [SceneView(self, i) for i in range(*idx.indices(len(self)))]
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError('scene index out of range')
+    return SceneView(self, idx)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield SceneView(self, i)
+
+  def release(self):
+    # Drop the views so that the underlying buffer can be closed
+    self.arrays = {}
+    self._buf = None
+
+
+class SharedSceneStore(SceneStore):
+  """
+  A SceneStore whose buffer is a multiprocessing.shared_memory block. The
+  process that loads the scenes calls create, and workers call attach with
+  the name of the block.
+  """
+  def __init__(self, shm, owner=False):
+    self.shm = shm
+    self.name = shm.name
+    self._owner = owner
+    super(SharedSceneStore, self).__init__(shm.buf)
+
+  @classmethod
+  def create(cls, scenes, info=None):
+    from multiprocessing import shared_memory
+    header, arrays = pack_scenes(scenes, info=info)
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=store_size(header, arrays))
+    write_store(shm.buf, header, arrays)
+    return cls(shm, owner=True)
+
+  @classmethod
+  def attach(cls, name):
+    from multiprocessing import shared_memory
+    try:
+      shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+      # Before Python 3.13 attaching always registers the block with the
+      # resource tracker; this is harmless for pool workers, which share the
+      # tracker of the process that created the block.
+      shm = shared_memory.SharedMemory(name=name)
+    return cls(shm)
+
+  def close(self):
+    self.release()
+    self.shm.close()
+    if self._owner:
+      self.shm.unlink()
+
+
+class MappedSceneStore(SceneStore):
+  """
+  A SceneStore read from a file written by write_scene_file. The file is
+  memory-mapped read-only, so scenes are only paged in as they are used and
+  processes reading the same file share its pages.
+  """
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    super(MappedSceneStore, self).__init__(self._mmap)
+
+  def close(self):
+    self.release()
+    self._mmap.close()
+
+
+def write_scene_file(path, scenes, info=None, vocab=None):
+  header, arrays = pack_scenes(scenes, info=info, vocab=vocab)
+  buf = bytearray(store_size(header, arrays))
+  write_store(buf, header, arrays)
+  with open(path, 'wb') as f:
+    f.write(buf)
+
+
+def share_scenes(scenes):
+  """
+  Make a list of scenes available to worker processes. Consecutive scenes of
+  a MappedSceneStore are shared through its file; anything else is packed
+  into shared memory. Returns a spec to pass to open_shared_scenes in the
+  workers, and a SharedSceneStore that the caller must close when the
+  workers are done (or None).
+  """
+  if scenes and isinstance(scenes[0], SceneView):
+    store, offset = scenes[0].store, scenes[0].idx
+    consecutive = all(s.store is store and s.idx == offset + i
+                      for i, s in enumerate(scenes))
+    if isinstance(store, MappedSceneStore) and consecutive:
+      return ('file', store.path, offset, len(scenes)), None
+  shared = SharedSceneStore.create(scenes)
+  return ('shm', shared.name, 0, len(scenes)), shared
+
+
+def open_shared_scenes(spec):
+  """
+  Open scenes shared by share_scenes; returns a list of SceneViews.
+  """
+  kind, name, offset, num_scenes = spec
+  if kind == 'file':
+    store = MappedSceneStore(name)
+  else:
+    store = SharedSceneStore.attach(name)
+  return store[offset:offset + num_scenes]
+
+
+class SceneView(object):
+  """
+  One scene of a SceneStore, indexable like a scene structure. Objects and
+  relationships are decoded lazily from the store's arrays.
+  """
+  def __init__(self, store, idx):
+    self.store = store
+    self.idx = idx
+    offsets = store.arrays['object_offsets']
+    self.start, self.end = int(offsets[idx]), int(offsets[idx + 1])
+    self._fields = store.header['scenes'][idx]
+    # Keys set on the view, e.g. caches added by question_engine
+    self._extra = {}
+    self._objects = None
+    self._relationships = None
+
+  def _get_objects(self):
+    if self._objects is None:
+      rows = self.store.arrays['attributes'][self.start:self.end].tolist()
+      self._objects = [ObjectView(self, i, row) for i, row in enumerate(rows)]
+    return self._objects
+
+  def _get_relationships(self):
+    if self._relationships is None:
+      masks = self.store.arrays['relationships'][self.start:self.end]
+      n = self.end - self.start
+      relationships = {}
+      for r, name in enumerate(self.store.relationship_names):
+        relationships[name] = [[j for j in range(n) if (mask >> j) & 1]
+                               for mask in masks[:, r].tolist()]
+      self._relationships = relationships
+    return self._relationships
+
+  def _get_directions(self):
+    directions = self.store.arrays['directions'][self.idx]
+    return {name: tuple(directions[d].tolist())
+            for d, name in enumerate(self.store.direction_names)}
+
+  def __getitem__(self, key):
+    if key == 'objects':
+      return self._get_objects()
+    elif key == 'relationships':
+      return self._get_relationships()
+    elif key == 'directions':
+      return self._get_directions()
+    elif key in self._extra:
+      return self._extra[key]
+    return self._fields[key]
+
+  def __setitem__(self, key, value):
+    self._extra[key] = value
+
+  def __contains__(self, key):
+    return key in ('objects', 'relationships', 'directions') or \
+           key in self._fields or key in self._extra
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def keys(self):
+    return list(self._fields.keys()) + ['objects', 'directions',
+                                        'relationships']
+
+  def to_dict(self):
+    """
+    Convert back to a plain scene structure, e.g. for writing as JSON.
+    """
+    scene = dict(self._fields)
+    scene['objects'] = [o.to_dict() for o in self['objects']]
+    scene['directions'] = self['directions']
+    scene['relationships'] = self['relationships']
+    return scene
+
+
+class ObjectView(object):
+  """
+  One object of a SceneView, indexable like an object dict.
+  """
+  KEYS = ATTRIBUTES + ['3d_coords', 'rotation', 'pixel_coords']
+
+  def __init__(self, scene, idx, codes):
+    self._scene = scene
+    self._idx = scene.start + idx
+    self._values = {a: scene.store.vocab[a][c]
+                    for a, c in zip(ATTRIBUTES, codes)}
+
+  def __getitem__(self, key):
+    if key in self._values:
+      return self._values[key]
+    arrays = self._scene.store.arrays
+    if key == '3d_coords':
+      return arrays['3d_coords'][self._idx].tolist()
+    elif key == 'rotation':
+      return float(arrays['rotations'][self._idx])
+    elif key == 'pixel_coords':
+      return arrays['pixel_coords'][self._idx].tolist()
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    return key in self.KEYS
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def keys(self):
+    return list(self.KEYS)
+
+  def to_dict(self):
+    return {k: self[k] for k in self.KEYS}
+
+
+def main(args):
+  with open(args.input_scene_file, 'r') as f:
+    scene_data = json.load(f)
+  vocab = None
+  if os.path.isfile(args.properties_json):
+    with open(args.properties_json, 'r') as f:
+      vocab = properties_vocab(json.load(f))
+  output_scene_file = args.output_scene_file
+  if output_scene_file is None:
+    output_scene_file = os.path.splitext(args.input_scene_file)[0] + '.bin'
+  write_scene_file(output_scene_file, scene_data['scenes'],
+                   info=scene_data['info'], vocab=vocab)
+  print('Wrote %d scenes to %s (%d bytes, JSON was %d bytes)'
+        % (len(scene_data['scenes']), output_scene_file,
+           os.path.getsize(output_scene_file),
+           os.path.getsize(args.input_scene_file)))
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
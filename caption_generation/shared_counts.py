@@ -0,0 +1,165 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import fcntl, hashlib, json, mmap, os
+from contextlib import contextmanager
+
+"""
+Template and answer counts shared between generate_questions.py workers.
+
+generate_questions.py balances templates and answers using per-template counts
+(template_counts) and per-template answer counts (template_answer_counts). When
+scenes are split into shards that run as separate processes, each process only
+sees its own counts, so the distribution is flat within each shard but drifts
+over the whole dataset. Instead, all workers on a machine can keep their counts
+in a single file that is memory-mapped by every process; updates are made under
+an exclusive lock on the file so no increments are lost.
+
+The file also records how many scenes have been started across all workers, so
+that counts are reset every reset_counts_every scenes globally rather than per
+worker.
+"""
+
+
+MAGIC = 0x434c4556524354 # 'CLEVRCT'
+HEADER_SIZE = 4 # magic, layout hash, number of scenes started, reserved
+ITEM_SIZE = 8
+
+
+def _layout_hash(keys, answers):
+  layout = [[list(k), [repr(a) for a in answers[k]]] for k in keys]
+  digest = hashlib.sha1(json.dumps(layout).encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+
+
+class CountsView(object):
+  """
+  A dict-like view of some of the counts in a SharedCounts table. Reads are
+  not locked; use increment rather than += to update counts.
+  """
+  def __init__(self, table, offsets):
+    self._table = table
+    self._offsets = offsets
+
+  def __getitem__(self, key):
+    return self._table._values[self._offsets[key]]
+
+  def __setitem__(self, key, value):
+    with self._table.lock():
+      self._table._values[self._offsets[key]] = value
+
+  def __contains__(self, key):
+    return key in self._offsets
+
+  def __iter__(self):
+    return iter(self._offsets)
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def keys(self):
+    return self._offsets.keys()
+
+  def values(self):
+    return [self[k] for k in self._offsets]
+
+  def items(self):
+    return [(k, self[k]) for k in self._offsets]
+
+  def increment(self, key, n=1):
+    with self._table.lock():
+      self._table._values[self._offsets[key]] += n
+
+
+class SharedCounts(object):
+  """
+  Template and answer counts stored in a memory-mapped file. template_counts
+  and template_answer_counts should be the freshly reset dicts built by
+  generate_questions.py; they fix the layout of the file, and every worker
+  sharing a file must use the same templates and metadata. The file is created
+  if it does not exist; delete it to start counting from scratch.
+  """
+  def __init__(self, path, template_counts, template_answer_counts):
+    keys = sorted(template_counts.keys())
+    answers = {k: list(template_answer_counts[k].keys()) for k in keys}
+    layout_hash = _layout_hash(keys, answers)
+
+    template_offsets, answer_offsets = {}, {}
+    offset = HEADER_SIZE
+    for k in keys:
+      template_offsets[k] = offset
+      offset += 1
+    for k in keys:
+      answer_offsets[k] = {}
+      for a in answers[k]:
+        answer_offsets[k][a] = offset
+        offset += 1
+    num_items = offset
+
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(self._fd, fcntl.LOCK_EX)
+    try:
+      size = os.fstat(self._fd).st_size
+      if size == 0:
+        os.ftruncate(self._fd, num_items * ITEM_SIZE)
+      elif size != num_items * ITEM_SIZE:
+        raise ValueError('Shared counts file "%s" has the wrong size; it was '
+                         'created for different templates' % path)
+      self._mmap = mmap.mmap(self._fd, num_items * ITEM_SIZE)
+      self._values = memoryview(self._mmap).cast('q')
+      if size == 0:
+        self._values[0] = MAGIC
+        self._values[1] = layout_hash
+      elif self._values[0] != MAGIC or self._values[1] != layout_hash:
+        raise ValueError('Shared counts file "%s" was created for different '
+                         'templates or metadata' % path)
+    finally:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    self.template_counts = CountsView(self, template_offsets)
+    self.template_answer_counts = {k: CountsView(self, answer_offsets[k])
+                                   for k in keys}
+    self._counts_range = (HEADER_SIZE, num_items)
+
+  @contextmanager
+  def lock(self):
+    fcntl.flock(self._fd, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def start_scene(self, reset_counts_every):
+    """
+    Record that a worker is starting a new scene, resetting all counts if this
+    is a multiple of reset_counts_every scenes over all workers. Returns True
+    if the counts were reset.
+    """
+    with self.lock():
+      scene_count = self._values[2]
+      self._values[2] = scene_count + 1
+      if scene_count % reset_counts_every != 0:
+        return False
+      start, end = self._counts_range
+      for i in range(start, end):
+        self._values[i] = 0
+      return True
+
+  def close(self):
+    self._values.release()
+    self._mmap.close()
+    os.close(self._fd)
+
+
+def increment(counts, key, n=1):
+  """
+  Increment a count in either a plain dict or a CountsView.
+  """
+  if isinstance(counts, CountsView):
+    counts.increment(key, n)
+  else:
+    counts[key] += n
@@ -0,0 +1,61 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, sys
+
+"""
+Check that plan files written by separate runs of plan_scenes.py, for example
+shards with adjacent --start_idx, can be rendered together: no seed is used
+by more than one plan, no image index is planned twice, and no two plans place
+exactly the same objects. Exits with a nonzero status if any check fails:
+
+python plan_scenes.py --camera_json data/camera.json --start_idx 0 \
+  --num_images 20 --output_plan_file ../output/plans_0.jsonl
+python plan_scenes.py --camera_json data/camera.json --start_idx 20 \
+  --num_images 20 --output_plan_file ../output/plans_20.jsonl
+python check_plans.py ../output/plans_0.jsonl ../output/plans_20.jsonl
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input_plan_files', nargs='+',
+    help="JSON lines files of scene plans, as written by plan_scenes.py")
+
+
+def find_duplicates(plans, key):
+  # Map each key to the image indices of the plans sharing it
+  seen = {}
+  for plan in plans:
+    seen.setdefault(key(plan), []).append(plan['image_index'])
+  return [indices for indices in seen.values() if len(indices) > 1]
+
+
+def main(args):
+  plans = []
+  for path in args.input_plan_files:
+    with open(path, 'r') as f:
+      plans.extend(json.loads(line) for line in f if line.strip())
+
+  checks = [
+    ('seed', lambda plan: json.dumps(plan['seed'])),
+    ('image index', lambda plan: plan['image_index']),
+    ('objects', lambda plan: json.dumps(plan['objects'], sort_keys=True)),
+  ]
+  num_failed = 0
+  for name, key in checks:
+    for indices in find_duplicates(plans, key):
+      print('Plans for images %s share the same %s'
+            % (', '.join(str(i) for i in indices), name))
+      num_failed += 1
+  print('Checked %d plans from %d files, %d duplicates'
+        % (len(plans), len(args.input_plan_files), num_failed))
+  return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  sys.exit(main(args))
@@ -0,0 +1,322 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, math
+import numpy as np
+
+"""
+Random object layouts for CLEVR scenes, independent of Blender.
+
+A layout is a list of object specifications giving the position, size,
+rotation, shape, color, and material of each object. Positions are sampled in
+batches of candidates that are checked against all previously placed objects
+at once; the first candidate that is further than min_dist from all other
+objects and further than margin along the four cardinal directions is kept. If
+no candidate in a batch of max_retries works then the layout is started over.
+
+The render scripts sample a layout with sample_layout and only then add the
+objects to the Blender scene.
+"""
+
+
+class PropertyCatalog(object):
+  """
+  The shapes, sizes, colors, and materials defined by a properties file, with
+  lookups in both directions between the names used in scene files and the
+  names of the .blend files, and optional shape / color combinations.
+
+  - color_name_to_rgba: dict mapping color names to RGBA lists in [0, 1]
+  - color_names: sorted list of color names
+  - material_mapping, object_mapping: lists of (file name, name) pairs
+  - size_mapping: list of (size name, scale) pairs
+  - shape_color_combos: list of (shape name, allowed color names) pairs, or
+    None if all combinations are allowed
+  """
+  def __init__(self, properties, shape_color_combos=None):
+    self.color_name_to_rgba = {}
+    for name, rgb in properties['colors'].items():
+      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
+      self.color_name_to_rgba[name] = rgba
+    self.color_names = sorted(self.color_name_to_rgba.keys())
+    self.material_mapping = [(v, k) for k, v in properties['materials'].items()]
+    self.object_mapping = [(v, k) for k, v in properties['shapes'].items()]
+    self.size_mapping = list(properties['sizes'].items())
+    self.material_name_to_file = {v: k for k, v in self.material_mapping}
+    self.material_file_to_name = dict(self.material_mapping)
+    self.shape_name_to_file = {v: k for k, v in self.object_mapping}
+    self.shape_file_to_name = dict(self.object_mapping)
+    self.size_to_scale = dict(self.size_mapping)
+
+    # Cubes are scaled down a bit so that they fit in the same circle
+    self._radii = {}
+    for shape_file, shape in self.object_mapping:
+      for size, r in self.size_mapping:
+        if shape_file == 'Cube':
+          r /= math.sqrt(2)
+        self._radii[shape, size] = r
+
+    self.shape_color_combos = None
+    self.shape_to_colors = None
+    if shape_color_combos is not None:
+      self.shape_color_combos = list(shape_color_combos.items())
+      self.shape_to_colors = dict(self.shape_color_combos)
+
+  def radius(self, shape, size):
+    """ Radius of an object with the given shape and size names """
+    return self._radii[shape, size]
+
+  def rgba(self, color):
+    return self.color_name_to_rgba[color]
+
+  def allowed_colors(self, shape):
+    """ Names of the colors that an object of the given shape may have """
+    if self.shape_to_colors is None:
+      return self.color_names
+    return self.shape_to_colors[shape]
+
+
+_catalog_cache = {}
+
+
+def load_catalog(properties_json, shape_color_combos_json=None):
+  """
+  Load the property file and optional shape / color combinations into a
+  PropertyCatalog; each pair of files is only read once per process.
+  """
+  key = (properties_json, shape_color_combos_json)
+  if key not in _catalog_cache:
+    with open(properties_json, 'r') as f:
+      properties = json.load(f)
+    shape_color_combos = None
+    if shape_color_combos_json is not None:
+      with open(shape_color_combos_json, 'r') as f:
+        shape_color_combos = json.load(f)
+    _catalog_cache[key] = PropertyCatalog(properties, shape_color_combos)
+  return _catalog_cache[key]
+
+
+class LayoutStats(object):
+  """ Counts of sampled candidates and restarted layouts """
+  def __init__(self):
+    self.num_layouts = 0
+    self.num_candidates = 0
+    self.num_restarts = 0
+
+  def summary(self):
+    return ('Sampled %d layouts from %d candidate positions with %d restarts'
+            % (self.num_layouts, self.num_candidates, self.num_restarts))
+
+
+def _choice(rng, seq):
+  return seq[rng.randint(len(seq))]
+
+
+def _choice_shape_color(rng, properties):
+  # Random shape and color, respecting the shape / color combinations if any;
+  # returns the shape file, shape name, and color name
+  if properties.shape_color_combos is None:
+    obj_name, obj_name_out = _choice(rng, properties.object_mapping)
+    color_name = _choice(rng, properties.color_names)
+  else:
+    obj_name_out, color_choices = _choice(rng, properties.shape_color_combos)
+    color_name = _choice(rng, color_choices)
+    obj_name = properties.shape_name_to_file[obj_name_out]
+  return obj_name, obj_name_out, color_name
+
+
+def _first_valid(candidates, r, placed, directions, min_dist, margin):
+  # Index of the first candidate position that is far enough from all placed
+  # objects, or None if there is no such candidate
+  if len(placed) == 0:
+    return 0
+  placed = np.asarray(placed, dtype=np.float64)
+  dx = candidates[:, 0:1] - placed[:, 0]
+  dy = candidates[:, 1:2] - placed[:, 1]
+  dists = np.sqrt(dx * dx + dy * dy)
+  good = np.all(dists - r - placed[:, 2] >= min_dist, axis=1)
+  for direction_vec in directions:
+    m = dx * direction_vec[0] + dy * direction_vec[1]
+    good &= ~np.any((m > 0) & (m < margin), axis=1)
+  valid = np.nonzero(good)[0]
+  if len(valid) == 0:
+    return None
+  return valid[0]
+
+
+def sample_layout(num_objects, properties, directions, min_dist=0.25,
+                  margin=0.4, max_retries=50, rng=None, stats=None,
+                  max_restarts=None):
+  """
+  Sample a random layout of num_objects objects.
+
+  Inputs:
+  - properties: PropertyCatalog returned by load_catalog
+  - directions: the 'directions' dict of a scene structure
+  - min_dist, margin, max_retries: as in the render scripts
+  - rng: numpy RandomState to use; defaults to the global numpy state
+  - stats: optional LayoutStats to update
+  - max_restarts: if not None, raise a RuntimeError after this many restarts
+
+  Returns a list of dicts, one per object, with keys x, y, r (the scale of the
+  object), theta (its rotation), size, shape, shape_file, color, rgba,
+  material, and material_file.
+  """
+  if rng is None:
+    rng = np.random
+  cardinal = []
+  for direction_name in ['left', 'right', 'front', 'behind']:
+    direction_vec = directions[direction_name]
+    assert direction_vec[2] == 0
+    cardinal.append(direction_vec)
+
+  num_restarts = 0
+  while True:
+    placed = []
+    layout = []
+    for i in range(num_objects):
+      # Choose a random size
+      size_name, r = _choice(rng, properties.size_mapping)
+
+      # Try max_retries candidate positions at once
+      candidates = rng.uniform(-3, 3, size=(max_retries, 2))
+      if stats is not None:
+        stats.num_candidates += max_retries
+      idx = _first_valid(candidates, r, placed, cardinal, min_dist, margin)
+      if idx is None:
+        break
+      x, y = candidates[idx]
+
+      # Choose random color and shape
+      obj_name, obj_name_out, color_name = _choice_shape_color(rng, properties)
+
+      # For cube, adjust the size a bit
+      r = properties.radius(obj_name_out, size_name)
+
+      # Choose random orientation and material for the object
+      theta = 360.0 * rng.random_sample()
+      mat_name, mat_name_out = _choice(rng, properties.material_mapping)
+
+      placed.append((x, y, r))
+      layout.append({
+        'x': float(x),
+        'y': float(y),
+        'r': r,
+        'theta': theta,
+        'size': size_name,
+        'shape': obj_name_out,
+        'shape_file': obj_name,
+        'color': color_name,
+        'rgba': properties.rgba(color_name),
+        'material': mat_name_out,
+        'material_file': mat_name,
+      })
+
+    if len(layout) == num_objects:
+      if stats is not None:
+        stats.num_layouts += 1
+      return layout
+
+    # Could not place some object; start over
+    num_restarts += 1
+    if stats is not None:
+      stats.num_restarts += 1
+    if max_restarts is not None and num_restarts > max_restarts:
+      raise RuntimeError('Could not place %d objects after %d restarts'
+                         % (num_objects, max_restarts))
+
+
+def sample_jitter(rng, magnitude):
+  """
+  Sample a random offset in [-magnitude, magnitude] along each axis, as used
+  for the camera and lamp jitter; returns an empty list if magnitude is zero.
+  """
+  if magnitude <= 0:
+    return []
+  return [float(2.0 * magnitude * (rng.random_sample() - 0.5))
+          for _ in range(3)]
+
+
+CHANGE_TYPES = ['same', 'color', 'material', 'drop', 'add']
+
+
+def plan_change(objects, change_type, properties, directions, min_dist=0.25,
+                margin=0.4, max_retries=50, rng=None):
+  """
+  Apply a change of type change_type to a list of scene objects (dicts as
+  stored in scene JSON files) without touching Blender.
+
+  Returns a tuple (new_objects, change) where change is a dict describing the
+  change, or (None, None) if the change could not be made (a new object could
+  not be placed). When shape / color combinations are used, colors are only
+  changed to colors allowed for the shape of the object.
+  """
+  if rng is None:
+    rng = np.random
+  if change_type not in CHANGE_TYPES:
+    raise ValueError('Unknown change type "%s"' % change_type)
+  new_objects = [dict(obj) for obj in objects]
+  change = {'type': change_type}
+  if change_type == 'same':
+    return new_objects, change
+
+  if change_type in ('color', 'material', 'drop'):
+    object_idx = rng.randint(len(objects))
+    change['object_index'] = object_idx
+    obj = new_objects[object_idx]
+  if change_type == 'color':
+    choices = [c for c in properties.allowed_colors(obj['shape'])
+               if c != obj['color']]
+    change['old'] = obj['color']
+    obj['color'] = change['new'] = _choice(rng, choices)
+  elif change_type == 'material':
+    choices = [m for _, m in properties.material_mapping
+               if m != obj['material']]
+    change['old'] = obj['material']
+    obj['material'] = change['new'] = _choice(rng, choices)
+  elif change_type == 'drop':
+    del new_objects[object_idx]
+  elif change_type == 'add':
+    placed = [(obj['3d_coords'][0], obj['3d_coords'][1],
+               properties.radius(obj['shape'], obj['size']))
+              for obj in objects]
+    cardinal = [directions[d] for d in ['left', 'right', 'front', 'behind']]
+    size_name, r = _choice(rng, properties.size_mapping)
+    candidates = rng.uniform(-3, 3, size=(max_retries, 2))
+    idx = _first_valid(candidates, r, placed, cardinal, min_dist, margin)
+    if idx is None:
+      return None, None
+    x, y = candidates[idx]
+    _, obj_name_out, color_name = _choice_shape_color(rng, properties)
+    r = properties.radius(obj_name_out, size_name)
+    new_obj = {
+      'shape': obj_name_out,
+      'size': size_name,
+      'material': _choice(rng, properties.material_mapping)[1],
+      '3d_coords': (float(x), float(y), r),
+      'rotation': 360.0 * rng.random_sample(),
+      'pixel_coords': None,
+      'color': color_name,
+    }
+    new_objects.append(new_obj)
+    change['object'] = new_obj
+  return new_objects, change
+
+
+def layout_to_objects(object_layout):
+  """
+  Convert a layout from sample_layout to a list of objects in the format used
+  by scene JSON files; pixel coordinates are filled in when rendering.
+  """
+  return [{
+    'shape': spec['shape'],
+    'size': spec['size'],
+    'material': spec['material'],
+    '3d_coords': (spec['x'], spec['y'], spec['r']),
+    'rotation': spec['theta'],
+    'pixel_coords': None,
+    'color': spec['color'],
+  } for spec in object_layout]
@@ -0,0 +1,174 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import math
+import numpy as np
+
+"""
+A cheap analytic estimate of object occlusion that does not need Blender.
+
+Every CLEVR object fits in a box with half-size r around (x, y, r), rotated by
+theta around the vertical axis, and contains a sphere of radius r around the
+same point. We project the boxes through the camera to get an upper bound on
+the pixels covered by each object, and remove the pixels covered by the
+projected inner spheres of objects that are entirely in front of it. If what
+is left of some object is smaller than min_pixels_per_object then that object
+cannot pass the render-based visibility check, so the layout can be discarded
+without rendering; otherwise the render-based check still decides.
+
+Camera parameters are plain dicts so they can be computed once in Blender
+(see utils.get_camera_params) and used anywhere:
+
+- world_to_camera: 4x4 matrix (nested lists) from world to camera space
+- frame: [min_x, max_x, min_y, max_y] of the view frame at unit depth
+- width, height: image size in pixels
+"""
+
+
+def project_points(points, camera):
+  """
+  Project an array of world-space points of shape (N, 3) into the image.
+  Returns arrays px, py of pixel coordinates (as in utils.get_camera_coords,
+  but not rounded) and depth giving the distance in front of the camera.
+  """
+  points = np.asarray(points, dtype=np.float64)
+  m = np.asarray(camera['world_to_camera'], dtype=np.float64)
+  co = points.dot(m[:3, :3].T) + m[:3, 3]
+  depth = -co[:, 2]
+  min_x, max_x, min_y, max_y = camera['frame']
+  x = (co[:, 0] / depth - min_x) / (max_x - min_x)
+  y = (co[:, 1] / depth - min_y) / (max_y - min_y)
+  w, h = camera['width'], camera['height']
+  return x * w, h - y * h, depth
+
+
+def move_camera(camera, offset):
+  """
+  Return the parameters of the camera after moving it by offset (a 3-vector
+  in world space) without rotating it, as done by the camera jitter.
+  """
+  m = np.array(camera['world_to_camera'], dtype=np.float64)
+  if len(offset) > 0:
+    m[:3, 3] -= m[:3, :3].dot(np.asarray(offset, dtype=np.float64))
+  moved = dict(camera)
+  moved['world_to_camera'] = m.tolist()
+  return moved
+
+
+def _convex_hull(points):
+  # Andrew's monotone chain; returns hull vertices in counterclockwise order
+  points = sorted(set(map(tuple, points)))
+  if len(points) <= 2:
+    return points
+  def cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+  lower, upper = [], []
+  for p in points:
+    while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+      lower.pop()
+    lower.append(p)
+  for p in reversed(points):
+    while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+      upper.pop()
+    upper.append(p)
+  return lower[:-1] + upper[:-1]
+
+
+def _box_corners(boxes):
+  # The 8 corners of the box around each object, as an array of shape (N*8, 3)
+  boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+  x, y, r, theta = boxes.T
+  c, s = np.cos(theta), np.sin(theta)
+  signs = np.array([(sx, sy, sz) for sx in (-1, 1) for sy in (-1, 1)
+                    for sz in (0, 2)], dtype=np.float64)
+  dx = signs[:, 0] * r[:, None]
+  dy = signs[:, 1] * r[:, None]
+  corners = np.stack([
+    x[:, None] + c[:, None] * dx - s[:, None] * dy,
+    y[:, None] + s[:, None] * dx + c[:, None] * dy,
+    signs[:, 2] * r[:, None],
+  ], axis=2)
+  return corners.reshape(-1, 3)
+
+
+def visible_pixel_bounds(boxes, camera):
+  """
+  Compute an upper bound on the number of visible pixels of each object.
+
+  Inputs:
+  - boxes: list of tuples (x, y, r, theta) giving the position on the ground
+    plane, size, and rotation of each object. theta is the 'rotation' stored
+    in the scene; it is sampled as 360 * random() but is set as the object's
+    rotation_euler, so Blender (and this function) treat it as radians
+  - camera: camera parameters as described above
+
+  Returns a numpy array with one bound per object.
+  """
+  w, h = camera['width'], camera['height']
+  min_x, max_x, min_y, max_y = camera['frame']
+  centers = [(x, y, r) for x, y, r, _ in boxes]
+  cx, cy, cz = project_points(centers, camera)
+  radii = np.array([r for _, _, r, _ in boxes], dtype=np.float64)
+  # Radius of the projected inner sphere; the true projection is slightly
+  # larger than this, so the disc is covered by the object
+  pixels_per_unit = min(w / (max_x - min_x), h / (max_y - min_y))
+  disc_radii = radii * pixels_per_unit / cz
+  near = cz - math.sqrt(3) * radii
+  far_inner = cz + radii
+  px, py, depth = project_points(_box_corners(boxes), camera)
+  px, py, depth = px.reshape(-1, 8), py.reshape(-1, 8), depth.reshape(-1, 8)
+
+  bounds = np.zeros(len(boxes), dtype=np.int64)
+  for i in range(len(boxes)):
+    if np.any(depth[i] <= 0):
+      # Part of the object is behind the camera; don't try to bound it
+      bounds[i] = w * h
+      continue
+    hull = _convex_hull(np.stack([px[i], py[i]], axis=1))
+    x0 = max(int(math.floor(px[i].min())), 0)
+    x1 = min(int(math.ceil(px[i].max())), w)
+    y0 = max(int(math.floor(py[i].min())), 0)
+    y1 = min(int(math.ceil(py[i].max())), h)
+    if x0 >= x1 or y0 >= y1:
+      continue
+    gx = np.arange(x0, x1)[None, :] + 0.5
+    gy = np.arange(y0, y1)[:, None] + 0.5
+    inside = np.ones((y1 - y0, x1 - x0), dtype=bool)
+    for j in range(len(hull)):
+      ax, ay = hull[j]
+      bx, by = hull[(j + 1) % len(hull)]
+      inside &= (bx - ax) * (gy - ay) - (by - ay) * (gx - ax) >= 0
+    for j in np.nonzero(far_inner < near[i])[0]:
+      inside &= (gx - cx[j]) ** 2 + (gy - cy[j]) ** 2 > disc_radii[j] ** 2
+    bounds[i] = int(inside.sum())
+  return bounds
+
+
+def certainly_occluded(boxes, camera, min_pixels_per_object):
+  """
+  Return True if some object certainly has fewer than min_pixels_per_object
+  visible pixels.
+  """
+  bounds = visible_pixel_bounds(boxes, camera)
+  return bool(np.any(bounds < min_pixels_per_object))
+
+
+class PrecheckStats(object):
+  """ Counts how many layouts the occlusion pre-check has rejected """
+  def __init__(self):
+    self.num_checked = 0
+    self.num_rejected = 0
+
+  def record(self, rejected):
+    self.num_checked += 1
+    if rejected:
+      self.num_rejected += 1
+
+  def summary(self):
+    rate = 100.0 * self.num_rejected / max(self.num_checked, 1)
+    return ('Occlusion pre-check rejected %d of %d layouts (%.1f%%)'
+            % (self.num_rejected, self.num_checked, rate))
@@ -0,0 +1,201 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, time
+import numpy as np
+
+import layout, occlusion
+
+"""
+Plans scenes for render_plans.py without running Blender. Each plan fully
+specifies a default scene (objects and camera / lamp jitter) together with a
+nonsemantically changed variant (only the camera moves) and a semantically
+changed variant (the camera moves and one change of --change_type is applied),
+as rendered by the render_sc_images scripts. Scenes whose change cannot be
+made, or where some object is certainly occluded (see occlusion.py), are
+rejected here so that no render time is spent on them.
+
+Plans are written as JSON lines, one scene per line. The camera and the
+directions along the ground plane come from --camera_json, which is written by
+render_plans.py --write_camera_json; run this once per base scene:
+
+blender --background --python render_plans.py -- --write_camera_json data/camera.json
+python plan_scenes.py --camera_json data/camera.json --num_images 10000
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--camera_json', default='data/camera.json',
+    help="JSON file with the camera parameters and directions of the base " +
+         "scene, as written by render_plans.py --write_camera_json")
+parser.add_argument('--properties_json', default='data/properties.json',
+    help="JSON file defining objects, materials, sizes, and colors.")
+parser.add_argument('--shape_color_combos_json', default=None,
+    help="Optional path to a JSON file mapping shape names to a list of " +
+         "allowed color names for that shape. This allows rendering images " +
+         "for CLEVR-CoGenT.")
+parser.add_argument('--output_plan_file', default='../output/CLEVR_plans.jsonl',
+    help="Path to write the scene plans to, one JSON object per line")
+parser.add_argument('--start_idx', default=0, type=int,
+    help="The index at which to start numbering the planned scenes.")
+parser.add_argument('--num_images', default=5, type=int,
+    help="The number of scenes to plan")
+parser.add_argument('--seed', default=0, type=int,
+    help="Base random seed. Each attempt at planning a scene is sampled " +
+         "with the seed [--seed, image index, attempt], which is stored in " +
+         "the plan so that any single scene can be sampled again; scenes " +
+         "planned in separate runs with different --start_idx therefore " +
+         "never share a seed.")
+parser.add_argument('--change_type', default='color',
+    choices=layout.CHANGE_TYPES,
+    help="The change applied to the semantically changed variant")
+
+# Settings for objects
+parser.add_argument('--min_objects', default=3, type=int,
+    help="The minimum number of objects to place in each scene")
+parser.add_argument('--max_objects', default=10, type=int,
+    help="The maximum number of objects to place in each scene")
+parser.add_argument('--min_dist', default=0.25, type=float,
+    help="The minimum allowed distance between object centers")
+parser.add_argument('--margin', default=0.4, type=float,
+    help="Along all cardinal directions (left, right, front, back), all " +
+         "objects will be at least this distance apart.")
+parser.add_argument('--min_pixels_per_object', default=200, type=int,
+    help="Scenes where some object certainly has fewer visible pixels than " +
+         "this are rejected.")
+parser.add_argument('--max_retries', default=50, type=int,
+    help="The number of times to try placing an object before giving up and " +
+         "re-placing all objects in the scene.")
+parser.add_argument('--occlusion_precheck', default=1, type=int,
+    help="Setting --occlusion_precheck 0 disables rejecting scenes where " +
+         "some object is certainly occluded.")
+
+# Camera and lamp jitter
+parser.add_argument('--width', default=320, type=int,
+    help="The width (in pixels) of the images that will be rendered")
+parser.add_argument('--height', default=240, type=int,
+    help="The height (in pixels) of the images that will be rendered")
+parser.add_argument('--key_light_jitter', default=1.0, type=float,
+    help="The magnitude of random jitter to add to the key light position.")
+parser.add_argument('--fill_light_jitter', default=1.0, type=float,
+    help="The magnitude of random jitter to add to the fill light position.")
+parser.add_argument('--back_light_jitter', default=1.0, type=float,
+    help="The magnitude of random jitter to add to the back light position.")
+parser.add_argument('--camera_jitter', default=0.5, type=float,
+    help="The magnitude of random jitter to add to the camera position")
+
+
+def is_occluded(objects, camera, args, stats):
+  if args.occlusion_precheck == 0:
+    return False
+  # Objects are centered at a height equal to their scale
+  boxes = [(obj['3d_coords'][0], obj['3d_coords'][1], obj['3d_coords'][2],
+            obj['rotation']) for obj in objects]
+  occluded = occlusion.certainly_occluded(boxes, camera,
+                                          args.min_pixels_per_object)
+  stats.record(occluded)
+  return occluded
+
+
+def make_rng(seed):
+  """
+  Random state for the seed [base seed, image index, attempt] of a plan. The
+  three numbers are mixed with a SeedSequence, so that nearby seeds give
+  unrelated random streams.
+  """
+  return np.random.RandomState(np.random.SeedSequence(seed).generate_state(8))
+
+
+def plan_scene(image_index, seed, args, properties, camera_info,
+               layout_stats, occlusion_stats):
+  """
+  Plan a single scene; returns None if the sampled scene was rejected.
+  """
+  rng = make_rng(seed)
+  directions = camera_info['directions']
+  camera = dict(camera_info['camera'], width=args.width, height=args.height)
+
+  num_objects = rng.randint(args.min_objects, args.max_objects + 1)
+  camera_jitter = layout.sample_jitter(rng, args.camera_jitter)
+  plan = {
+    'image_index': image_index,
+    'seed': seed,
+    'camera_jitter': camera_jitter,
+    'key_light_jitter': layout.sample_jitter(rng, args.key_light_jitter),
+    'back_light_jitter': layout.sample_jitter(rng, args.back_light_jitter),
+    'fill_light_jitter': layout.sample_jitter(rng, args.fill_light_jitter),
+    'variants': {},
+  }
+  object_layout = layout.sample_layout(num_objects, properties, directions,
+      min_dist=args.min_dist, margin=args.margin,
+      max_retries=args.max_retries, rng=rng, stats=layout_stats)
+  plan['objects'] = layout.layout_to_objects(object_layout)
+  if is_occluded(plan['objects'], occlusion.move_camera(camera, camera_jitter),
+                 args, occlusion_stats):
+    return None
+
+  for name, change_type in [('nonsemantic', 'same'),
+                            ('semantic', args.change_type)]:
+    # Variants keep the lamps but move the camera a bit more
+    variant_jitter = layout.sample_jitter(rng, args.camera_jitter)
+    if variant_jitter:
+      variant_jitter = [a + b for a, b in zip(camera_jitter, variant_jitter)]
+    objects, change = layout.plan_change(plan['objects'], change_type,
+        properties, directions, min_dist=args.min_dist, margin=args.margin,
+        max_retries=args.max_retries, rng=rng)
+    if objects is None:
+      return None
+    if is_occluded(objects, occlusion.move_camera(camera, variant_jitter),
+                   args, occlusion_stats):
+      return None
+    plan['variants'][name] = {
+      'change': change,
+      'camera_jitter': variant_jitter,
+      'objects': objects,
+    }
+  return plan
+
+
+def main(args):
+  with open(args.camera_json, 'r') as f:
+    camera_info = json.load(f)
+  properties = layout.load_catalog(args.properties_json,
+                                   args.shape_color_combos_json)
+  layout_stats = layout.LayoutStats()
+  occlusion_stats = occlusion.PrecheckStats()
+
+  tic = time.time()
+  num_planned, num_rejected, attempt = 0, 0, 0
+  with open(args.output_plan_file, 'w') as f:
+    while num_planned < args.num_images:
+      # Rejected scenes are sampled again with the next attempt number, so
+      # that planned scenes are still numbered consecutively. The seed only
+      # depends on the image index and the attempt, so it never overlaps with
+      # the seeds of scenes planned with another --start_idx.
+      image_index = args.start_idx + num_planned
+      seed = [args.seed, image_index, attempt]
+      plan = plan_scene(image_index, seed, args, properties, camera_info,
+                        layout_stats, occlusion_stats)
+      if plan is None:
+        num_rejected += 1
+        attempt += 1
+        continue
+      f.write(json.dumps(plan) + '\n')
+      num_planned += 1
+      attempt = 0
+  toc = time.time()
+
+  print('Planned %d scenes (%d rejected) in %.2f seconds (%.1f scenes/s)'
+        % (num_planned, num_rejected, toc - tic, num_planned / (toc - tic)))
+  print(layout_stats.summary())
+  if args.occlusion_precheck == 1:
+    print(occlusion_stats.summary())
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
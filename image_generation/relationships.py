@@ -0,0 +1,145 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json
+import numpy as np
+
+"""
+Spatial relationships between the objects of a scene. This only needs numpy,
+so it is used both by the render scripts inside Blender and from plain Python
+to fill in the relationships of scenes that were written with
+--store_relationships 0:
+
+python relationships.py --input_scene_file ../output/CLEVR_scenes.json \
+  --output_scene_file ../output/CLEVR_scenes_with_relationships.json
+
+Directional relationships (left, right, front, behind) are computed for all
+pairs of objects and all directions at once. Further relationships based on the
+distance between objects can be added by passing distance_relations to
+compute_all_relationships; see make_near_relation for an example.
+"""
+
+# Version and threshold of compute_all_relationships, recorded in scenes that
+# are written without relationships
+RELATIONSHIPS_VERSION = 1
+RELATIONSHIPS_EPS = 0.2
+
+
+def _coords(scene_struct):
+  coords = [obj['3d_coords'] for obj in scene_struct['objects']]
+  return np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+
+def _to_lists(related):
+  # Boolean matrix to lists of related object indices, ignoring self-pairs
+  np.fill_diagonal(related, False)
+  return [np.flatnonzero(row).tolist() for row in related]
+
+
+def distance_matrix(coords):
+  """
+  Distances along the ground plane between all pairs of objects, given an
+  array of object coordinates of shape (N, 3).
+  """
+  diff = coords[None, :, :2] - coords[:, None, :2]
+  return np.sqrt((diff * diff).sum(axis=2))
+
+
+def make_near_relation(max_dist):
+  """
+  Make a distance relation under which object j is related to object i if
+  their centers are at most max_dist apart along the ground plane.
+  """
+  def near_relation(dists, scene_struct):
+    return dists <= max_dist
+  return near_relation
+
+
+def compute_all_relationships(scene_struct, eps=RELATIONSHIPS_EPS,
+                              relations=None, distance_relations=None):
+  """
+  Computes relationships between all pairs of objects in the scene.
+
+  Returns a dictionary mapping string relationship names to lists of lists of
+  integers, where output[rel][i] gives a list of object indices that have the
+  relationship rel with object i. For example if j is in output['left'][i] then
+  object j is left of object i.
+
+  - relations: names of the directions of scene_struct['directions'] to
+    compute relationships for; by default all but above and below
+  - distance_relations: optional dict mapping relationship names to functions
+    that receive the matrix of distances between objects (see distance_matrix)
+    and the scene, and return a boolean matrix whose entry (i, j) says whether
+    object j has the relationship with object i
+  """
+  if relations is None:
+    relations = [name for name in scene_struct['directions']
+                 if name != 'above' and name != 'below']
+  coords = _coords(scene_struct)
+  directions = np.array([scene_struct['directions'][name]
+                         for name in relations], dtype=np.float64)
+  directions = directions.reshape(-1, 3)
+
+  # diff[i, j] is the vector from object i to object j, and dots[i, j, k] its
+  # projection onto direction k. The products are summed in the same order as
+  # the original per-pair loop so that results match it exactly at the
+  # threshold.
+  diff = coords[None, :, :] - coords[:, None, :]
+  dots = diff[:, :, 0, None] * directions[:, 0]
+  dots = dots + diff[:, :, 1, None] * directions[:, 1]
+  dots = dots + diff[:, :, 2, None] * directions[:, 2]
+  related = dots > eps
+
+  all_relationships = {}
+  for k, name in enumerate(relations):
+    all_relationships[name] = _to_lists(related[:, :, k].copy())
+  if distance_relations:
+    dists = distance_matrix(coords)
+    for name, relation in distance_relations.items():
+      related = np.array(relation(dists, scene_struct), dtype=bool)
+      all_relationships[name] = _to_lists(related)
+  return all_relationships
+
+
+def add_relationships(scene_struct):
+  """
+  Fill in the relationships of a scene written with --store_relationships 0
+  from its relationships_spec.
+  """
+  spec = scene_struct.pop('relationships_spec')
+  if spec['version'] != RELATIONSHIPS_VERSION:
+    raise ValueError('Unsupported relationships version %r' % spec['version'])
+  scene_struct['relationships'] = compute_all_relationships(scene_struct,
+                                                            eps=spec['eps'])
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', required=True,
+    help="JSON file containing ground-truth scene information for all " +
+         "images, as written by the render scripts")
+parser.add_argument('--output_scene_file', required=True,
+    help="Path to write the scenes with relationships filled in")
+
+
+def main(args):
+  with open(args.input_scene_file, 'r') as f:
+    scenes = json.load(f)
+  num_filled = 0
+  for scene in scenes['scenes']:
+    if 'relationships_spec' in scene:
+      add_relationships(scene)
+      num_filled += 1
+  with open(args.output_scene_file, 'w') as f:
+    json.dump(scenes, f)
+  print('Filled in relationships for %d of %d scenes'
+        % (num_filled, len(scenes['scenes'])))
+
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
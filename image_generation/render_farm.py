@@ -0,0 +1,333 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, os, subprocess, sys, time
+
+"""
+Runs one of the render scripts over a range of image indices on the local
+machine. The range is split into work units of --images_per_unit images, and
+each unit is rendered by its own Blender process; up to --num_workers units
+are rendered at the same time. Arguments after "--" are passed on to the render
+script, with the range of the unit added:
+
+python render_farm.py --script render_sc_images_color.py \
+  --start_idx 14500 --num_images 500 --num_workers 2 --gpus 3 \
+  --manifest ../output_color/farm.json -- --use_gpu 1 --width 480 --height 320
+
+The state of every unit is kept in the --manifest file, so running the same
+command again only renders the units that are not done yet. Units whose
+worker crashed are rendered again, up to --max_attempts times. When a worker
+gives up on some images (exit status 75, see utils.RenderSupervisor), only the
+images listed in its failure manifest are rendered again, as new units
+covering them.
+
+Each worker writes the combined scene files of the render scripts to its own
+files in --log_dir, since workers running at the same time would otherwise
+write the same file; use collect_scenes.py to combine the scenes of each
+output directory once all units are done.
+
+Without --gpus all workers render on the CPU; use --threads_per_worker to
+share the cores between them.
+"""
+
+# Exit status of a render script that gave up on some images; see
+# utils.EXIT_RENDER_FAILED
+EXIT_RENDER_FAILED = 75
+
+# Flags giving the range of indices to render, for scripts that don't use
+# --start_idx and --num_images
+RANGE_FLAGS = {
+  'render_plans.py': ('--start_plan', '--num_plans'),
+}
+
+# Flags giving the combined scene files written by the render scripts, and
+# the suffix of the file each unit writes instead
+SC_SCENE_FILE_FLAGS = [
+  ('--output_scene_file', 'scenes.json'),
+  ('--semantic_output_scene_file', 'sc_scenes.json'),
+  ('--nonsemantic_output_scene_file', 'nsc_scenes.json'),
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--script', default='render_images.py',
+    help="The render script to run")
+parser.add_argument('--blender', default='blender',
+    help="Path to the Blender executable")
+parser.add_argument('--start_idx', default=0, type=int,
+    help="The first index to render")
+parser.add_argument('--num_images', default=10, type=int,
+    help="The number of indices to render")
+parser.add_argument('--images_per_unit', default=10, type=int,
+    help="The number of indices rendered by each Blender process")
+parser.add_argument('--num_workers', default=1, type=int,
+    help="The number of Blender processes to run at the same time")
+parser.add_argument('--threads_per_worker', default=0, type=int,
+    help="The number of render threads of each Blender process; 0 lets " +
+         "Blender use all cores. On CPU-only machines this should be about " +
+         "the number of cores divided by --num_workers.")
+parser.add_argument('--gpus', default='',
+    help="Optional comma-separated list of GPU ids; workers are assigned to " +
+         "them in turn through CUDA_VISIBLE_DEVICES. Leave empty to render " +
+         "on the CPU.")
+parser.add_argument('--max_attempts', default=3, type=int,
+    help="The number of times a unit is run before it is marked as failed")
+parser.add_argument('--manifest', default='../output/render_farm.json',
+    help="JSON file recording the state of every unit")
+parser.add_argument('--log_dir', default=None,
+    help="Directory for the output of each Blender process and its failure " +
+         "manifest; defaults to a directory next to --manifest")
+parser.add_argument('--poll_interval', default=1.0, type=float,
+    help="Seconds between checks for finished workers")
+
+
+def split_argv(argv):
+  """ Split the command line into our arguments and the script arguments """
+  if '--' in argv:
+    idx = argv.index('--')
+    return argv[:idx], argv[(idx + 1):]
+  return argv, []
+
+
+def new_unit(start, count):
+  return {
+    'start': start,
+    'count': count,
+    'status': 'pending',
+    'attempts': 0,
+    'returncode': None,
+    'seconds': None,
+  }
+
+
+def load_manifest(args):
+  """
+  Split the range into units, taking the state of units that are already in
+  the manifest from there, along with the units that were added to render
+  images again. Units that are not done (or split into such units) are
+  pending again, with their attempts reset.
+  """
+  units = []
+  for start in range(args.start_idx, args.start_idx + args.num_images,
+                     args.images_per_unit):
+    count = min(args.images_per_unit, args.start_idx + args.num_images - start)
+    units.append(new_unit(start, count))
+  if os.path.isfile(args.manifest):
+    with open(args.manifest, 'r') as f:
+      previous = json.load(f)['units']
+    by_key = dict(((u['start'], u['count']), u) for u in previous)
+    for i, unit in enumerate(units):
+      units[i] = by_key.get((unit['start'], unit['count']), unit)
+    units.extend(u for u in previous if 'retry_of' in u)
+    for unit in units:
+      if unit['status'] not in ('done', 'split'):
+        unit['status'] = 'pending'
+        unit['attempts'] = 0
+  return units
+
+
+def save_manifest(args, units):
+  # Write to a temporary file first so that the manifest is never left half
+  # written if the scheduler is killed
+  tmp_path = args.manifest + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'script': args.script, 'units': units}, f, indent=2)
+  os.rename(tmp_path, args.manifest)
+
+
+def unit_name(unit):
+  return '%06d_%06d' % (unit['start'], unit['start'] + unit['count'] - 1)
+
+
+def failures_path(args, unit):
+  return os.path.join(args.log_dir, unit_name(unit) + '.failures.jsonl')
+
+
+def failed_indices(args, unit):
+  """
+  Indices of the images a unit gave up on, read from its failure manifest, or
+  None if it has none. Occluded plans are left out since they fail the same
+  way every time.
+  """
+  path = failures_path(args, unit)
+  if not os.path.isfile(path):
+    return None
+  indices = set()
+  with open(path, 'r') as f:
+    for line in f:
+      if not line.strip(): continue
+      failure = json.loads(line)
+      if failure['kind'] != 'occluded':
+        indices.add(failure['index'])
+  return sorted(indices)
+
+
+def contiguous_ranges(indices):
+  """ Split sorted indices into (start, count) ranges of consecutive ones """
+  ranges = []
+  for idx in indices:
+    if ranges and ranges[-1][0] + ranges[-1][1] == idx:
+      ranges[-1][1] += 1
+    else:
+      ranges.append([idx, 1])
+  return [tuple(r) for r in ranges]
+
+
+def scene_file_flags(args, unit):
+  """
+  Arguments pointing the combined scene files of args.script to files of this
+  unit in args.log_dir
+  """
+  script = os.path.basename(args.script)
+  if script == 'render_images.py':
+    flags = SC_SCENE_FILE_FLAGS[:1]
+  elif script.startswith('render_sc_images'):
+    flags = SC_SCENE_FILE_FLAGS
+  else:
+    flags = []
+  argv = []
+  for flag, suffix in flags:
+    argv += [flag, os.path.join(args.log_dir,
+                                '%s.%s' % (unit_name(unit), suffix))]
+  return argv
+
+
+def blender_command(args, script_argv):
+  """ Command running args.script in Blender with the given arguments """
+  cmd = [args.blender, '--background']
+  if args.threads_per_worker > 0:
+    cmd += ['--threads', str(args.threads_per_worker)]
+  return cmd + ['--python', args.script, '--'] + script_argv
+
+
+def worker_env(args, slot):
+  """ Environment of the worker in the given slot, selecting its GPU """
+  env = dict(os.environ)
+  gpus = [g for g in args.gpus.split(',') if g]
+  if gpus:
+    env['CUDA_VISIBLE_DEVICES'] = gpus[slot % len(gpus)]
+  return env
+
+
+def start_worker(args, script_argv, unit, slot):
+  """ Start a Blender process rendering one unit """
+  start_flag, count_flag = RANGE_FLAGS.get(os.path.basename(args.script),
+                                           ('--start_idx', '--num_images'))
+  name = unit_name(unit)
+  # The failure manifest is appended to, so drop the one of a previous attempt
+  failure_manifest = failures_path(args, unit)
+  if os.path.isfile(failure_manifest):
+    os.remove(failure_manifest)
+  cmd = blender_command(args, script_argv + [
+    start_flag, str(unit['start']), count_flag, str(unit['count']),
+    '--failure_manifest', failure_manifest,
+  ] + scene_file_flags(args, unit))
+  env = worker_env(args, slot)
+  log = open(os.path.join(args.log_dir, name + '.log'), 'a')
+  proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+  log.close()
+  return proc
+
+
+def describe_exit(returncode):
+  if returncode == EXIT_RENDER_FAILED:
+    return 'gave up on some images'
+  if returncode < 0:
+    return 'killed by signal %d' % -returncode
+  return 'exited with status %d' % returncode
+
+
+def main(args, script_argv):
+  if args.log_dir is None:
+    args.log_dir = os.path.splitext(args.manifest)[0] + '_logs'
+  manifest_dir = os.path.dirname(args.manifest)
+  if manifest_dir and not os.path.isdir(manifest_dir):
+    os.makedirs(manifest_dir)
+  if not os.path.isdir(args.log_dir):
+    os.makedirs(args.log_dir)
+
+  units = load_manifest(args)
+  save_manifest(args, units)
+  pending = [u for u in units if u['status'] == 'pending']
+  num_done = sum(1 for u in units if u['status'] in ('done', 'split'))
+  print('%d of %d units already done; rendering %d units with %d workers'
+        % (num_done, len(units), len(pending), args.num_workers))
+
+  tic = time.time()
+  num_rendered = 0
+  running = {}
+  free_slots = list(range(args.num_workers))
+  while pending or running:
+    # Start workers on free slots
+    while pending and free_slots:
+      unit = pending.pop(0)
+      slot = free_slots.pop(0)
+      unit['status'] = 'running'
+      unit['attempts'] += 1
+      running[slot] = (unit, start_worker(args, script_argv, unit, slot),
+                       time.time())
+      save_manifest(args, units)
+
+    time.sleep(args.poll_interval)
+    for slot in list(running.keys()):
+      unit, proc, unit_tic = running[slot]
+      returncode = proc.poll()
+      if returncode is None:
+        continue
+      del running[slot]
+      free_slots.append(slot)
+      unit['returncode'] = returncode
+      unit['seconds'] = time.time() - unit_tic
+      indices = None
+      if returncode == EXIT_RENDER_FAILED:
+        indices = failed_indices(args, unit)
+      if returncode == 0:
+        unit['status'] = 'done'
+        num_rendered += unit['count']
+        result = 'done'
+      elif (indices is not None and len(indices) < unit['count']
+            and unit['attempts'] < args.max_attempts):
+        # Render only the images the worker gave up on again, as new units
+        unit['status'] = 'split'
+        unit['failed'] = indices
+        num_rendered += unit['count'] - len(indices)
+        for start, count in contiguous_ranges(indices):
+          retry = new_unit(start, count)
+          retry['attempts'] = unit['attempts']
+          retry['retry_of'] = unit_name(unit)
+          units.append(retry)
+          pending.append(retry)
+        result = 'gave up on %d images; retrying them' % len(indices)
+      elif unit['attempts'] < args.max_attempts:
+        # Crashed or gave up on some images; render the whole unit again
+        unit['status'] = 'pending'
+        pending.append(unit)
+        result = '%s; retrying' % describe_exit(returncode)
+      else:
+        unit['status'] = 'failed'
+        result = '%s; giving up' % describe_exit(returncode)
+      save_manifest(args, units)
+      hours = (time.time() - tic) / 3600.0
+      print('Unit %s %s after %.1f s (attempt %d); %.1f images/hour'
+            % (unit_name(unit), result, unit['seconds'], unit['attempts'],
+               num_rendered / hours))
+
+  toc = time.time()
+  num_done = sum(1 for u in units if u['status'] in ('done', 'split'))
+  failed = [unit_name(u) for u in units if u['status'] == 'failed']
+  print('Rendered %d images in %.1f s (%.1f images/hour); %d of %d units done'
+        % (num_rendered, toc - tic, num_rendered / ((toc - tic) / 3600.0),
+           num_done, len(units)))
+  for name in failed:
+    print('Failed unit %s' % name)
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  argv, script_argv = split_argv(sys.argv[1:])
+  args = parser.parse_args(argv)
+  sys.exit(main(args, script_argv))
@@ -6,9 +6,8 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile
+import math, sys, random, argparse, json, os, tempfile, time
 from datetime import datetime as dt
-from collections import Counter
 
 """
 Renders random scenes using Blender, each with with a random number of objects;
@@ -31,6 +30,9 @@ except ImportError as e:
 if INSIDE_BLENDER:
   try:
     import utils
+    import occlusion
+    import layout
+    import relationships
   except ImportError as e:
     print("\nERROR")
     print("Running render_images.py from Blender and cannot import utils.py.") 
@@ -41,6 +43,14 @@ if INSIDE_BLENDER:
     print("$VERSION is your Blender version (such as 2.78).")
     sys.exit(1)
 
+# Statistics about the layouts sampled in add_random_objects and how many of
+# them were rejected by the occlusion pre-check
+layout_stats = layout.LayoutStats() if INSIDE_BLENDER else None
+occlusion_stats = occlusion.PrecheckStats() if INSIDE_BLENDER else None
+
+# Retries failed renders and records images that could not be rendered
+render_supervisor = utils.RenderSupervisor() if INSIDE_BLENDER else None
+
 parser = argparse.ArgumentParser()
 
 # Input options
@@ -78,6 +88,25 @@ parser.add_argument('--min_pixels_per_object', default=200, type=int,
     help="All objects will have at least this many visible pixels in the " +
          "final rendered images; this ensures that no objects are fully " +
          "occluded by other objects.")
+parser.add_argument('--visibility_render_scale', default=1.0, type=float,
+    help="Scale of the resolution at which the flat-shaded render used to " +
+         "check object visibility is made, relative to --width and " +
+         "--height; --min_pixels_per_object is scaled by the square of " +
+         "this value. Values below 1 make the check faster at the cost of " +
+         "accuracy for barely visible objects.")
+parser.add_argument('--visibility_from_index_pass', default=0, type=int,
+    help="Setting --visibility_from_index_pass 1 checks object visibility " +
+         "using the Cycles object index pass of the final render instead " +
+         "of a separate flat-shaded render, placing objects again if any " +
+         "object is not visible. The visible pixel count, bounding box, and " +
+         "run-length encoded instance mask of each object are stored in " +
+         "the output JSON.")
+parser.add_argument('--occlusion_precheck', default=1, type=int,
+    help="Setting --occlusion_precheck 1 estimates object occlusion from " +
+         "the object bounding boxes before rendering anything, and places " +
+         "objects again if some object certainly has fewer than " +
+         "--min_pixels_per_object visible pixels. The rendered visibility " +
+         "check is still applied to layouts that pass.")
 parser.add_argument('--max_retries', default=50, type=int,
     help="The number of times to try placing an object before giving up and " +
          "re-placing all objects in the scene.")
@@ -113,6 +142,12 @@ parser.add_argument('--save_blendfiles', type=int, default=0,
          "each generated image to be stored in the directory specified by " +
          "the --output_blend_dir flag. These files are not saved by default " +
          "because they take up ~5-10MB each.")
+parser.add_argument('--store_relationships', default=1, type=int,
+    help="Setting --store_relationships 0 omits the spatial relationships " +
+         "from the output JSON scene structures and only records the " +
+         "threshold and version used to compute them; question generation " +
+         "recomputes them from the object coordinates when loading scenes. " +
+         "This makes scene files several times smaller.")
 parser.add_argument('--version', default='1.0',
     help="String to store in the \"version\" field of the generated JSON file")
 parser.add_argument('--license',
@@ -146,11 +181,46 @@ parser.add_argument('--render_min_bounces', default=8, type=int,
     help="The minimum number of bounces to use for rendering.")
 parser.add_argument('--render_max_bounces', default=8, type=int,
     help="The maximum number of bounces to use for rendering.")
+parser.add_argument('--reuse_scene', default=1, type=int,
+    help="Setting --reuse_scene 1 loads the base scene and materials once " +
+         "and applies the render settings once, then resets the scene in " +
+         "place between images by removing the added objects and materials " +
+         "and restoring the camera and lamps. Setting --reuse_scene 0 " +
+         "reloads the base scene file for every image.")
+parser.add_argument('--purge_orphans_every', default=10, type=int,
+    help="When reusing the scene, remove unused meshes, materials, and " +
+         "images left over from previous scenes after this many images " +
+         "so that memory use does not grow over long runs.")
+parser.add_argument('--share_materials', default=1, type=int,
+    help="Setting --share_materials 1 makes all objects with the same " +
+         "material and color share a single Blender material, so that the " +
+         "number of shaders Cycles has to compile is bounded by the number " +
+         "of material and color combinations rather than the number of " +
+         "objects. Setting --share_materials 0 creates a new material for " +
+         "every object.")
 parser.add_argument('--render_tile_size', default=256, type=int,
     help="The tile size to use for rendering. This should not affect the " +
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
          "while larger tile sizes may be optimal for GPU-based rendering.")
+parser.add_argument('--render_max_retries', default=3, type=int,
+    help="The number of times a failed render is retried, with exponential " +
+         "backoff, before the image is given up on. Images that could not " +
+         "be rendered are skipped, and the script exits with status 75 " +
+         "after rendering the rest; after out-of-memory, GPU, or I/O errors " +
+         "the script stops right away.")
+parser.add_argument('--render_retry_backoff', default=1.0, type=float,
+    help="Seconds to wait before retrying a failed render for the first " +
+         "time; the wait doubles with every further retry.")
+parser.add_argument('--serve', default=None, nargs='?', const='-',
+    help="Keep running and render jobs received as JSON lines instead of " +
+         "rendering --num_images images; see render_pool.py. With no value " +
+         "jobs are read from stdin and results are written to stdout; " +
+         "otherwise this gives the path of a Unix socket to listen on.")
+parser.add_argument('--failure_manifest', default=None,
+    help="Optional path of a file to which one JSON line is appended for " +
+         "each image that could not be rendered, giving its index and the " +
+         "kind of failure.")
 
 def main(args):
   num_digits = 6
@@ -169,23 +239,47 @@ def main(args):
   if args.save_blendfiles == 1 and not os.path.isdir(args.output_blend_dir):
     os.makedirs(args.output_blend_dir)
   
+  utils.SHARE_MATERIALS = (args.share_materials == 1)
+  session = None
+  if args.reuse_scene == 1:
+    session = utils.SceneSession(args.base_scene_blendfile, args.material_dir,
+        object_names=['Camera', 'Lamp_Key', 'Lamp_Back', 'Lamp_Fill'],
+        purge_every=args.purge_orphans_every)
+    configure_render(args)
+  render_supervisor.configure(args)
+
+  if args.serve is not None:
+    serve_jobs(args, session, img_template, scene_template, blend_template)
+    return render_supervisor.exit_code()
+
   all_scene_paths = []
   for i in range(args.num_images):
     img_path = img_template % (i + args.start_idx)
     scene_path = scene_template % (i + args.start_idx)
-    all_scene_paths.append(scene_path)
     blend_path = None
     if args.save_blendfiles == 1:
       blend_path = blend_template % (i + args.start_idx)
     num_objects = random.randint(args.min_objects, args.max_objects)
-    render_scene(args,
-      num_objects=num_objects,
-      output_index=(i + args.start_idx),
-      output_split=args.split,
-      output_image=img_path,
-      output_scene=scene_path,
-      output_blendfile=blend_path,
-    )
+    try:
+      render_scene(args,
+        num_objects=num_objects,
+        output_index=(i + args.start_idx),
+        output_split=args.split,
+        output_image=img_path,
+        output_scene=scene_path,
+        output_blendfile=blend_path,
+        session=session,
+      )
+    except utils.RenderFailed as e:
+      render_supervisor.record_error(i + args.start_idx, e,
+                                     paths=[img_path, scene_path, blend_path])
+      if e.fatal:
+        # Leave the remaining images to a new worker
+        for j in range(i + 1, args.num_images):
+          render_supervisor.record_failure(j + args.start_idx, 'skipped')
+        break
+      continue
+    all_scene_paths.append(scene_path)
 
   # After rendering all images, combine the JSON files for each scene into a
   # single JSON file.
@@ -204,30 +298,63 @@ def main(args):
   }
   with open(args.output_scene_file, 'w') as f:
     json.dump(output, f)
+  print(layout_stats.summary())
+  if args.occlusion_precheck == 1:
+    print(occlusion_stats.summary())
+  if render_supervisor.failures:
+    print(render_supervisor.summary())
+  return render_supervisor.exit_code()
 
 
-
-def render_scene(args,
-    num_objects=5,
-    output_index=0,
-    output_split='none',
-    output_image='render.png',
-    output_scene='render_json',
-    output_blendfile=None,
-  ):
-
-  # Load the main blendfile
-  bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-
-  # Load materials
-  utils.load_materials(args.material_dir)
-
+def serve_jobs(args, session, img_template, scene_template, blend_template):
+  """
+  Render jobs received through utils.serve until told to stop. A job gives
+  the index of the image to render and optionally its number of objects, as
+  {"index": 12, "num_objects": 4}; its result gives the status ('ok' or
+  'failed') and the paths of the outputs, or the kind of failure.
+  """
+  def handle_job(job):
+    index = job['index']
+    img_path = img_template % index
+    scene_path = scene_template % index
+    blend_path = None
+    if args.save_blendfiles == 1:
+      blend_path = blend_template % index
+    num_objects = job.get('num_objects')
+    if num_objects is None:
+      num_objects = random.randint(args.min_objects, args.max_objects)
+    try:
+      timings = render_scene(args,
+        num_objects=num_objects,
+        output_index=index,
+        output_split=args.split,
+        output_image=img_path,
+        output_scene=scene_path,
+        output_blendfile=blend_path,
+        session=session,
+      )
+    except utils.RenderFailed as e:
+      render_supervisor.record_error(index, e,
+                                     paths=[img_path, scene_path, blend_path])
+      return {'index': index, 'status': 'failed', 'kind': e.kind,
+              'message': e.message, 'fatal': e.fatal}
+    result = {'index': index, 'status': 'ok', 'image': img_path,
+              'scene': scene_path}
+    result.update(timings)
+    return result
+
+  utils.serve(args.serve, handle_job)
+
+
+def configure_render(args):
+  """
+  Apply the render settings from args to the current scene.
+  """
   # Set render arguments so we can get pixel coordinates later.
   # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
   # cannot be used.
   render_args = bpy.context.scene.render
   render_args.engine = "CYCLES"
-  render_args.filepath = output_image
   render_args.resolution_x = args.width
   render_args.resolution_y = args.height
   render_args.resolution_percentage = 100
@@ -251,6 +378,32 @@ def render_scene(args,
   if args.use_gpu == 1:
     bpy.context.scene.cycles.device = 'GPU'
 
+
+def render_scene(args,
+    num_objects=5,
+    output_index=0,
+    output_split='none',
+    output_image='render.png',
+    output_scene='render_json',
+    output_blendfile=None,
+    session=None,
+  ):
+
+  setup_start = time.time()
+  if session is None:
+    # Load the main blendfile
+    bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+
+    # Load materials
+    utils.load_materials(args.material_dir)
+
+    configure_render(args)
+  else:
+    # The base scene, materials and render settings are already loaded; just
+    # remove the objects from the previous scene and undo the jitter.
+    session.reset()
+  bpy.context.scene.render.filepath = output_image
+
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
       'split': output_split,
@@ -271,6 +424,9 @@ def render_scene(args,
   if args.camera_jitter > 0:
     for i in range(3):
       bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
+  # Update the world matrix of the jittered camera, which is used below for the
+  # directions, the occlusion precheck and the pixel coordinates of objects
+  bpy.context.scene.update()
 
   # Figure out the left, up, and behind directions along the plane and record
   # them in the scene structure
@@ -306,199 +462,150 @@ def render_scene(args,
     for i in range(3):
       bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
 
-  # Now make some random objects
-  objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera)
-
-  # Render the scene and dump the scene data structure
-  scene_struct['objects'] = objects
-  scene_struct['relationships'] = compute_all_relationships(scene_struct)
+  # Now make some random objects and render the scene. When visibility is
+  # checked using the object index pass of the final render, objects are
+  # placed again until all of them are visible in the render.
   while True:
-    try:
-      bpy.ops.render.render(write_still=True)
+    objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera)
+    if args.visibility_from_index_pass == 1:
+      utils.enable_object_index_pass(blender_objects)
+    render_start = time.time()
+    render_supervisor.render(write_still=True)
+    if args.visibility_from_index_pass == 0:
       break
-    except Exception as e:
-      print(e)
+    index = utils.read_object_index_pass()
+    if utils.add_object_masks(objects, index, args.min_pixels_per_object):
+      break
+    print('Some objects are occluded; replacing objects')
+    utils.delete_objects(blender_objects)
+
+  # Dump the scene data structure
+  scene_struct['objects'] = objects
+  if args.store_relationships:
+    scene_struct['relationships'] = \
+        relationships.compute_all_relationships(scene_struct)
+  else:
+    # Relationships are fully determined by the coordinates and directions,
+    # so only record how to recompute them when the scene is loaded
+    scene_struct['relationships_spec'] = {
+      'version': relationships.RELATIONSHIPS_VERSION,
+      'eps': relationships.RELATIONSHIPS_EPS,
+    }
+  num_materials = len(set(o.material_slots[0].material.name
+                          for o in blender_objects))
+  timings = {
+    'setup_seconds': render_start - setup_start,
+    'render_seconds': time.time() - render_start,
+  }
+  print('Image %d: setup took %.2f s, rendering took %.2f s, %d objects '
+        'using %d materials' % (output_index, timings['setup_seconds'],
+        timings['render_seconds'], len(blender_objects), num_materials))
 
   with open(output_scene, 'w') as f:
     json.dump(scene_struct, f, indent=2)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+  return timings
 
 
 def add_random_objects(scene_struct, num_objects, args, camera):
   """
-  Add random objects to the current blender scene
+  Add random objects to the current blender scene. Layouts are sampled without
+  Blender (see layout.py), and objects are only added to the scene for layouts
+  that pass the occlusion pre-check; if some object turns out to be occluded
+  in the rendered visibility check then a new layout is sampled.
   """
+  properties = layout.load_catalog(args.properties_json,
+                                   args.shape_color_combos_json)
+  camera_params = utils.get_camera_params(camera)
 
-  # Load the property file
-  with open(args.properties_json, 'r') as f:
-    properties = json.load(f)
-    color_name_to_rgba = {}
-    for name, rgb in properties['colors'].items():
-      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-      color_name_to_rgba[name] = rgba
-    material_mapping = [(v, k) for k, v in properties['materials'].items()]
-    object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-    size_mapping = list(properties['sizes'].items())
-
-  shape_color_combos = None
-  if args.shape_color_combos_json is not None:
-    with open(args.shape_color_combos_json, 'r') as f:
-      shape_color_combos = list(json.load(f).items())
-
-  positions = []
-  objects = []
-  blender_objects = []
-  for i in range(num_objects):
-    # Choose a random size
-    size_name, r = random.choice(size_mapping)
-
-    # Try to place the object, ensuring that we don't intersect any existing
-    # objects and that we are more than the desired margin away from all existing
-    # objects along all cardinal directions.
-    num_tries = 0
-    while True:
-      # If we try and fail to place an object too many times, then delete all
-      # the objects in the scene and start over.
-      num_tries += 1
-      if num_tries > args.max_retries:
-        for obj in blender_objects:
-          utils.delete_object(obj)
-        return add_random_objects(scene_struct, num_objects, args, camera)
-      x = random.uniform(-3, 3)
-      y = random.uniform(-3, 3)
-      # Check to make sure the new object is further than min_dist from all
-      # other objects, and further than margin along the four cardinal directions
-      dists_good = True
-      margins_good = True
-      for (xx, yy, rr) in positions:
-        dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
-        if dist - r - rr < args.min_dist:
-          dists_good = False
-          break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
-          if 0 < margin < args.margin:
-            print(margin, args.margin, direction_name)
-            print('BROKEN MARGIN!')
-            margins_good = False
-            break
-        if not margins_good:
-          break
-
-      if dists_good and margins_good:
-        break
+  while True:
+    object_layout = layout.sample_layout(num_objects, properties,
+        scene_struct['directions'], min_dist=args.min_dist,
+        margin=args.margin, max_retries=args.max_retries, stats=layout_stats)
+
+    # Discard layouts where some object is certainly occluded without
+    # touching the Blender scene
+    if args.occlusion_precheck == 1:
+      boxes = [(o['x'], o['y'], o['r'], o['theta']) for o in object_layout]
+      occluded = occlusion.certainly_occluded(boxes, camera_params,
+                                              args.min_pixels_per_object)
+      occlusion_stats.record(occluded)
+      if occluded:
+        print('Some objects are certainly occluded; sampling a new layout')
+        continue
+
+    objects = []
+    blender_objects = []
+    for spec in object_layout:
+      # Actually add the object to the scene
+      obj = utils.add_object(args.shape_dir, spec['shape_file'], spec['r'],
+                             (spec['x'], spec['y']), theta=spec['theta'])
+      blender_objects.append(obj)
+
+      # Attach its material
+      utils.add_material(obj, spec['material_file'], Color=spec['rgba'])
+
+      # Record data about the object in the scene data structure
+      pixel_coords = utils.get_camera_coords(camera, obj.location)
+      objects.append({
+        'shape': spec['shape'],
+        'size': spec['size'],
+        'material': spec['material'],
+        '3d_coords': tuple(obj.location),
+        'rotation': spec['theta'],
+        'pixel_coords': pixel_coords,
+        'color': spec['color'],
+      })
+
+    # Check that all objects are at least partially visible in the rendered
+    # image; when using the object index pass this is done after the final
+    # render.
+    all_visible = True
+    if args.visibility_from_index_pass == 0:
+      all_visible = check_visibility(blender_objects,
+                                     args.min_pixels_per_object,
+                                     args.visibility_render_scale)
+    if all_visible:
+      return objects, blender_objects
 
-    # Choose random color and shape
-    if shape_color_combos is None:
-      obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
-    else:
-      obj_name_out, color_choices = random.choice(shape_color_combos)
-      color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-      rgba = color_name_to_rgba[color_name]
-
-    # For cube, adjust the size a bit
-    if obj_name == 'Cube':
-      r /= math.sqrt(2)
-
-    # Choose random orientation for the object.
-    theta = 360.0 * random.random()
-
-    # Actually add the object to the scene
-    utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-    obj = bpy.context.object
-    blender_objects.append(obj)
-    positions.append((x, y, r))
-
-    # Attach a random material
-    mat_name, mat_name_out = random.choice(material_mapping)
-    utils.add_material(mat_name, Color=rgba)
-
-    # Record data about the object in the scene data structure
-    pixel_coords = utils.get_camera_coords(camera, obj.location)
-    objects.append({
-      'shape': obj_name_out,
-      'size': size_name,
-      'material': mat_name_out,
-      '3d_coords': tuple(obj.location),
-      'rotation': theta,
-      'pixel_coords': pixel_coords,
-      'color': color_name,
-    })
-
-  # Check that all objects are at least partially visible in the rendered image
-  all_visible = check_visibility(blender_objects, args.min_pixels_per_object)
-  if not all_visible:
     # If any of the objects are fully occluded then start over; delete all
     # objects from the scene and place them all again.
     print('Some objects are occluded; replacing objects')
-    for obj in blender_objects:
-      utils.delete_object(obj)
-    return add_random_objects(scene_struct, num_objects, args, camera)
-
-  return objects, blender_objects
+    utils.delete_objects(blender_objects)
 
 
-def compute_all_relationships(scene_struct, eps=0.2):
-  """
-  Computes relationships between all pairs of objects in the scene.
-  
-  Returns a dictionary mapping string relationship names to lists of lists of
-  integers, where output[rel][i] gives a list of object indices that have the
-  relationship rel with object i. For example if j is in output['left'][i] then
-  object j is left of object i.
-  """
-  all_relationships = {}
-  for name, direction_vec in scene_struct['directions'].items():
-    if name == 'above' or name == 'below': continue
-    all_relationships[name] = []
-    for i, obj1 in enumerate(scene_struct['objects']):
-      coords1 = obj1['3d_coords']
-      related = set()
-      for j, obj2 in enumerate(scene_struct['objects']):
-        if obj1 == obj2: continue
-        coords2 = obj2['3d_coords']
-        diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-        dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-        if dot > eps:
-          related.add(j)
-      all_relationships[name].append(sorted(list(related)))
-  return all_relationships
-
-
-def check_visibility(blender_objects, min_pixels_per_object):
+def check_visibility(blender_objects, min_pixels_per_object, render_scale=1.0):
   """
   Check whether all objects in the scene have some minimum number of visible
   pixels; to accomplish this we assign random (but distinct) colors to all
   objects, and render using no lighting or shading or antialiasing; this
   ensures that each object is just a solid uniform color. We can then count
   the number of pixels of each color in the output image to check the visibility
-  of each object.
+  of each object. The flat render is made at render_scale times the output
+  resolution, and min_pixels_per_object is scaled to match.
 
   Returns True if all objects are visible and False otherwise.
   """
   f, path = tempfile.mkstemp(suffix='.png')
-  object_colors = render_shadeless(blender_objects, path=path)
+  os.close(f)
+  object_colors = render_shadeless(blender_objects, path=path,
+                                   render_scale=render_scale)
   img = bpy.data.images.load(path)
-  p = list(img.pixels)
-  color_count = Counter((p[i], p[i+1], p[i+2], p[i+3])
-                        for i in range(0, len(p), 4))
+  color_counts = utils.count_colors(img)
+  bpy.data.images.remove(img)
   os.remove(path)
-  if len(color_count) != len(blender_objects) + 1:
+  if len(color_counts) != len(blender_objects) + 1:
     return False
-  for _, count in color_count.most_common():
-    if count < min_pixels_per_object:
+  min_pixels = min_pixels_per_object * render_scale ** 2
+  for count in color_counts:
+    if count < min_pixels:
       return False
   return True
 
 
-def render_shadeless(blender_objects, path='flat.png'):
+def render_shadeless(blender_objects, path='flat.png', render_scale=1.0):
   """
   Render a version of the scene with shading disabled and unique materials
   assigned to all objects, and return a set of all colors that should be in the
@@ -511,11 +618,14 @@ def render_shadeless(blender_objects, path='flat.png'):
   old_filepath = render_args.filepath
   old_engine = render_args.engine
   old_use_antialiasing = render_args.use_antialiasing
+  old_resolution_percentage = render_args.resolution_percentage
 
   # Override some render settings to have flat shading
   render_args.filepath = path
   render_args.engine = 'BLENDER_RENDER'
   render_args.use_antialiasing = False
+  render_args.resolution_percentage = max(1, int(round(
+      old_resolution_percentage * render_scale)))
 
   # Move the lights and ground to layer 2 so they don't render
   utils.set_layer(bpy.data.objects['Lamp_Key'], 2)
@@ -527,7 +637,7 @@ def render_shadeless(blender_objects, path='flat.png'):
   object_colors = set()
   old_materials = []
   for i, obj in enumerate(blender_objects):
-    old_materials.append(obj.data.materials[0])
+    old_materials.append(obj.material_slots[0].material)
     bpy.ops.material.new()
     mat = bpy.data.materials['Material']
     mat.name = 'Material_%d' % i
@@ -537,14 +647,14 @@ def render_shadeless(blender_objects, path='flat.png'):
     object_colors.add((r, g, b))
     mat.diffuse_color = [r, g, b]
     mat.use_shadeless = True
-    obj.data.materials[0] = mat
+    obj.material_slots[0].material = mat
 
   # Render the scene
   bpy.ops.render.render(write_still=True)
 
   # Undo the above; first restore the materials to objects
   for mat, obj in zip(old_materials, blender_objects):
-    obj.data.materials[0] = mat
+    obj.material_slots[0].material = mat
 
   # Move the lights and ground back to layer 0
   utils.set_layer(bpy.data.objects['Lamp_Key'], 0)
@@ -556,6 +666,7 @@ def render_shadeless(blender_objects, path='flat.png'):
   render_args.filepath = old_filepath
   render_args.engine = old_engine
   render_args.use_antialiasing = old_use_antialiasing
+  render_args.resolution_percentage = old_resolution_percentage
 
   return object_colors
 
@@ -565,7 +676,7 @@ if __name__ == '__main__':
     # Run normally
     argv = utils.extract_args()
     args = parser.parse_args(argv)
-    main(args)
+    sys.exit(main(args))
   elif '--help' in sys.argv or '-h' in sys.argv:
     parser.print_help()
   else:
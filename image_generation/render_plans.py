@@ -0,0 +1,347 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import sys, argparse, json, os
+
+"""
+Renders scenes planned by plan_scenes.py. For each plan the default scene and
+its nonsemantic and semantic variants are rendered exactly as specified in the
+plan, without sampling anything; if some object turns out not to be visible
+in any of the three images then the outputs for that plan are removed and its
+index is reported as failed.
+
+Each rendered image gets its own JSON scene file, as in the other render
+scripts; use collect_scenes.py to combine them. Rendering a range of plans
+(--start_plan and --num_plans) makes it easy to spread one plan file over many
+workers.
+
+This file expects to be run from Blender like this:
+
+blender --background --python render_plans.py -- [arguments to this script]
+
+Running it with --write_camera_json writes the camera parameters and
+directions of the base scene for plan_scenes.py instead of rendering.
+"""
+
+INSIDE_BLENDER = True
+try:
+  import bpy, bpy_extras
+  from mathutils import Vector
+except ImportError as e:
+  INSIDE_BLENDER = False
+if INSIDE_BLENDER:
+  try:
+    import utils
+    import layout
+    import relationships
+    import render_images
+  except ImportError as e:
+    print("\nERROR")
+    print("Running render_plans.py from Blender and cannot import utils.py.")
+    print("You may need to add a .pth file to the site-packages of Blender's")
+    print("bundled python with a command like this:\n")
+    print("echo $PWD >> $BLENDER/$VERSION/python/lib/python3.5/site-packages/clevr.pth")
+    print("\nWhere $BLENDER is the directory where Blender is installed, and")
+    print("$VERSION is your Blender version (such as 2.78).")
+    sys.exit(1)
+
+# Retries failed renders and records plans that could not be rendered
+render_supervisor = utils.RenderSupervisor() if INSIDE_BLENDER else None
+
+parser = argparse.ArgumentParser()
+
+# Input options
+parser.add_argument('--input_plan_file', default='../output/CLEVR_plans.jsonl',
+    help="File of scene plans written by plan_scenes.py")
+parser.add_argument('--start_plan', default=0, type=int,
+    help="Index (line number) of the first plan in --input_plan_file to render")
+parser.add_argument('--num_plans', default=-1, type=int,
+    help="The number of plans to render; -1 renders all remaining plans")
+parser.add_argument('--write_camera_json', default=None,
+    help="If given, write the camera parameters and directions of the base " +
+         "scene to this file for plan_scenes.py and exit without rendering")
+parser.add_argument('--base_scene_blendfile', default='data/base_scene.blend',
+    help="Base blender file on which all scenes are based; includes " +
+          "ground plane, lights, and camera.")
+parser.add_argument('--properties_json', default='data/properties.json',
+    help="JSON file defining objects, materials, sizes, and colors.")
+parser.add_argument('--shape_dir', default='data/shapes',
+    help="Directory where .blend files for object models are stored")
+parser.add_argument('--material_dir', default='data/materials',
+    help="Directory where .blend files for materials are stored")
+parser.add_argument('--min_pixels_per_object', default=200, type=int,
+    help="All objects will have at least this many visible pixels in the " +
+         "final rendered images; plans where this fails are reported as " +
+         "failed.")
+parser.add_argument('--visibility_render_scale', default=1.0, type=float,
+    help="Scale of the resolution at which the flat-shaded render used to " +
+         "check object visibility is made, relative to --width and " +
+         "--height; --min_pixels_per_object is scaled by the square of " +
+         "this value.")
+parser.add_argument('--visibility_from_index_pass', default=0, type=int,
+    help="Setting --visibility_from_index_pass 1 checks object visibility " +
+         "using the Cycles object index pass of the final render instead " +
+         "of a separate flat-shaded render, and stores the visible pixel " +
+         "count, bounding box, and instance mask of each object.")
+
+# Output settings
+parser.add_argument('--filename_prefix', default='CLEVR',
+    help="This prefix will be prepended to the rendered images and JSON scenes")
+parser.add_argument('--split', default='default',
+    help="Name of the split of the default scenes")
+parser.add_argument('--semantic_split', default='semantic',
+    help="Name of the split of the semantically changed scenes")
+parser.add_argument('--nonsemantic_split', default='nonsemantic',
+    help="Name of the split of the nonsemantically changed scenes")
+parser.add_argument('--output_dir', default='../output/',
+    help="The directory where output images and scenes will be stored; " +
+         "default, semantic, and nonsemantic images are written to its " +
+         "images, sc_images, and nsc_images subdirectories and their " +
+         "scenes to scenes, sc_scenes, and nsc_scenes. They will be " +
+         "created if they do not exist.")
+parser.add_argument('--store_relationships', default=1, type=int,
+    help="Setting --store_relationships 0 omits the spatial relationships " +
+         "from the output JSON scene structures; see render_images.py.")
+parser.add_argument('--purge_orphans_every', default=10, type=int,
+    help="Remove unused meshes, materials, and images left over from " +
+         "previous scenes after this many images.")
+parser.add_argument('--share_materials', default=1, type=int,
+    help="Setting --share_materials 0 creates a new material for every " +
+         "object instead of sharing one per material and color.")
+
+# Rendering options
+parser.add_argument('--use_gpu', default=0, type=int,
+    help="Setting --use_gpu 1 enables GPU-accelerated rendering using CUDA. " +
+         "You must have an NVIDIA GPU with the CUDA toolkit installed for " +
+         "to work.")
+parser.add_argument('--width', default=320, type=int,
+    help="The width (in pixels) for the rendered images")
+parser.add_argument('--height', default=240, type=int,
+    help="The height (in pixels) for the rendered images")
+parser.add_argument('--render_num_samples', default=512, type=int,
+    help="The number of samples to use when rendering. Larger values will " +
+         "result in nicer images but will cause rendering to take longer.")
+parser.add_argument('--render_min_bounces', default=8, type=int,
+    help="The minimum number of bounces to use for rendering.")
+parser.add_argument('--render_max_bounces', default=8, type=int,
+    help="The maximum number of bounces to use for rendering.")
+parser.add_argument('--render_tile_size', default=256, type=int,
+    help="The tile size to use for rendering.")
+parser.add_argument('--render_max_retries', default=3, type=int,
+    help="The number of times a failed render is retried, with exponential " +
+         "backoff, before the image is given up on. Images that could not " +
+         "be rendered are skipped, and the script exits with status 75 " +
+         "after rendering the rest; after out-of-memory, GPU, or I/O errors " +
+         "the script stops right away.")
+parser.add_argument('--render_retry_backoff', default=1.0, type=float,
+    help="Seconds to wait before retrying a failed render for the first " +
+         "time; the wait doubles with every further retry.")
+parser.add_argument('--failure_manifest', default=None,
+    help="Optional path of a file to which one JSON line is appended for " +
+         "each image that could not be rendered, giving its index and the " +
+         "kind of failure.")
+
+# Names of the outputs of each plan: (variant, split flag, output subdirectory
+# prefix); the default scene is rendered first
+VARIANTS = [
+  ('default', 'split', ''),
+  ('nonsemantic', 'nonsemantic_split', 'nsc_'),
+  ('semantic', 'semantic_split', 'sc_'),
+]
+
+
+def write_camera_json(args):
+  bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+  render_images.configure_render(args)
+  camera = bpy.data.objects['Camera']
+  output = {
+    'camera': utils.get_camera_params(camera),
+    'directions': utils.get_directions(camera),
+  }
+  with open(args.write_camera_json, 'w') as f:
+    json.dump(output, f, indent=2)
+
+
+def load_plans(args):
+  plans = []
+  with open(args.input_plan_file, 'r') as f:
+    for i, line in enumerate(f):
+      if i < args.start_plan:
+        continue
+      if args.num_plans >= 0 and len(plans) >= args.num_plans:
+        break
+      plans.append(json.loads(line))
+  return plans
+
+
+def output_paths(args, plan, variant_name):
+  """ Image and scene paths of one variant of a plan """
+  for name, split_flag, dir_prefix in VARIANTS:
+    if name == variant_name:
+      break
+  split = getattr(args, split_flag)
+  prefix = '%s_%s_%06d' % (args.filename_prefix, split, plan['image_index'])
+  image_dir = os.path.join(args.output_dir, dir_prefix + 'images')
+  scene_dir = os.path.join(args.output_dir, dir_prefix + 'scenes')
+  return (split, os.path.join(image_dir, prefix + '.png'),
+          os.path.join(scene_dir, prefix + '.json'))
+
+
+def add_plan_objects(objects, args, camera, properties):
+  """
+  Add the planned objects to the scene, filling in their pixel coordinates.
+  Returns the list of blender objects.
+  """
+  blender_objects = []
+  for obj in objects:
+    x, y, r = obj['3d_coords']
+    shape_file = properties.shape_name_to_file[obj['shape']]
+    blender_obj = utils.add_object(args.shape_dir, shape_file, r, (x, y),
+                                   theta=obj['rotation'])
+    utils.add_material(blender_obj,
+                       properties.material_name_to_file[obj['material']],
+                       Color=properties.rgba(obj['color']))
+    obj['3d_coords'] = tuple(blender_obj.location)
+    obj['pixel_coords'] = utils.get_camera_coords(camera, blender_obj.location)
+    blender_objects.append(blender_obj)
+  return blender_objects
+
+
+def render_variant(args, plan, variant_name, session, properties):
+  """
+  Render one variant of a plan; returns True on success and False if some
+  object is not visible.
+  """
+  if variant_name == 'default':
+    variant = {'camera_jitter': plan['camera_jitter'],
+               'objects': plan['objects'], 'change': None}
+  else:
+    variant = plan['variants'][variant_name]
+  split, output_image, output_scene = output_paths(args, plan, variant_name)
+
+  session.reset()
+  bpy.context.scene.render.filepath = output_image
+
+  # Move the camera and lamps as planned
+  for name, key, jitter in [('Camera', None, variant['camera_jitter']),
+                            ('Lamp_Key', 'key_light_jitter', None),
+                            ('Lamp_Back', 'back_light_jitter', None),
+                            ('Lamp_Fill', 'fill_light_jitter', None)]:
+    if key is not None:
+      jitter = plan[key]
+    for i in range(len(jitter)):
+      bpy.data.objects[name].location[i] += jitter[i]
+  # Update the world matrix of the moved camera, which is used for the
+  # directions and the pixel coordinates of objects
+  bpy.context.scene.update()
+  camera = bpy.data.objects['Camera']
+
+  scene_struct = {
+      'split': split,
+      'image_index': plan['image_index'],
+      'image_filename': os.path.basename(output_image),
+      'objects': [dict(obj) for obj in variant['objects']],
+      'directions': utils.get_directions(camera),
+  }
+  if variant['change'] is not None:
+    scene_struct['change'] = variant['change']
+  blender_objects = add_plan_objects(scene_struct['objects'], args, camera,
+                                     properties)
+
+  if args.visibility_from_index_pass == 1:
+    utils.enable_object_index_pass(blender_objects)
+  elif not render_images.check_visibility(blender_objects,
+                                          args.min_pixels_per_object,
+                                          args.visibility_render_scale):
+    return False
+
+  render_supervisor.render(write_still=True)
+
+  if args.visibility_from_index_pass == 1:
+    index = utils.read_object_index_pass()
+    if not utils.add_object_masks(scene_struct['objects'], index,
+                                  args.min_pixels_per_object):
+      return False
+
+  if args.store_relationships:
+    scene_struct['relationships'] = \
+        relationships.compute_all_relationships(scene_struct)
+  else:
+    scene_struct['relationships_spec'] = {
+      'version': relationships.RELATIONSHIPS_VERSION,
+      'eps': relationships.RELATIONSHIPS_EPS,
+    }
+  with open(output_scene, 'w') as f:
+    json.dump(scene_struct, f, indent=2)
+  return True
+
+
+def main(args):
+  if args.write_camera_json is not None:
+    write_camera_json(args)
+    return
+
+  for _, _, dir_prefix in VARIANTS:
+    for subdir in ['images', 'scenes']:
+      path = os.path.join(args.output_dir, dir_prefix + subdir)
+      if not os.path.isdir(path):
+        os.makedirs(path)
+
+  properties = layout.load_catalog(args.properties_json)
+  utils.SHARE_MATERIALS = (args.share_materials == 1)
+  session = utils.SceneSession(args.base_scene_blendfile, args.material_dir,
+      object_names=['Camera', 'Lamp_Key', 'Lamp_Back', 'Lamp_Fill'],
+      purge_every=args.purge_orphans_every)
+  render_images.configure_render(args)
+
+  render_supervisor.configure(args)
+
+  plans = load_plans(args)
+  for k, plan in enumerate(plans):
+    paths = []
+    for variant_name, _, _ in VARIANTS:
+      paths.extend(output_paths(args, plan, variant_name)[1:])
+    try:
+      for variant_name, _, _ in VARIANTS:
+        if not render_variant(args, plan, variant_name, session, properties):
+          # Only keep plans where all variants were rendered
+          print('Some objects are occluded in the %s scene of plan %d'
+                % (variant_name, plan['image_index']))
+          message = 'objects occluded in the %s scene' % variant_name
+          render_supervisor.record_failure(plan['image_index'], 'occluded',
+                                           message, paths=paths)
+          break
+    except utils.RenderFailed as e:
+      render_supervisor.record_error(plan['image_index'], e, paths=paths)
+      if e.fatal:
+        # Leave the remaining plans to a new worker
+        for other in plans[k + 1:]:
+          render_supervisor.record_failure(other['image_index'], 'skipped')
+        break
+
+  num_failed = len(render_supervisor.failures)
+  print('Rendered %d of %d plans' % (len(plans) - num_failed, len(plans)))
+  return render_supervisor.exit_code()
+
+if __name__ == '__main__':
+  if INSIDE_BLENDER:
+    # Run normally
+    argv = utils.extract_args()
+    args = parser.parse_args(argv)
+    sys.exit(main(args))
+  elif '--help' in sys.argv or '-h' in sys.argv:
+    parser.print_help()
+  else:
+    print('This script is intended to be called from blender like this:')
+    print()
+    print('blender --background --python render_plans.py -- [args]')
+    print()
+    print('You can also run as a standalone python script to view all')
+    print('arguments like this:')
+    print()
+    print('python render_plans.py --help')
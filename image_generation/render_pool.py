@@ -0,0 +1,221 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, os, subprocess, sys, threading, time
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import render_farm
+
+"""
+Renders a range of image indices with a pool of long-lived Blender workers.
+Each worker runs render_images.py --serve, so Blender starts and loads the base
+scene only once per worker instead of once per few images; every image then
+only costs resetting the scene and rendering it. Jobs are sent to the workers
+as JSON lines on their stdin, one image at a time, and results are read back
+from their stdout (see utils.serve). Workers that die are started again and
+their image is handed out again, up to --max_attempts times.
+
+Arguments after "--" are passed on to render_images.py:
+
+python render_pool.py --start_idx 0 --num_images 1000 --num_workers 2 \
+  --gpus 0,1 -- --use_gpu 1 --width 480 --height 320
+
+Since the workers never write the combined scene file, use collect_scenes.py
+to build it once all images are rendered.
+"""
+
+# Prefix of result lines in the output of workers; see utils.RESULT_PREFIX
+RESULT_PREFIX = 'CLEVR_RESULT '
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--script', default='render_images.py',
+    help="The render script to run; it must support --serve")
+parser.add_argument('--blender', default='blender',
+    help="Path to the Blender executable")
+parser.add_argument('--start_idx', default=0, type=int,
+    help="The first index to render")
+parser.add_argument('--num_images', default=10, type=int,
+    help="The number of indices to render")
+parser.add_argument('--num_workers', default=1, type=int,
+    help="The number of Blender workers to keep running")
+parser.add_argument('--threads_per_worker', default=0, type=int,
+    help="The number of render threads of each worker; 0 lets Blender use " +
+         "all cores")
+parser.add_argument('--gpus', default='',
+    help="Optional comma-separated list of GPU ids; workers are assigned to " +
+         "them in turn through CUDA_VISIBLE_DEVICES. Leave empty to render " +
+         "on the CPU.")
+parser.add_argument('--max_attempts', default=3, type=int,
+    help="The number of times an image is handed out before giving up on it")
+parser.add_argument('--log_dir', default='../output/render_pool_logs',
+    help="Directory for the output of each worker")
+parser.add_argument('--failure_manifest', default=None,
+    help="Optional path of a file to which one JSON line is appended for " +
+         "each image that could not be rendered")
+
+
+class Worker(object):
+  """
+  A Blender process serving jobs on its stdin. A thread reads its stdout,
+  putting (worker, result) pairs on the shared results queue, and
+  (worker, None) once the process has exited; everything else it prints goes
+  to the log file.
+  """
+  def __init__(self, slot, cmd, env, log_path, results):
+    self.slot = slot
+    self.job = None
+    self.proc = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+    self.log_path = log_path
+    self.results = results
+    self.thread = threading.Thread(target=self._read_results)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _read_results(self):
+    with open(self.log_path, 'a') as log:
+      for line in iter(self.proc.stdout.readline, ''):
+        if line.startswith(RESULT_PREFIX):
+          self.results.put((self, json.loads(line[len(RESULT_PREFIX):])))
+        else:
+          log.write(line)
+    self.proc.wait()
+    self.results.put((self, None))
+
+  def submit(self, job):
+    self.job = job
+    try:
+      self.proc.stdin.write(json.dumps(job) + '\n')
+      self.proc.stdin.flush()
+    except (IOError, OSError):
+      # The worker died; the reader thread reports it
+      pass
+
+  def stop(self):
+    try:
+      self.proc.stdin.write(json.dumps({'command': 'stop'}) + '\n')
+      self.proc.stdin.close()
+    except (IOError, OSError):
+      pass
+
+
+class WorkerPool(object):
+  """
+  Keeps args.num_workers workers running and hands out jobs to them one at a
+  time; see render_pool.py --help for the arguments used.
+  """
+  def __init__(self, args, script_argv):
+    self.args = args
+    self.cmd = render_farm.blender_command(args, script_argv + ['--serve'])
+    self.results = queue.Queue()
+    self.num_started = 0
+    self.workers = [self._start(slot) for slot in range(args.num_workers)]
+
+  def _start(self, slot):
+    self.num_started += 1
+    log_path = os.path.join(self.args.log_dir, 'worker_%d.log' % slot)
+    return Worker(slot, self.cmd, render_farm.worker_env(self.args, slot),
+                  log_path, self.results)
+
+  def run(self, jobs, callback=None):
+    """
+    Render all jobs, calling callback(job, result) for every finished job.
+    Returns the list of jobs that failed max_attempts times.
+    """
+    pending = list(jobs)
+    attempts = {}
+    failed = []
+    idle = list(self.workers)
+    num_busy = 0
+    while pending or num_busy > 0:
+      while pending and idle:
+        job = pending.pop(0)
+        attempts[job['index']] = attempts.get(job['index'], 0) + 1
+        idle.pop(0).submit(job)
+        num_busy += 1
+
+      worker, result = self.results.get()
+      job, worker.job = worker.job, None
+      if result is None:
+        # The worker exited; start a new one in its slot
+        print('Worker %d exited with status %d'
+              % (worker.slot, worker.proc.returncode))
+        new_worker = self._start(worker.slot)
+        self.workers[self.workers.index(worker)] = new_worker
+        if worker in idle:
+          idle.remove(worker)
+        idle.append(new_worker)
+        if job is None:
+          continue
+        result = {'index': job['index'], 'status': 'failed', 'kind': 'crash',
+                  'message': 'worker exited with status %d'
+                             % worker.proc.returncode}
+      elif not result.get('fatal', False):
+        # Workers stop after fatal failures, so wait for them to exit
+        idle.append(worker)
+      num_busy -= 1
+
+      if result['status'] != 'ok':
+        if attempts[job['index']] < self.args.max_attempts:
+          pending.append(job)
+          continue
+        failed.append(job)
+      if callback is not None:
+        callback(job, result)
+    return failed
+
+  def close(self):
+    for worker in self.workers:
+      worker.stop()
+    for worker in self.workers:
+      worker.proc.wait()
+
+
+def main(args, script_argv):
+  if not os.path.isdir(args.log_dir):
+    os.makedirs(args.log_dir)
+  jobs = [{'index': i}
+          for i in range(args.start_idx, args.start_idx + args.num_images)]
+
+  tic = time.time()
+  counts = {'ok': 0}
+  def report(job, result):
+    if result['status'] == 'ok':
+      counts['ok'] += 1
+      hours = (time.time() - tic) / 3600.0
+      print('Image %d rendered in %.1f s; %d of %d done, %.1f images/hour'
+            % (job['index'], result['render_seconds'], counts['ok'],
+               len(jobs), counts['ok'] / hours))
+    else:
+      print('Giving up on image %d: %s' % (job['index'], result['message']))
+      if args.failure_manifest is not None:
+        with open(args.failure_manifest, 'a') as f:
+          f.write(json.dumps(result) + '\n')
+
+  pool = WorkerPool(args, script_argv)
+  try:
+    failed = pool.run(jobs, report)
+  finally:
+    pool.close()
+  toc = time.time()
+  print('Rendered %d images in %.1f s (%.1f images/hour) with %d workers, '
+        '%d started in total' % (counts['ok'], toc - tic,
+        counts['ok'] / ((toc - tic) / 3600.0), args.num_workers,
+        pool.num_started))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  argv, script_argv = render_farm.split_argv(sys.argv[1:])
+  args = parser.parse_args(argv)
+  sys.exit(main(args, script_argv))
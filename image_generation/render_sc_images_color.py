@@ -8,7 +8,6 @@
 from __future__ import print_function
 import math, sys, random, argparse, json, os, tempfile, copy
 from datetime import datetime as dt
-from collections import Counter
 
 """
 Renders random scenes using Blender, each with with a random number of objects;
@@ -31,6 +30,9 @@ except ImportError as e:
 if INSIDE_BLENDER:
   try:
     import utils
+    import occlusion
+    import layout
+    import relationships
   except ImportError as e:
     print("\nERROR")
     print("Running render_images.py from Blender and cannot import utils.py.") 
@@ -41,6 +43,14 @@ if INSIDE_BLENDER:
     print("$VERSION is your Blender version (such as 2.78).")
     sys.exit(1)
 
+# Statistics about the layouts sampled in add_random_objects and how many of
+# them were rejected by the occlusion pre-check
+layout_stats = layout.LayoutStats() if INSIDE_BLENDER else None
+occlusion_stats = occlusion.PrecheckStats() if INSIDE_BLENDER else None
+
+# Retries failed renders and records images that could not be rendered
+render_supervisor = utils.RenderSupervisor() if INSIDE_BLENDER else None
+
 parser = argparse.ArgumentParser()
 
 # Input options
@@ -78,6 +88,25 @@ parser.add_argument('--min_pixels_per_object', default=200, type=int,
     help="All objects will have at least this many visible pixels in the " +
          "final rendered images; this ensures that no objects are fully " +
          "occluded by other objects.")
+parser.add_argument('--visibility_render_scale', default=1.0, type=float,
+    help="Scale of the resolution at which the flat-shaded render used to " +
+         "check object visibility is made, relative to --width and " +
+         "--height; --min_pixels_per_object is scaled by the square of " +
+         "this value. Values below 1 make the check faster at the cost of " +
+         "accuracy for barely visible objects.")
+parser.add_argument('--visibility_from_index_pass', default=0, type=int,
+    help="Setting --visibility_from_index_pass 1 checks object visibility " +
+         "using the Cycles object index pass of the final render instead " +
+         "of a separate flat-shaded render. Default scenes are placed again " +
+         "if any object is not visible, and changed scenes are rejected. " +
+         "The visible pixel count, bounding box, and run-length encoded " +
+         "instance mask of each object are stored in the output JSON.")
+parser.add_argument('--occlusion_precheck', default=1, type=int,
+    help="Setting --occlusion_precheck 1 estimates object occlusion from " +
+         "the object bounding boxes before rendering anything, and places " +
+         "objects again if some object certainly has fewer than " +
+         "--min_pixels_per_object visible pixels. The rendered visibility " +
+         "check is still applied to layouts that pass.")
 parser.add_argument('--max_retries', default=50, type=int,
     help="The number of times to try placing an object before giving up and " +
          "re-placing all objects in the scene.")
@@ -147,6 +176,12 @@ parser.add_argument('--save_blendfiles', type=int, default=0,
          "each generated image to be stored in the directory specified by " +
          "the --output_blend_dir flag. These files are not saved by default " +
          "because they take up ~5-10MB each.")
+parser.add_argument('--store_relationships', default=1, type=int,
+    help="Setting --store_relationships 0 omits the spatial relationships " +
+         "from the output JSON scene structures and only records the " +
+         "threshold and version used to compute them; question generation " +
+         "recomputes them from the object coordinates when loading scenes. " +
+         "This makes scene files several times smaller.")
 parser.add_argument('--version', default='1.0',
     help="String to store in the \"version\" field of the generated JSON file")
 parser.add_argument('--license',
@@ -180,11 +215,38 @@ parser.add_argument('--render_min_bounces', default=8, type=int,
     help="The minimum number of bounces to use for rendering.")
 parser.add_argument('--render_max_bounces', default=8, type=int,
     help="The maximum number of bounces to use for rendering.")
+parser.add_argument('--share_materials', default=1, type=int,
+    help="Setting --share_materials 1 makes all objects with the same " +
+         "material and color share a single Blender material, so that the " +
+         "number of shaders Cycles has to compile is bounded by the number " +
+         "of material and color combinations rather than the number of " +
+         "objects. Setting --share_materials 0 creates a new material for " +
+         "every object.")
 parser.add_argument('--render_tile_size', default=256, type=int,
     help="The tile size to use for rendering. This should not affect the " +
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
          "while larger tile sizes may be optimal for GPU-based rendering.")
+parser.add_argument('--render_max_retries', default=3, type=int,
+    help="The number of times a failed render is retried, with exponential " +
+         "backoff, before the image is given up on. Images that could not " +
+         "be rendered are skipped, and the script exits with status 75 " +
+         "after rendering the rest; after out-of-memory, GPU, or I/O errors " +
+         "the script stops right away.")
+parser.add_argument('--render_retry_backoff', default=1.0, type=float,
+    help="Seconds to wait before retrying a failed render for the first " +
+         "time; the wait doubles with every further retry.")
+parser.add_argument('--failure_manifest', default=None,
+    help="Optional path of a file to which one JSON line is appended for " +
+         "each image that could not be rendered, giving its index and the " +
+         "kind of failure.")
+parser.add_argument('--change_in_place', default=1, type=int,
+    help="Setting --change_in_place 1 renders the nonsemantically and " +
+         "semantically changed scenes by changing the default scene, which " +
+         "is still loaded, in place: the camera and lamps are moved back to " +
+         "their jittered positions and only the changed object is touched. " +
+         "Setting --change_in_place 0 rebuilds each changed scene from the " +
+         "base scene file.")
 
 def main(args):
   num_digits = 6
@@ -236,6 +298,8 @@ def main(args):
     os.makedirs(args.semantic_output_scene_dir)
   if args.save_blendfiles == 1 and not os.path.isdir(args.semantic_output_blend_dir):
     os.makedirs(args.semantic_output_blend_dir)
+  utils.SHARE_MATERIALS = (args.share_materials == 1)
+  render_supervisor.configure(args)
   
   all_scene_paths = []
   all_sc_scene_paths = []
@@ -248,46 +312,61 @@ def main(args):
     if args.save_blendfiles == 1:
       default_blend_path = default_blend_template % (i + args.start_idx)
     num_objects = random.randint(args.min_objects, args.max_objects)
-
-    # Render default scene.
-    default_config = render_default_scene(args,
-      num_objects=num_objects,
-      output_index=(i + args.start_idx),
-      output_split=args.split,
-      output_image=default_img_path,
-      output_scene=default_scene_path,
-      output_blendfile=default_blend_path,
-    )
-
-    # Render non-semantically changed scene.
     nonsemantic_img_path = nonsemantic_img_template % (i + args.start_idx)
     nonsemantic_scene_path = nonsemantic_scene_template % (i + args.start_idx)
     nonsemantic_blend_path = None
     if args.save_blendfiles == 1:
       nonsemantic_blend_path = nonsemantic_blend_template % (i + args.start_idx)
-    nonsemantic_change_success = render_semantic_change(args, default_config,
-      output_index=(i + args.start_idx),
-      output_split=args.split,
-      output_image=nonsemantic_img_path,
-      output_scene=nonsemantic_scene_path,
-      output_blendfile=nonsemantic_blend_path,
-      change_type='same',
-    )
-
-    # Render semantically changed scene.
     semantic_img_path = semantic_img_template % (i + args.start_idx)
     semantic_scene_path = semantic_scene_template % (i + args.start_idx)
     semantic_blend_path = None
     if args.save_blendfiles == 1:
       semantic_blend_path = semantic_blend_template % (i + args.start_idx)
-    semantic_change_success = render_semantic_change(args, default_config,
-      output_index=(i + args.start_idx),
-      output_split=args.split,
-      output_image=semantic_img_path,
-      output_scene=semantic_scene_path,
-      output_blendfile=semantic_blend_path,
-      change_type='color',
-    )
+
+    try:
+      # Render default scene.
+      default_config = render_default_scene(args,
+        num_objects=num_objects,
+        output_index=(i + args.start_idx),
+        output_split=args.split,
+        output_image=default_img_path,
+        output_scene=default_scene_path,
+        output_blendfile=default_blend_path,
+      )
+
+      # Render non-semantically changed scene.
+      nonsemantic_change_success = render_semantic_change(args, default_config,
+        output_index=(i + args.start_idx),
+        output_split=args.split,
+        output_image=nonsemantic_img_path,
+        output_scene=nonsemantic_scene_path,
+        output_blendfile=nonsemantic_blend_path,
+        change_type='same',
+      )
+
+      # Render semantically changed scene.
+      semantic_change_success = render_semantic_change(args, default_config,
+        output_index=(i + args.start_idx),
+        output_split=args.split,
+        output_image=semantic_img_path,
+        output_scene=semantic_scene_path,
+        output_blendfile=semantic_blend_path,
+        change_type='color',
+      )
+    except utils.RenderFailed as e:
+      # Give up on this index and remove whatever was written for it
+      render_supervisor.record_error(i + args.start_idx, e, paths=[
+        default_img_path, default_scene_path, default_blend_path,
+        nonsemantic_img_path, nonsemantic_scene_path, nonsemantic_blend_path,
+        semantic_img_path, semantic_scene_path, semantic_blend_path,
+      ])
+      i += 1
+      if e.fatal:
+        # Leave the remaining images to a new worker
+        for j in range(i, args.num_images):
+          render_supervisor.record_failure(j + args.start_idx, 'skipped')
+        break
+      continue
 
     # only save stuffs when semantic and nonsemantic changes succeeded
     if semantic_change_success and nonsemantic_change_success:
@@ -362,6 +441,12 @@ def main(args):
   }
   with open(args.nonsemantic_output_scene_file, 'w') as f:
     json.dump(output, f)
+  print(layout_stats.summary())
+  if args.occlusion_precheck == 1:
+    print(occlusion_stats.summary())
+  if render_supervisor.failures:
+    print(render_supervisor.summary())
+  return render_supervisor.exit_code()
 
 
 def render_default_scene(args,
@@ -425,6 +510,12 @@ def render_default_scene(args,
     return 2.0 * L * (random.random() - 0.5)
 
   config = {}
+  # Locations of the camera and lamps before any jitter, so that the changed
+  # scenes can be rendered without reloading the base scene
+  config['base_locations'] = dict(
+      (name, tuple(bpy.data.objects[name].location))
+      for name in ['Camera', 'Lamp_Key', 'Lamp_Back', 'Lamp_Fill'])
+
   # Add random jitter to camera position
   camera_jitters = [] # need this to apply the same jitter for scenes without semantic change
   if args.camera_jitter > 0:
@@ -482,19 +573,36 @@ def render_default_scene(args,
   config['back_light_jitters'] = back_light_jitters
   config['fill_light_jitters'] = fill_light_jitters
 
-  # Now make some random objects
-  objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera)
+  # Now make some random objects and render the scene. When visibility is
+  # checked using the object index pass of the final render, objects are
+  # placed again until all of them are visible in the render.
+  while True:
+    objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera)
+    if args.visibility_from_index_pass == 1:
+      utils.enable_object_index_pass(blender_objects)
+    render_supervisor.render(write_still=True)
+    if args.visibility_from_index_pass == 0:
+      break
+    index = utils.read_object_index_pass()
+    if utils.add_object_masks(objects, index, args.min_pixels_per_object):
+      break
+    print('Some objects are occluded; replacing objects')
+    utils.delete_objects(blender_objects)
   config['objects'] = objects
+  config['blender_objects'] = blender_objects
 
-  # Render the scene and dump the scene data structure
+  # Dump the scene data structure
   scene_struct['objects'] = objects
-  scene_struct['relationships'] = compute_all_relationships(scene_struct)
-  while True:
-    try:
-      bpy.ops.render.render(write_still=True)
-      break
-    except Exception as e:
-      print(e)
+  if args.store_relationships:
+    scene_struct['relationships'] = \
+        relationships.compute_all_relationships(scene_struct)
+  else:
+    # Relationships are fully determined by the coordinates and directions,
+    # so only record how to recompute them when the scene is loaded
+    scene_struct['relationships_spec'] = {
+      'version': relationships.RELATIONSHIPS_VERSION,
+      'eps': relationships.RELATIONSHIPS_EPS,
+    }
 
   with open(output_scene, 'w') as f:
     json.dump(scene_struct, f, indent=2)
@@ -514,6 +622,72 @@ def render_semantic_change(args,
     change_type='random',
   ):
 
+  # This will give ground-truth information about the scene and its objects
+  scene_struct = {
+      'split': output_split,
+      'image_index': output_index,
+      'image_filename': os.path.basename(output_image),
+      'objects': [],
+      'directions': {},
+  }
+
+  if args.change_in_place == 1:
+    default_blend_objects = default_config['blender_objects']
+    camera = reuse_default_scene(args, default_config, output_image,
+                                 scene_struct)
+  else:
+    default_blend_objects = None
+    camera = load_default_scene(args, default_config, output_image,
+                                scene_struct)
+
+  # Now make some semantic changes to default objects
+  default_objects = default_config['objects']
+  sc_objects, sc_blend_objects, success = \
+    apply_change(default_objects, scene_struct, args, camera, change_type,
+                 default_blend_objects)
+  if not success:
+    print('Could not semantically change the given scene for change type: %s' % change_type)
+    return False
+  if args.visibility_from_index_pass == 1:
+    utils.enable_object_index_pass(sc_blend_objects)
+
+  # Render the scene and dump the scene data structure
+  scene_struct['objects'] = sc_objects
+  if args.store_relationships:
+    scene_struct['relationships'] = \
+        relationships.compute_all_relationships(scene_struct)
+  else:
+    # Relationships are fully determined by the coordinates and directions,
+    # so only record how to recompute them when the scene is loaded
+    scene_struct['relationships_spec'] = {
+      'version': relationships.RELATIONSHIPS_VERSION,
+      'eps': relationships.RELATIONSHIPS_EPS,
+    }
+  render_supervisor.render(write_still=True)
+  if args.visibility_from_index_pass == 1:
+    index = utils.read_object_index_pass()
+    if not utils.add_object_masks(sc_objects, index,
+                                  args.min_pixels_per_object):
+      print('Some objects are occluded')
+      if default_blend_objects is not None:
+        undo_change(default_objects, sc_objects, sc_blend_objects, args,
+                    change_type)
+      return False
+
+  with open(output_scene, 'w') as f:
+    json.dump(scene_struct, f, indent=2)
+
+  if output_blendfile is not None:
+    bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+
+  return True
+
+
+def load_default_scene(args, default_config, output_image, scene_struct):
+  """
+  Load the base scene again and set up the camera and lamps of the default
+  scene, with a new random jitter for the camera. Returns the camera.
+  """
   # Load the main blendfile
   bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
 
@@ -549,15 +723,6 @@ def render_semantic_change(args,
   if args.use_gpu == 1:
     bpy.context.scene.cycles.device = 'GPU'
 
-  # This will give ground-truth information about the scene and its objects
-  scene_struct = {
-      'split': output_split,
-      'image_index': output_index,
-      'image_filename': os.path.basename(output_image),
-      'objects': [],
-      'directions': {},
-  }
-
   # Put a plane on the ground so we can compute cardinal directions
   bpy.ops.mesh.primitive_plane_add(radius=5)
   plane = bpy.context.object
@@ -620,194 +785,133 @@ def render_semantic_change(args,
       rand_fill_light_jitter = rand(args.fill_light_jitter)
       bpy.data.objects['Lamp_Fill'].location[i] += rand_fill_light_jitter
   """
+  return camera
 
-  # Now make some semantic changes to default objects
-  default_objects = default_config['objects']
-  sc_objects, sc_blend_objects, success = \
-    apply_change(default_objects, scene_struct, args, camera, change_type)
-  if not success:
-    print('Could not semantically change the given scene for change type: %s' % change_type)
-    return False
 
-  # Render the scene and dump the scene data structure
-  scene_struct['objects'] = sc_objects
-  scene_struct['relationships'] = compute_all_relationships(scene_struct)
-  while True:
-    try:
-      bpy.ops.render.render(write_still=True)
-      break
-    except Exception as e:
-      print(e)
-
-  with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f, indent=2)
-
-  if output_blendfile is not None:
-    bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+def reuse_default_scene(args, default_config, output_image, scene_struct):
+  """
+  Set up the default scene, which is still loaded, for rendering a changed
+  scene: the camera and lamps are moved back to their positions in the default
+  scene using the recorded jitters, and the camera gets a new random jitter.
+  Returns the camera.
+  """
+  def rand(L):
+    return 2.0 * L * (random.random() - 0.5)
 
-  return True
+  bpy.context.scene.render.filepath = output_image
+  jitters = [
+    ('Camera', default_config['camera_jitters']),
+    ('Lamp_Key', default_config['key_light_jitters']),
+    ('Lamp_Back', default_config['back_light_jitters']),
+    ('Lamp_Fill', default_config['fill_light_jitters']),
+  ]
+  for name, jitter in jitters:
+    location = list(default_config['base_locations'][name])
+    for i in range(len(jitter)):
+      location[i] += jitter[i]
+    bpy.data.objects[name].location = location
+
+  # Randomly jitter camera from the default location
+  camera = bpy.data.objects['Camera']
+  if args.camera_jitter > 0:
+    for i in range(3):
+      camera.location[i] += rand(args.camera_jitter)
+  bpy.context.scene.update()
+  scene_struct['directions'] = utils.get_directions(camera)
+  return camera
 
 
 def add_random_objects(scene_struct, num_objects, args, camera):
   """
-  Add random objects to the current blender scene
+  Add random objects to the current blender scene. Layouts are sampled without
+  Blender (see layout.py), and objects are only added to the scene for layouts
+  that pass the occlusion pre-check; if some object turns out to be occluded
+  in the rendered visibility check then a new layout is sampled.
   """
+  properties = layout.load_catalog(args.properties_json,
+                                   args.shape_color_combos_json)
+  camera_params = utils.get_camera_params(camera)
 
-  # Load the property file
-  with open(args.properties_json, 'r') as f:
-    properties = json.load(f)
-    color_name_to_rgba = {}
-    for name, rgb in properties['colors'].items():
-      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-      color_name_to_rgba[name] = rgba
-    material_mapping = [(v, k) for k, v in properties['materials'].items()]
-    object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-    size_mapping = list(properties['sizes'].items())
-
-  shape_color_combos = None
-  if args.shape_color_combos_json is not None:
-    with open(args.shape_color_combos_json, 'r') as f:
-      shape_color_combos = list(json.load(f).items())
-
-  positions = []
-  objects = []
-  blender_objects = []
-  for i in range(num_objects):
-    # Choose a random size
-    size_name, r = random.choice(size_mapping)
-
-    # Try to place the object, ensuring that we don't intersect any existing
-    # objects and that we are more than the desired margin away from all existing
-    # objects along all cardinal directions.
-    num_tries = 0
-    while True:
-      # If we try and fail to place an object too many times, then delete all
-      # the objects in the scene and start over.
-      num_tries += 1
-      if num_tries > args.max_retries:
-        for obj in blender_objects:
-          utils.delete_object(obj)
-        return add_random_objects(scene_struct, num_objects, args, camera)
-      x = random.uniform(-3, 3)
-      y = random.uniform(-3, 3)
-      # Check to make sure the new object is further than min_dist from all
-      # other objects, and further than margin along the four cardinal directions
-      dists_good = True
-      margins_good = True
-      for (xx, yy, rr) in positions:
-        dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
-        if dist - r - rr < args.min_dist:
-          dists_good = False
-          break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
-          if 0 < margin < args.margin:
-            print(margin, args.margin, direction_name)
-            print('BROKEN MARGIN!')
-            margins_good = False
-            break
-        if not margins_good:
-          break
-
-      if dists_good and margins_good:
-        break
-
-    # Choose random color and shape
-    if shape_color_combos is None:
-      obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
-    else:
-      obj_name_out, color_choices = random.choice(shape_color_combos)
-      color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-      rgba = color_name_to_rgba[color_name]
-
-    # For cube, adjust the size a bit
-    if obj_name == 'Cube':
-      r /= math.sqrt(2)
-
-    # Choose random orientation for the object.
-    theta = 360.0 * random.random()
-
-    # Actually add the object to the scene
-    utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-    obj = bpy.context.object
-    blender_objects.append(obj)
-    positions.append((x, y, r))
+  while True:
+    object_layout = layout.sample_layout(num_objects, properties,
+        scene_struct['directions'], min_dist=args.min_dist,
+        margin=args.margin, max_retries=args.max_retries, stats=layout_stats)
+
+    # Discard layouts where some object is certainly occluded without
+    # touching the Blender scene
+    if args.occlusion_precheck == 1:
+      boxes = [(o['x'], o['y'], o['r'], o['theta']) for o in object_layout]
+      occluded = occlusion.certainly_occluded(boxes, camera_params,
+                                              args.min_pixels_per_object)
+      occlusion_stats.record(occluded)
+      if occluded:
+        print('Some objects are certainly occluded; sampling a new layout')
+        continue
 
-    # Attach a random material
-    mat_name, mat_name_out = random.choice(material_mapping)
-    utils.add_material(mat_name, Color=rgba)
-
-    # Record data about the object in the scene data structure
-    pixel_coords = utils.get_camera_coords(camera, obj.location)
-    objects.append({
-      'shape': obj_name_out,
-      'size': size_name,
-      'material': mat_name_out,
-      '3d_coords': tuple(obj.location),
-      'rotation': theta,
-      'pixel_coords': pixel_coords,
-      'color': color_name,
-    })
+    objects = []
+    blender_objects = []
+    for spec in object_layout:
+      # Actually add the object to the scene
+      obj = utils.add_object(args.shape_dir, spec['shape_file'], spec['r'],
+                             (spec['x'], spec['y']), theta=spec['theta'])
+      blender_objects.append(obj)
+
+      # Attach its material
+      utils.add_material(obj, spec['material_file'], Color=spec['rgba'])
+
+      # Record data about the object in the scene data structure
+      pixel_coords = utils.get_camera_coords(camera, obj.location)
+      objects.append({
+        'shape': spec['shape'],
+        'size': spec['size'],
+        'material': spec['material'],
+        '3d_coords': tuple(obj.location),
+        'rotation': spec['theta'],
+        'pixel_coords': pixel_coords,
+        'color': spec['color'],
+      })
+
+    # Check that all objects are at least partially visible in the rendered
+    # image; when using the object index pass this is done after the final
+    # render.
+    all_visible = True
+    if args.visibility_from_index_pass == 0:
+      all_visible = check_visibility(blender_objects,
+                                     args.min_pixels_per_object,
+                                     args.visibility_render_scale)
+    if all_visible:
+      return objects, blender_objects
 
-  # Check that all objects are at least partially visible in the rendered image
-  all_visible = check_visibility(blender_objects, args.min_pixels_per_object)
-  if not all_visible:
     # If any of the objects are fully occluded then start over; delete all
     # objects from the scene and place them all again.
     print('Some objects are occluded; replacing objects')
-    for obj in blender_objects:
-      utils.delete_object(obj)
-    return add_random_objects(scene_struct, num_objects, args, camera)
-
-  return objects, blender_objects
+    utils.delete_objects(blender_objects)
 
 
-def apply_change(default_objects, scene_struct, args, camera, change_type):
+def apply_change(default_objects, scene_struct, args, camera, change_type,
+                 default_blend_objects=None):
   """
-  Apply changes to default objects to the current blender scene.
+  Apply changes to default objects to the current blender scene. If
+  default_blend_objects is given then the default objects are still in the
+  scene and only the changed object is updated; otherwise all objects are
+  added to the scene.
   """
 
-  # Load the property file
-  with open(args.properties_json, 'r') as f:
-    properties = json.load(f)
-    color_name_to_rgba = {}
-    for name, rgb in properties['colors'].items():
-      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-      color_name_to_rgba[name] = rgba
-    material_mapping = [(v, k) for k, v in properties['materials'].items()]
-    object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-    size_mapping = list(properties['sizes'].items())
-
-  shape_color_combos = None
-  possible_shape_to_color = None
-  if args.shape_color_combos_json is not None:
-    with open(args.shape_color_combos_json, 'r') as f:
-      possible_shape_to_color = json.load(f)
-      shape_color_combos = list(possible_shape_to_color.items())
-
+  # The property file is only loaded once per process
+  properties = layout.load_catalog(args.properties_json,
+                                   args.shape_color_combos_json)
 
   def render_object(obj):
-    obj_name_out = obj['shape']
-    obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-    color_name = obj['color']
-    rgba = color_name_to_rgba[color_name]
-    size_name = obj['size']
-    r = [v for k, v in size_mapping if k == size_name][0]
-    if obj_name == 'Cube':
-      r /= math.sqrt(2)
+    obj_name = properties.shape_name_to_file[obj['shape']]
+    rgba = properties.rgba(obj['color'])
+    r = properties.radius(obj['shape'], obj['size'])
     theta = obj['rotation']
-    mat_name_out = obj['material']
-    mat_name = [k for k, v in material_mapping if v == mat_name_out][0]
+    mat_name = properties.material_name_to_file[obj['material']]
     x, y, z = obj['3d_coords']
     position = (x, y, r)
-    utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-    new_blend_obj = bpy.context.object
-    utils.add_material(mat_name, Color=rgba)
+    new_blend_obj = utils.add_object(args.shape_dir, obj_name, r, (x, y),
+                                     theta=theta)
+    utils.add_material(new_blend_obj, mat_name, Color=rgba)
     new_pixel_coords = utils.get_camera_coords(camera, new_blend_obj.location)
     return new_blend_obj, position, new_pixel_coords
 
@@ -828,8 +932,6 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
         assert direction_vec[2] == 0
         margin = dx * direction_vec[0] + dy * direction_vec[1]
         if 0 < margin < args.margin:
-          print(margin, args.margin, direction_name)
-          print('BROKEN MARGIN!')
           margins_good = False
           break
       if not margins_good:
@@ -846,15 +948,10 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
       new_obj = copy.deepcopy(obj)
       if i == object_idx:
         curr_color_name = new_obj['color']
-        obj_name_out = obj['shape']
-        if possible_shape_to_color is not None:
-          possible_color_choices = possible_shape_to_color[obj_name_out]
+        possible_color_choices = properties.allowed_colors(obj['shape'])
         while True:
-          new_color_name, new_rgba = random.choice(list(color_name_to_rgba.items()))
-          if possible_shape_to_color is not None:
-            if new_color_name != curr_color_name and new_color_name in possible_color_choices:
-              break
-          elif new_color_name != curr_color_name:
+          new_color_name = random.choice(possible_color_choices)
+          if new_color_name != curr_color_name:
             break
         new_obj['color'] = new_color_name
       new_objects.append(new_obj)
@@ -865,9 +962,9 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
       new_obj = copy.deepcopy(obj)
       if i == object_idx:
         curr_mat_name_out = new_obj['material']
-        curr_mat_name = [k for k, v in material_mapping if v == curr_mat_name_out][0]
+        curr_mat_name = properties.material_name_to_file[curr_mat_name_out]
         while True:
-          new_mat_name, new_mat_name_out = random.choice(material_mapping)
+          new_mat_name, new_mat_name_out = random.choice(properties.material_mapping)
           if new_mat_name != curr_mat_name:
             break
         new_obj['material'] = new_mat_name_out
@@ -889,19 +986,14 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
     # Need to check distance and margin
 
     # Randomly pick size
-    new_size_name, new_r = random.choice(size_mapping)
+    new_size_name, new_r = random.choice(properties.size_mapping)
 
     # Try to place the object, ensuring that we don't intersect any existing
     # objects and that we are more than the desired margin away from all existing
     # objects along all cardinal directions.
     other_positions = []
     for i, obj in enumerate(default_objects):
-      obj_name_out = obj['shape']
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-      size_name = obj['size']
-      r = [v for k, v in size_mapping if k == size_name][0]
-      if obj_name == 'Cube':
-        r /= math.sqrt(2)
+      r = properties.radius(obj['shape'], obj['size'])
       x, y, z = obj['3d_coords']
       position = (x, y, r)
       other_positions.append(position)
@@ -916,29 +1008,26 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
       new_x = random.uniform(-3, 3)
       new_y = random.uniform(-3, 3)
       this_position = (new_x, new_y, new_r) 
+      # Rejected positions show up in the layout summary printed at the end
+      layout_stats.num_candidates += 1
       success = check_dist_margin(this_position, other_positions)
       if success:
         break
     
     # Choose random color and shape
-    if shape_color_combos is None:
-      new_obj_name, new_obj_name_out = random.choice(object_mapping)
-      new_color_name, new_rgba = random.choice(list(color_name_to_rgba.items()))
+    if properties.shape_color_combos is None:
+      new_obj_name, new_obj_name_out = random.choice(properties.object_mapping)
+      new_color_name = random.choice(properties.color_names)
     else:
-      new_obj_name_out, color_choices = random.choice(shape_color_combos)
+      new_obj_name_out, color_choices = random.choice(
+          properties.shape_color_combos)
       new_color_name = random.choice(color_choices)
-      new_obj_name = [k for k, v in object_mapping if v == new_obj_name_out][0]
-      new_rgba = color_name_to_rgba[new_color_name]
-
-    # For cube, adjust the size a bit
-    if new_obj_name == 'Cube':
-      new_r /= math.sqrt(2)
 
     # Choose random orientation for the object.
     new_theta = 360.0 * random.random()
 
     # Attach a random material
-    new_mat_name, new_mat_name_out = random.choice(material_mapping)
+    new_mat_name, new_mat_name_out = random.choice(properties.material_mapping)
 
     new_objects.append({
       'shape': new_obj_name_out,
@@ -963,81 +1052,108 @@ def apply_change(default_objects, scene_struct, args, camera, change_type):
       new_obj = copy.deepcopy(obj)
       new_objects.append(new_obj)
 
-  new_num_objects = len(new_objects)
-  new_positions = []
-  new_blend_objects = []
-  for obj in new_objects:
-    new_blend_object, new_position, new_pixel_coords = render_object(obj)
-    new_blend_objects.append(new_blend_object)
-    new_positions.append(new_position)
-    obj['pixel_coords'] = new_pixel_coords
-
-  # Check that all objects are at least partially visible in the rendered image
-  all_visible = check_visibility(new_blend_objects, args.min_pixels_per_object)
+  if default_blend_objects is None:
+    new_num_objects = len(new_objects)
+    new_positions = []
+    new_blend_objects = []
+    for obj in new_objects:
+      new_blend_object, new_position, new_pixel_coords = render_object(obj)
+      new_blend_objects.append(new_blend_object)
+      new_positions.append(new_position)
+      obj['pixel_coords'] = new_pixel_coords
+  else:
+    # Only touch the changed object; the camera has moved, so the pixel
+    # coordinates of all objects are updated
+    new_blend_objects = list(default_blend_objects)
+    if change_type in ('color', 'material'):
+      obj = new_objects[object_idx]
+      utils.change_material(new_blend_objects[object_idx],
+                            properties.material_name_to_file[obj['material']],
+                            Color=properties.rgba(obj['color']))
+    elif change_type == 'drop':
+      # A dropped object cannot be restored, so it is removed from the
+      # default scene as well rather than left behind as a deleted object
+      utils.delete_object(new_blend_objects.pop(object_idx))
+      del default_blend_objects[object_idx]
+      del default_objects[object_idx]
+    elif change_type == 'add':
+      new_blend_objects.append(render_object(new_objects[-1])[0])
+    for obj, blend_obj in zip(new_objects, new_blend_objects):
+      obj['pixel_coords'] = utils.get_camera_coords(camera, blend_obj.location)
+
+  # Check that all objects are at least partially visible in the rendered image;
+  # when using the object index pass this is done after the final render.
+  all_visible = True
+  if args.visibility_from_index_pass == 0:
+    all_visible = check_visibility(new_blend_objects,
+                                   args.min_pixels_per_object,
+                                   args.visibility_render_scale)
   if not all_visible:
     # If any of the objects are fully occluded, delete all and skip this one.
     print('Some objects are occluded')
-    for obj in new_blend_objects:
-      utils.delete_object(obj)
+    if default_blend_objects is None:
+      for obj in new_blend_objects:
+        utils.delete_object(obj)
+    else:
+      undo_change(default_objects, new_objects, new_blend_objects, args,
+                  change_type)
     return None, None, False
 
   return new_objects, new_blend_objects, True
 
 
-def compute_all_relationships(scene_struct, eps=0.2):
+def undo_change(default_objects, new_objects, new_blend_objects, args,
+                change_type):
   """
-  Computes relationships between all pairs of objects in the scene.
-  
-  Returns a dictionary mapping string relationship names to lists of lists of
-  integers, where output[rel][i] gives a list of object indices that have the
-  relationship rel with object i. For example if j is in output['left'][i] then
-  object j is left of object i.
+  Undo a change that apply_change made to the default scene in place, so that
+  the default objects are left as they were for the next change of this scene:
+  an added object is deleted and a changed material is changed back. A dropped
+  object cannot be restored; apply_change removes it from the default objects.
   """
-  all_relationships = {}
-  for name, direction_vec in scene_struct['directions'].items():
-    if name == 'above' or name == 'below': continue
-    all_relationships[name] = []
-    for i, obj1 in enumerate(scene_struct['objects']):
-      coords1 = obj1['3d_coords']
-      related = set()
-      for j, obj2 in enumerate(scene_struct['objects']):
-        if obj1 == obj2: continue
-        coords2 = obj2['3d_coords']
-        diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-        dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-        if dot > eps:
-          related.add(j)
-      all_relationships[name].append(sorted(list(related)))
-  return all_relationships
-
-
-def check_visibility(blender_objects, min_pixels_per_object):
+  properties = layout.load_catalog(args.properties_json,
+                                   args.shape_color_combos_json)
+  if change_type == 'add':
+    utils.delete_object(new_blend_objects[-1])
+  elif change_type in ('color', 'material'):
+    for obj, new_obj, blend_obj in zip(default_objects, new_objects,
+                                       new_blend_objects):
+      if (obj['color'] != new_obj['color']
+          or obj['material'] != new_obj['material']):
+        utils.change_material(blend_obj,
+                              properties.material_name_to_file[obj['material']],
+                              Color=properties.rgba(obj['color']))
+
+
+def check_visibility(blender_objects, min_pixels_per_object, render_scale=1.0):
   """
   Check whether all objects in the scene have some minimum number of visible
   pixels; to accomplish this we assign random (but distinct) colors to all
   objects, and render using no lighting or shading or antialiasing; this
   ensures that each object is just a solid uniform color. We can then count
   the number of pixels of each color in the output image to check the visibility
-  of each object.
+  of each object. The flat render is made at render_scale times the output
+  resolution, and min_pixels_per_object is scaled to match.
 
   Returns True if all objects are visible and False otherwise.
   """
   f, path = tempfile.mkstemp(suffix='.png')
-  object_colors = render_shadeless(blender_objects, path=path)
+  os.close(f)
+  object_colors = render_shadeless(blender_objects, path=path,
+                                   render_scale=render_scale)
   img = bpy.data.images.load(path)
-  p = list(img.pixels)
-  color_count = Counter((p[i], p[i+1], p[i+2], p[i+3])
-                        for i in range(0, len(p), 4))
+  color_counts = utils.count_colors(img)
+  bpy.data.images.remove(img)
   os.remove(path)
-  if len(color_count) != len(blender_objects) + 1:
+  if len(color_counts) != len(blender_objects) + 1:
     return False
-  for _, count in color_count.most_common():
-    if count < min_pixels_per_object:
+  min_pixels = min_pixels_per_object * render_scale ** 2
+  for count in color_counts:
+    if count < min_pixels:
       return False
   return True
 
 
-def render_shadeless(blender_objects, path='flat.png'):
+def render_shadeless(blender_objects, path='flat.png', render_scale=1.0):
   """
   Render a version of the scene with shading disabled and unique materials
   assigned to all objects, and return a set of all colors that should be in the
@@ -1050,11 +1166,14 @@ def render_shadeless(blender_objects, path='flat.png'):
   old_filepath = render_args.filepath
   old_engine = render_args.engine
   old_use_antialiasing = render_args.use_antialiasing
+  old_resolution_percentage = render_args.resolution_percentage
 
   # Override some render settings to have flat shading
   render_args.filepath = path
   render_args.engine = 'BLENDER_RENDER'
   render_args.use_antialiasing = False
+  render_args.resolution_percentage = max(1, int(round(
+      old_resolution_percentage * render_scale)))
 
   # Move the lights and ground to layer 2 so they don't render
   utils.set_layer(bpy.data.objects['Lamp_Key'], 2)
@@ -1066,7 +1185,7 @@ def render_shadeless(blender_objects, path='flat.png'):
   object_colors = set()
   old_materials = []
   for i, obj in enumerate(blender_objects):
-    old_materials.append(obj.data.materials[0])
+    old_materials.append(obj.material_slots[0].material)
     bpy.ops.material.new()
     mat = bpy.data.materials['Material']
     mat.name = 'Material_%d' % i
@@ -1076,14 +1195,14 @@ def render_shadeless(blender_objects, path='flat.png'):
     object_colors.add((r, g, b))
     mat.diffuse_color = [r, g, b]
     mat.use_shadeless = True
-    obj.data.materials[0] = mat
+    obj.material_slots[0].material = mat
 
   # Render the scene
   bpy.ops.render.render(write_still=True)
 
   # Undo the above; first restore the materials to objects
   for mat, obj in zip(old_materials, blender_objects):
-    obj.data.materials[0] = mat
+    obj.material_slots[0].material = mat
 
   # Move the lights and ground back to layer 0
   utils.set_layer(bpy.data.objects['Lamp_Key'], 0)
@@ -1095,6 +1214,7 @@ def render_shadeless(blender_objects, path='flat.png'):
   render_args.filepath = old_filepath
   render_args.engine = old_engine
   render_args.use_antialiasing = old_use_antialiasing
+  render_args.resolution_percentage = old_resolution_percentage
 
   return object_colors
 
@@ -1104,7 +1224,7 @@ if __name__ == '__main__':
     # Run normally
     argv = utils.extract_args()
     args = parser.parse_args(argv)
-    main(args)
+    sys.exit(main(args))
   elif '--help' in sys.argv or '-h' in sys.argv:
     parser.print_help()
   else:
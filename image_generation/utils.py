@@ -5,8 +5,9 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
-import sys, random, os
+import sys, random, os, json, time
 import bpy, bpy_extras
+from mathutils import Vector
 
 
 """
@@ -33,13 +34,15 @@ def parse_args(parser, argv=None):
   return parser.parse_args(extract_args(argv))
 
 
-# I wonder if there's a better way to do this?
 def delete_object(obj):
   """ Delete a specified blender object """
-  for o in bpy.data.objects:
-    o.select = False
-  obj.select = True
-  bpy.ops.object.delete()
+  bpy.data.objects.remove(obj, do_unlink=True)
+
+
+def delete_objects(objs):
+  """ Delete several blender objects """
+  for obj in list(objs):
+    bpy.data.objects.remove(obj, do_unlink=True)
 
 
 def get_camera_coords(cam, pos):
@@ -65,6 +68,159 @@ def get_camera_coords(cam, pos):
   return (px, py, z)
 
 
+def count_colors(img):
+  """
+  Count the number of pixels of each distinct color in a Blender image.
+  Returns a numpy array of counts, one per distinct color.
+  """
+  import numpy as np
+  pixels = np.empty(len(img.pixels), dtype=np.float32)
+  try:
+    img.pixels.foreach_get(pixels)
+  except AttributeError:
+    # Older versions of Blender do not support foreach_get on image pixels
+    pixels[:] = img.pixels[:]
+  # Images loaded from PNG files have 8 bits per channel, so pack each RGBA
+  # color into a single integer
+  rgba = np.round(pixels.reshape(-1, 4) * 255).astype(np.uint32)
+  packed = ((rgba[:, 0] << 24) | (rgba[:, 1] << 16) |
+            (rgba[:, 2] << 8) | rgba[:, 3])
+  _, counts = np.unique(packed, return_counts=True)
+  return counts
+
+
+def enable_object_index_pass(blender_objects):
+  """
+  Give each object a distinct pass index (starting from 1; the background is
+  0) and enable the Cycles object index pass. The pass is routed through the
+  compositor to a viewer node so that it can be read back with
+  read_object_index_pass after rendering; the rendered image itself is passed
+  through unchanged.
+  """
+  scene = bpy.context.scene
+  for i, obj in enumerate(blender_objects):
+    obj.pass_index = i + 1
+  scene.render.layers[0].use_pass_object_index = True
+  scene.use_nodes = True
+  tree = scene.node_tree
+
+  def find_node(node_type, bl_idname):
+    for node in tree.nodes:
+      if node.type == node_type:
+        return node
+    return tree.nodes.new(bl_idname)
+
+  layers_node = find_node('R_LAYERS', 'CompositorNodeRLayers')
+  composite_node = find_node('COMPOSITE', 'CompositorNodeComposite')
+  viewer_node = find_node('VIEWER', 'CompositorNodeViewer')
+  tree.links.new(layers_node.outputs['Image'], composite_node.inputs['Image'])
+  tree.links.new(layers_node.outputs['IndexOB'], viewer_node.inputs['Image'])
+
+
+def read_object_index_pass():
+  """
+  Read the object index pass of the last render (see enable_object_index_pass)
+  as a numpy array of shape (height, width) whose first row is the top of the
+  image.
+  """
+  import numpy as np
+  img = bpy.data.images['Viewer Node']
+  w, h = img.size
+  pixels = np.empty(w * h * 4, dtype=np.float32)
+  try:
+    img.pixels.foreach_get(pixels)
+  except AttributeError:
+    pixels[:] = img.pixels[:]
+  index = np.round(pixels[0::4]).astype(np.int32).reshape(h, w)
+  return index[::-1]
+
+
+def encode_mask(mask):
+  """
+  Run-length encode a boolean mask in the uncompressed COCO format: counts
+  alternate between runs of zeros and ones over the mask in column-major
+  order, starting with zeros.
+  """
+  import numpy as np
+  flat = mask.flatten(order='F').astype(np.int8)
+  changes = np.nonzero(np.diff(flat))[0] + 1
+  bounds = np.concatenate([[0], changes, [flat.size]])
+  counts = np.diff(bounds).tolist()
+  if flat.size > 0 and flat[0] == 1:
+    counts = [0] + counts
+  return {'size': list(mask.shape), 'counts': counts}
+
+
+def add_object_masks(objects, index, min_pixels_per_object):
+  """
+  Record the visible pixel count, 2D bounding box [x, y, width, height] and
+  run-length encoded instance mask of each object in the objects list (in the
+  same order that was passed to enable_object_index_pass) using an object
+  index image from read_object_index_pass.
+
+  Returns True if every object has at least min_pixels_per_object visible
+  pixels.
+  """
+  import numpy as np
+  counts = np.bincount(index.ravel(), minlength=len(objects) + 1)
+  all_visible = True
+  for i, obj in enumerate(objects):
+    mask = (index == i + 1)
+    obj['pixel_count'] = int(counts[i + 1])
+    if counts[i + 1] > 0:
+      ys = np.nonzero(mask.any(axis=1))[0]
+      xs = np.nonzero(mask.any(axis=0))[0]
+      obj['bbox'] = [int(xs[0]), int(ys[0]), int(xs[-1] - xs[0] + 1),
+                     int(ys[-1] - ys[0] + 1)]
+    else:
+      obj['bbox'] = [0, 0, 0, 0]
+    obj['mask'] = encode_mask(mask)
+    if counts[i + 1] < min_pixels_per_object:
+      all_visible = False
+  return all_visible
+
+
+def get_camera_params(cam):
+  """
+  Get the parameters of a perspective camera that are needed to project points
+  without Blender (see occlusion.py); this mirrors the projection done by
+  bpy_extras.object_utils.world_to_camera_view.
+  """
+  scene = bpy.context.scene
+  world_to_camera = cam.matrix_world.normalized().inverted()
+  frame = [-v for v in cam.data.view_frame(scene=scene)[:3]]
+  frame = [v / v.z for v in frame]
+  scale = scene.render.resolution_percentage / 100.0
+  return {
+    'world_to_camera': [list(row) for row in world_to_camera],
+    'frame': [frame[1].x, frame[2].x, frame[0].y, frame[1].y],
+    'width': int(scale * scene.render.resolution_x),
+    'height': int(scale * scene.render.resolution_y),
+  }
+
+
+def get_directions(cam):
+  """
+  Compute the six axis-aligned directions (behind, front, left, right, above,
+  below) along the ground plane from the perspective of the camera.
+  """
+  plane_normal = Vector((0, 0, 1))
+  cam_behind = cam.matrix_world.to_quaternion() * Vector((0, 0, -1))
+  cam_left = cam.matrix_world.to_quaternion() * Vector((-1, 0, 0))
+  cam_up = cam.matrix_world.to_quaternion() * Vector((0, 1, 0))
+  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
+  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
+  plane_up = cam_up.project(plane_normal).normalized()
+  return {
+    'behind': tuple(plane_behind),
+    'front': tuple(-plane_behind),
+    'left': tuple(plane_left),
+    'right': tuple(-plane_left),
+    'above': tuple(plane_up),
+    'below': tuple(-plane_up),
+  }
+
+
 def set_layer(obj, layer_idx):
   """ Move an object to a particular layer """
   # Set the target layer to True first because an object must always be on
@@ -74,16 +230,47 @@ def set_layer(obj, layer_idx):
     obj.layers[i] = (i == layer_idx)
 
 
+def load_shape(object_dir, name):
+  """
+  Return a template object for the shape "$name", loading it from
+  object_dir/$name.blend the first time it is requested in the current
+  file. The template is not linked to the scene, so it is never rendered; it
+  is renamed so that it is not counted by add_object, and its material slot is
+  linked to the object rather than the mesh so that copies sharing its mesh
+  can each have their own material.
+  """
+  template_name = 'template_%s' % name
+  template = bpy.data.objects.get(template_name)
+  if template is not None:
+    return template
+
+  filepath = os.path.join(object_dir, '%s.blend' % name)
+  with bpy.data.libraries.load(filepath) as (data_from, data_to):
+    data_to.objects = [name]
+  template = data_to.objects[0]
+  template.name = template_name
+  template.use_fake_user = True
+  if len(template.data.materials) == 0:
+    template.data.materials.append(None)
+  template.material_slots[0].link = 'OBJECT'
+  return template
+
+
 def add_object(object_dir, name, scale, loc, theta=0):
   """
-  Load an object from a file. We assume that in the directory object_dir, there
-  is a file named "$name.blend" which contains a single object named "$name"
-  that has unit size and is centered at the origin.
+  Add a copy of an object to the scene. We assume that in the directory
+  object_dir, there is a file named "$name.blend" which contains a single object
+  named "$name" that has unit size and is centered at the origin. The file is
+  only read once (see load_shape); every copy shares the same mesh.
 
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
+
+  Returns the new object.
   """
+  template = load_shape(object_dir, name)
+
   # First figure out how many of this object are already in the scene so we can
   # give the new object a unique name
   count = 0
@@ -91,19 +278,17 @@ def add_object(object_dir, name, scale, loc, theta=0):
     if obj.name.startswith(name):
       count += 1
 
-  filename = os.path.join(object_dir, '%s.blend' % name, 'Object', name)
-  bpy.ops.wm.append(filename=filename)
+  # Copy the template; this copies the object but not its mesh
+  obj = template.copy()
+  obj.name = '%s_%d' % (name, count)
+  bpy.context.scene.objects.link(obj)
 
-  # Give it a new name to avoid conflicts
-  new_name = '%s_%d' % (name, count)
-  bpy.data.objects[name].name = new_name
-
-  # Set the new object as active, then rotate, scale, and translate it
+  # Rotate, scale, and translate the new object
   x, y = loc
-  bpy.context.scene.objects.active = bpy.data.objects[new_name]
-  bpy.context.object.rotation_euler[2] = theta
-  bpy.ops.transform.resize(value=(scale, scale, scale))
-  bpy.ops.transform.translate(value=(x, y, scale))
+  obj.rotation_euler[2] = theta
+  obj.scale = template.scale * scale
+  obj.location = template.location + Vector((x, y, scale))
+  return obj
 
 
 def load_materials(material_dir):
@@ -115,33 +300,361 @@ def load_materials(material_dir):
   for fn in os.listdir(material_dir):
     if not fn.endswith('.blend'): continue
     name = os.path.splitext(fn)[0]
-    filepath = os.path.join(material_dir, fn, 'NodeTree', name)
-    bpy.ops.wm.append(filename=filepath)
+    filepath = os.path.join(material_dir, fn)
+    with bpy.data.libraries.load(filepath) as (data_from, data_to):
+      data_to.node_groups = [name]
+
 
+# Kinds of datablocks that SceneSession.purge_orphans cleans up
+PURGEABLE_DATA = ['meshes', 'materials', 'textures', 'images', 'node_groups']
 
-def add_material(name, **properties):
+
+class SceneSession(object):
   """
-  Create a new material and assign it to the active object. "name" should be the
-  name of a material that has been previously loaded using load_materials.
+  Keeps a single base scene loaded across many renders. The base scene and
+  materials are loaded once; the transforms of the named objects (typically
+  the camera and lamps) are snapshotted so that they can be restored after
+  being jittered, and reset() removes every object and material that was added
+  since the snapshot (other than materials shared by add_material) so that the
+  next scene starts from the base scene again.
+
+  Data that is no longer used by anything (meshes of deleted objects, images
+  loaded for visibility checks, etc.) is purged every purge_every resets so
+  that memory use stays flat over long runs.
   """
-  # Figure out how many materials are already in the scene
-  mat_count = len(bpy.data.materials)
+  def __init__(self, base_scene_blendfile, material_dir, object_names=(),
+               purge_every=10):
+    bpy.ops.wm.open_mainfile(filepath=base_scene_blendfile)
+    load_materials(material_dir)
+    self.purge_every = purge_every
+    self.num_resets = 0
+    self.transforms = {}
+    for name in object_names:
+      obj = bpy.data.objects[name]
+      self.transforms[name] = (obj.location.copy(),
+                               obj.rotation_euler.copy(),
+                               obj.scale.copy())
+    self.base_objects = set(o.name for o in bpy.context.scene.objects)
+    self.base_materials = set(m.name for m in bpy.data.materials)
+    self.base_data = {}
+    for collection in PURGEABLE_DATA:
+      self.base_data[collection] = set(d.name for d in
+                                       getattr(bpy.data, collection))
+
+  def reset(self):
+    """ Restore the base scene in place """
+    scene = bpy.context.scene
+    for obj in list(scene.objects):
+      if obj.name not in self.base_objects:
+        bpy.data.objects.remove(obj, do_unlink=True)
+    for mat in list(bpy.data.materials):
+      # Materials shared by add_material are kept for the next scene
+      if mat.name not in self.base_materials and 'pool_key' not in mat:
+        bpy.data.materials.remove(mat, do_unlink=True)
+    for name, (loc, rot, scale) in self.transforms.items():
+      obj = bpy.data.objects[name]
+      obj.location = loc
+      obj.rotation_euler = rot
+      obj.scale = scale
+    self.num_resets += 1
+    if self.purge_every > 0 and self.num_resets % self.purge_every == 0:
+      self.purge_orphans()
+
+  def purge_orphans(self):
+    """ Remove added datablocks that have no remaining users """
+    for collection in PURGEABLE_DATA:
+      data = getattr(bpy.data, collection)
+      base = self.base_data[collection]
+      for d in list(data):
+        if d.users == 0 and d.name not in base:
+          data.remove(d)
+
+
+# Exit status of a render script when some images could not be rendered, so
+# that whatever runs the script can tell this apart from a crash; the images
+# are listed in the failure manifest and can be rendered again by a new worker
+EXIT_RENDER_FAILED = 75
+
+# Substrings of render error messages for each kind of failure; failures that
+# match none of these are classified as 'render'
+FAILURE_PATTERNS = [
+  ('device', ['out of memory', 'cuda', 'opencl', 'gpu']),
+  ('io', ['no space left', 'permission denied', 'read-only file system',
+          'cannot write', "can't write", 'cannot open', "can't open"]),
+]
+
+# After a failure of one of these kinds the worker stops instead of moving on
+# to the next image, since the next image would most likely fail the same way
+FATAL_FAILURES = ['device', 'io']
+
+
+def classify_render_failure(error):
+  """ Classify a render error as 'device', 'io', or 'render' """
+  message = str(error).lower()
+  for kind, patterns in FAILURE_PATTERNS:
+    if any(pattern in message for pattern in patterns):
+      return kind
+  return 'render'
+
+
+class RenderFailed(Exception):
+  """ Raised by RenderSupervisor.render when it gives up on an image """
+  def __init__(self, kind, message, attempts):
+    super(RenderFailed, self).__init__('%s failure after %d attempts: %s'
+                                       % (kind, attempts, message))
+    self.kind = kind
+    self.message = message
+    self.attempts = attempts
+    self.fatal = kind in FATAL_FAILURES
+
+
+class RenderSupervisor(object):
+  """
+  Renders the current scene, retrying failed renders up to max_retries times
+  with exponential backoff starting at backoff seconds; I/O failures are not
+  retried. Images that could not be rendered are recorded with
+  record_failure, which appends one JSON line per image to the failure
+  manifest (if any), and exit_code gives the status the script should exit
+  with.
+  """
+  def __init__(self, max_retries=3, backoff=1.0, failure_manifest=None):
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.failure_manifest = failure_manifest
+    self.failures = []
+
+  def configure(self, args):
+    self.max_retries = args.render_max_retries
+    self.backoff = args.render_retry_backoff
+    self.failure_manifest = args.failure_manifest
+
+  def render(self, **kwargs):
+    attempts = 0
+    while True:
+      try:
+        bpy.ops.render.render(**kwargs)
+        return
+      except Exception as e:
+        attempts += 1
+        kind = classify_render_failure(e)
+        print('Render failed (%s, attempt %d): %s' % (kind, attempts, e))
+        if kind == 'io' or attempts > self.max_retries:
+          raise RenderFailed(kind, str(e), attempts)
+        time.sleep(self.backoff * 2 ** (attempts - 1))
+
+  def record_failure(self, index, kind, message='', attempts=0, paths=()):
+    """
+    Record that image index could not be rendered and remove whatever was
+    already written to paths for it.
+    """
+    for path in paths:
+      if path is not None and os.path.isfile(path):
+        os.remove(path)
+    failure = {
+      'index': index,
+      'kind': kind,
+      'message': message,
+      'attempts': attempts,
+    }
+    self.failures.append(failure)
+    if self.failure_manifest is not None:
+      with open(self.failure_manifest, 'a') as f:
+        f.write(json.dumps(failure) + '\n')
+
+  def record_error(self, index, error, paths=()):
+    """ Record a RenderFailed error for image index """
+    self.record_failure(index, error.kind, error.message, error.attempts,
+                        paths)
+
+  def exit_code(self):
+    # Plans with occluded objects fail the same way every time, so they are
+    # not a reason to run the worker again
+    if any(f['kind'] != 'occluded' for f in self.failures):
+      return EXIT_RENDER_FAILED
+    return 0
+
+  def summary(self):
+    return 'Failed to render %d images' % len(self.failures)
+
+
+# Prefix of the result lines that serve writes to stdout, since everything
+# that Blender prints goes there as well
+RESULT_PREFIX = 'CLEVR_RESULT '
+
+
+def _serve_stream(reader, writer, handle_job, prefix=''):
+  # Handle the jobs from one stream; returns True if serving should stop
+  for line in iter(reader.readline, ''):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      job = json.loads(line)
+    except ValueError as e:
+      job, result = {}, {'status': 'error', 'message': 'Invalid job: %s' % e}
+    else:
+      if job.get('command') == 'stop':
+        return True
+      try:
+        result = handle_job(job)
+      except Exception as e:
+        result = {'status': 'error', 'message': str(e)}
+    if 'id' in job:
+      result['id'] = job['id']
+    writer.write(prefix + json.dumps(result) + '\n')
+    writer.flush()
+    if result.get('fatal', False):
+      return True
+  return False
+
+
+def serve(address, handle_job):
+  """
+  Keep handling jobs until told to stop. Jobs are JSON objects, one per line,
+  and handle_job returns a dict that is written back as one JSON line; the
+  'id' of the job, if any, is copied to its result.
+
+  If address is '-' then jobs are read from stdin until it is closed, and
+  results are written to stdout prefixed with RESULT_PREFIX. Otherwise
+  address is the path of a Unix socket to listen on; clients are served one at
+  a time. Serving stops after a job {"command": "stop"} or a result with
+  'fatal' set.
+  """
+  if address == '-':
+    _serve_stream(sys.stdin, sys.stdout, handle_job, RESULT_PREFIX)
+    return
+
+  import socket
+  if os.path.exists(address):
+    os.remove(address)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(address)
+  server.listen(1)
+  try:
+    stop = False
+    while not stop:
+      conn, _ = server.accept()
+      reader, writer = conn.makefile('r'), conn.makefile('w')
+      try:
+        stop = _serve_stream(reader, writer, handle_job)
+      finally:
+        reader.close()
+        writer.close()
+        conn.close()
+  finally:
+    server.close()
+    os.remove(address)
+
+
+# Whether add_material reuses materials with the same type and properties
+SHARE_MATERIALS = True
+
+# Maps material keys (see _material_key) to the names of pooled materials
+_material_pool = {}
+
+
+def _material_key(name, properties):
+  items = []
+  for k, v in sorted(properties.items()):
+    if isinstance(v, (list, tuple)):
+      v = tuple(v)
+    items.append((k, v))
+  return repr((name, tuple(items)))
+
+
+def _pooled_material(key):
+  # Materials are looked up by name since they may have been removed (for
+  # example by SceneSession.reset or when a new file is opened); the key
+  # stored on the material guards against its name having been reused.
+  mat_name = _material_pool.get(key)
+  if mat_name is None:
+    return None
+  mat = bpy.data.materials.get(mat_name)
+  if mat is None or mat.get('pool_key') != key:
+    del _material_pool[key]
+    return None
+  return mat
+
+
+def _get_material(name, properties):
+  # A pooled material for name and properties, or a new one
+  key = _material_key(name, properties)
+  mat = _pooled_material(key) if SHARE_MATERIALS else None
+  if mat is None:
+    mat = new_material(name, **properties)
+    if SHARE_MATERIALS:
+      mat['pool_key'] = key
+      mat.use_fake_user = True
+      _material_pool[key] = mat.name
+  return mat
+
+
+def add_material(obj, name, **properties):
+  """
+  Assign a material to an object. "name" should be the name of a material
+  that has been previously loaded using load_materials.
+
+  If SHARE_MATERIALS is True then all objects with the same material name and
+  properties share a single material, so the number of distinct shaders in a
+  scene is bounded by the number of material and color combinations rather
+  than the number of objects; otherwise a new material is created for every
+  object.
+  """
+  mat = _get_material(name, properties)
 
-  # Create a new material; it is not attached to anything and
-  # it will be called "Material"
-  bpy.ops.material.new()
+  # Attach the material to the object
+  # Make sure it doesn't already have materials
+  if len(obj.material_slots) > 0 and obj.material_slots[0].link == 'OBJECT':
+    # Objects added with add_object share their mesh, so the material is
+    # attached to the object itself
+    assert obj.material_slots[0].material is None
+    obj.material_slots[0].material = mat
+  else:
+    assert len(obj.data.materials) == 0
+    obj.data.materials.append(mat)
 
-  # Get a reference to the material we just created and rename it;
-  # then the next time we make a new material it will still be called
-  # "Material" and we will still be able to look it up by name
-  mat = bpy.data.materials['Material']
-  mat.name = 'Material_%d' % mat_count
 
-  # Attach the new material to the active object
-  # Make sure it doesn't already have materials
-  obj = bpy.context.active_object
-  assert len(obj.data.materials) == 0
-  obj.data.materials.append(mat)
+def change_material(obj, name, **properties):
+  """
+  Change the material of an object that was given one with add_material.
+  Shared materials are never modified, since other objects may use them;
+  instead the object is switched to the shared material for the new name and
+  properties. A material used only by this object is patched in place by
+  pointing its group node at the node group "name" and setting its inputs.
+  """
+  slot = obj.material_slots[0]
+  mat = slot.material
+  if SHARE_MATERIALS or 'pool_key' in mat:
+    slot.material = _get_material(name, properties)
+    return
+
+  output_node, group_node = None, None
+  for n in mat.node_tree.nodes:
+    if n.name == 'Material Output':
+      output_node = n
+    elif n.type == 'GROUP':
+      group_node = n
+  group_node.node_tree = bpy.data.node_groups[name]
+  for inp in group_node.inputs:
+    if inp.name in properties:
+      inp.default_value = properties[inp.name]
+  mat.node_tree.links.new(
+      group_node.outputs['Shader'],
+      output_node.inputs['Surface'],
+  )
+
+
+def new_material(name, **properties):
+  """
+  Create a new material using the node group "name", setting the inputs of the
+  node group from properties. The material is not attached to anything.
+  """
+  # Figure out how many materials are already in the scene
+  mat_count = len(bpy.data.materials)
+
+  # Create a new material with the default node tree
+  mat = bpy.data.materials.new('Material_%d' % mat_count)
+  mat.use_nodes = True
 
   # Find the output node of the new material
   output_node = None
@@ -169,4 +682,4 @@ def add_material(name, **properties):
       group_node.outputs['Shader'],
       output_node.inputs['Surface'],
   )
-
+  return mat
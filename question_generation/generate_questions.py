@@ -6,7 +6,8 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import argparse, json, os, itertools, random, shutil
+import argparse, json, os, itertools, random, shutil, sys
+import resource
 import time
 import re
 
@@ -47,7 +48,7 @@ parser = argparse.ArgumentParser()
 # Inputs
 parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py, or a .bin file converted by scene_store.py")
 parser.add_argument('--metadata_file', default='metadata.json',
     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='synonyms.json',
@@ -59,6 +60,22 @@ parser.add_argument('--template_dir', default='CLEVR_1.0_templates',
 parser.add_argument('--output_questions_file',
     default='../output/CLEVR_questions.json',
     help="The output file to write containing generated questions")
+parser.add_argument('--output_format', default='json',
+    choices=['json', 'npy', 'both'],
+    help="Format for the generated questions. \"npy\" writes token-id arrays " +
+         "for question text and prefix-serialized programs, plus answer ids, " +
+         "as .npy files in --output_encoded_dir that can be memory-mapped; " +
+         "\"both\" writes the JSON file as well.")
+parser.add_argument('--output_encoded_dir',
+    default='../output/CLEVR_questions_encoded',
+    help="Directory where encoded .npy arrays are written when " +
+         "--output_format is npy or both. Use one directory per shard.")
+parser.add_argument('--input_vocab_json', default=None,
+    help="Optional vocabulary file to encode questions with; by default the " +
+         "vocabulary is built from the metadata, templates and synonyms, " +
+         "which gives the same token ids for every shard.")
+parser.add_argument('--output_vocab_json', default='../output/CLEVR_vocab.json',
+    help="Where to write the vocabulary used for encoded output")
 
 # Control which and how many images to process
 parser.add_argument('--scene_start_idx', default=0, type=int,
@@ -126,19 +143,20 @@ def precompute_filter_options(scene_struct, metadata):
           attribute_map[masked_key] = set()
         attribute_map[masked_key].add(object_idx)
 
-  scene_struct['_filter_options'] = attribute_map
+  qeng.get_scene_cache(scene_struct)['_filter_options'] = attribute_map
 
 
 def find_filter_options(object_idxs, scene_struct, metadata):
   # Keys are tuples (size, color, shape, material) (where some may be None)
   # and values are lists of object idxs that match the filter criterion
 
-  if '_filter_options' not in scene_struct:
+  scene_cache = qeng.get_scene_cache(scene_struct)
+  if '_filter_options' not in scene_cache:
     precompute_filter_options(scene_struct, metadata)
 
   attribute_map = {}
   object_idxs = set(object_idxs)
-  for k, vs in scene_struct['_filter_options'].items():
+  for k, vs in scene_cache['_filter_options'].items():
     attribute_map[k] = sorted(list(object_idxs & vs))
   return attribute_map
 
@@ -165,7 +183,8 @@ def add_empty_filter_options(attribute_map, metadata, num_to_add):
 def find_relate_filter_options(object_idx, scene_struct, metadata,
     unique=False, include_zero=False, trivial_frac=0.1):
   options = {}
-  if '_filter_options' not in scene_struct:
+  scene_cache = qeng.get_scene_cache(scene_struct)
+  if '_filter_options' not in scene_cache:
     precompute_filter_options(scene_struct, metadata)
 
   # TODO: Right now this is only looking for nontrivial combinations; in some
@@ -174,7 +193,7 @@ def find_relate_filter_options(object_idx, scene_struct, metadata,
   trivial_options = {}
   for relationship in scene_struct['relationships']:
     related = set(scene_struct['relationships'][relationship][object_idx])
-    for filters, filtered in scene_struct['_filter_options'].items():
+    for filters, filtered in scene_cache['_filter_options'].items():
       intersection = related & filtered
       trivial = (intersection == filtered)
       if unique and len(intersection) != 1: continue
@@ -483,14 +502,8 @@ def instantiate_templates_dfs(scene_struct, template, metadata, answer_counts,
   for state in final_states:
     structured_questions.append(state['nodes'])
     answers.append(state['answer'])
-    text = random.choice(template['text'])
-    for name, val in state['vals'].items():
-      if val in synonyms:
-        val = random.choice(synonyms[val])
-      text = text.replace(name, val)
-      text = ' '.join(text.split())
-    text = replace_optionals(text)
-    text = ' '.join(text.split())
+    compiled = random.choice(template['_text_compiled'])
+    text = realize_text(compiled, state['vals'], synonyms)
     text = other_heuristic(text, state['vals'])
     text_questions.append(text)
 
@@ -529,6 +542,110 @@ def replace_optionals(s):
   return s
 
 
+TEXT_TOKEN_PATTERN = re.compile(r'(<[A-Z0-9_]+>|\[|\])')
+
+
+def compile_text_template(text):
+  """
+  Compile a text template into a sequence of tokens so that it can be realized
+  without repeated string replacement. Each token is a tuple:
+
+  ('text', s): literal text s
+  ('param', name): a slot filled with the (synonym of the) value of name
+  ('optional', tokens): a compiled subsequence that is kept with probability
+    0.5, as in replace_optionals
+
+  For example "What [is] <C>" compiles to
+
+  [('text', 'What '), ('optional', [('text', 'is')]), ('text', ' '),
+   ('param', '<C>')]
+  """
+  root = []
+  stack = [root]
+  for piece in TEXT_TOKEN_PATTERN.split(text):
+    if piece == '':
+      continue
+    if piece == '[':
+      optional = []
+      stack[-1].append(('optional', optional))
+      stack.append(optional)
+    elif piece == ']' and len(stack) > 1:
+      stack.pop()
+    elif piece.startswith('<'):
+      stack[-1].append(('param', piece))
+    else:
+      stack[-1].append(('text', piece))
+
+  # Brackets that are never closed are not optional; splice their contents
+  # back into the enclosing sequence as literal text.
+  while len(stack) > 1:
+    unclosed = stack.pop()
+    parent = stack[-1]
+    assert parent[-1][0] == 'optional' and parent[-1][1] is unclosed
+    parent[-1] = ('text', '[')
+    parent.extend(unclosed)
+  return root
+
+
+def build_synonym_table(synonyms):
+  """
+  Convert the synonyms JSON into a table mapping each value to a tuple of
+  choices, so that realizing text needs a single lookup per parameter.
+  """
+  return {val: tuple(choices) for val, choices in synonyms.items()}
+
+
+def realize_text(compiled, vals, synonym_table):
+  """
+  Realize a compiled text template (from compile_text_template) with the
+  parameter values in vals. Each parameter gets a single synonym for all of
+  its occurrences; parameters missing from vals are left as-is.
+  """
+  words = {}
+  for name, val in vals.items():
+    choices = synonym_table.get(val)
+    words[name] = random.choice(choices) if choices else val
+
+  pieces = []
+  def emit(tokens):
+    for kind, value in tokens:
+      if kind == 'text':
+        pieces.append(value)
+      elif kind == 'param':
+        pieces.append(words.get(value, value))
+      elif random.random() > 0.5:
+        emit(value)
+  emit(compiled)
+  return ' '.join(''.join(pieces).split())
+
+
+def peak_rss_mb():
+  """
+  Peak resident set size of this process in megabytes
+  """
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    # ru_maxrss is in bytes on OSX but kilobytes on Linux
+    rss /= 1024.0
+  return rss / 1024.0
+
+
+def load_scene_file(path):
+  """
+  Read scenes from a scene JSON file, or from a binary scene file written by
+  scene_store.py if path ends in .bin; the latter are memory-mapped rather than
+  parsed. Returns (scenes, info).
+  """
+  if path.endswith('.bin'):
+    # numpy is only needed for binary scene files
+    import scene_store
+    store = scene_store.MappedSceneStore(path)
+    return store, store.info
+  with open(path, 'r') as f:
+    scene_data = json.load(f)
+  return scene_data['scenes'], scene_data['info']
+
+
 def main(args):
   with open(args.metadata_file, 'r') as f:
     metadata = json.load(f)
@@ -552,6 +669,8 @@ def main(args):
       for i, template in enumerate(json.load(f)):
         num_loaded_templates += 1
         key = (fn, i)
+        template['_text_compiled'] = [compile_text_template(t)
+                                      for t in template['text']]
         templates[key] = template
   print('Read %d templates from disk' % num_loaded_templates)
 
@@ -581,11 +700,7 @@ def main(args):
   template_counts, template_answer_counts = reset_counts()
 
   # Read file containing input scenes
-  all_scenes = []
-  with open(args.input_scene_file, 'r') as f:
-    scene_data = json.load(f)
-    all_scenes = scene_data['scenes']
-    scene_info = scene_data['info']
+  all_scenes, scene_info = load_scene_file(args.input_scene_file)
   begin = args.scene_start_idx
   if args.num_scenes > 0:
     end = args.scene_start_idx + args.num_scenes
@@ -595,13 +710,28 @@ def main(args):
 
   # Read synonyms file
   with open(args.synonyms_json, 'r') as f:
-    synonyms = json.load(f)
+    synonyms = build_synonym_table(json.load(f))
+
+  vocab = None
+  if args.output_format in ['npy', 'both']:
+    # numpy is only needed for encoded output
+    import question_encoding as qenc
+    if args.input_vocab_json is not None:
+      vocab = qenc.load_vocab(args.input_vocab_json)
+      # Fail now rather than after all questions have been generated
+      qenc.check_vocab(vocab, templates)
+    else:
+      vocab = qenc.build_vocab(templates, metadata, synonyms)
 
   questions = []
   scene_count = 0
   for i, scene in enumerate(all_scenes):
     scene_fn = scene['image_filename']
-    scene_struct = scene
+    # Caches derived from the scene live in a per-scene context that is
+    # released once we are done with the scene, so they do not accumulate
+    # in all_scenes over the whole run. Scenes written without relationships
+    # have them derived by the context as well.
+    scene_struct = qeng.SceneContext(scene)
     print('starting image %s (%d / %d)'
           % (scene_fn, i + 1, len(all_scenes)))
 
@@ -656,6 +786,11 @@ def main(args):
         print('did not get any =(')
       if num_instantiated >= args.templates_per_image:
         break
+    scene_struct.release()
+    if args.verbose:
+      print('peak RSS: %.1f MB' % peak_rss_mb())
+
+  print('peak RSS after %d scenes: %.1f MB' % (scene_count, peak_rss_mb()))
 
   # Change "side_inputs" to "value_inputs" in all functions of all functional
   # programs. My original name for these was "side_inputs" but I decided to
@@ -677,12 +812,19 @@ def main(args):
       else:
         f['value_inputs'] = []
 
-  with open(args.output_questions_file, 'w') as f:
-    print('Writing output to %s' % args.output_questions_file)
-    json.dump({
-        'info': scene_info,
-        'questions': questions,
-      }, f)
+  if args.output_format in ['json', 'both']:
+    with open(args.output_questions_file, 'w') as f:
+      print('Writing output to %s' % args.output_questions_file)
+      json.dump({
+          'info': scene_info,
+          'questions': questions,
+        }, f)
+
+  if vocab is not None:
+    arrays = qenc.encode_questions(questions, vocab, verbose=args.verbose)
+    print('Writing encoded output to %s' % args.output_encoded_dir)
+    qenc.write_encoded_questions(args.output_encoded_dir, arrays)
+    qenc.write_vocab(args.output_vocab_json, vocab)
 
 
 if __name__ == '__main__':